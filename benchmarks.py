@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+Benchmarks for django-field-history.
+
+Runs against a fresh test database using the same settings as runtests.py::
+
+    python benchmarks.py                 # run every benchmark
+    python benchmarks.py serialization   # run the named benchmarks
+"""
+from __future__ import print_function
+
+import datetime
+from decimal import Decimal
+import os
+import sys
+import timeit
+
+import runtests  # noqa: F401 (configures settings)
+
+from django.core import serializers
+from django.db import connection, models
+from django.test.utils import setup_test_environment
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def report(label, seconds, number):
+    print('  {:<48} {:>10.2f} us/op'.format(label, seconds / number * 1e6))
+
+
+def report_memory(label, func):
+    try:
+        import tracemalloc
+    except ImportError:
+        return  # Python 2
+    tracemalloc.start()
+    try:
+        result = func()  # noqa: F841 (keep the result alive until measured)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print('  {:<48} {:>10.1f} KiB peak'.format(label, peak / 1024.0))
+
+
+@benchmark
+def serialization(number=5000):
+    """Per-save serialization cost of four changed fields."""
+    from field_history.serialization import serialize_fields
+    from tests.models import Human
+
+    human = Human.objects.create(age=18, body_temp=Decimal('98.60'),
+                                 birth_date=datetime.date(1991, 11, 6))
+    fields = sorted(Human.field_history.fields)
+    plan = Human.field_history.get_serialization_plan(human)
+
+    def per_field():
+        for field in fields:
+            serializers.serialize('json', [human], fields=[field])
+
+    report('serializers.serialize() per field', timeit.timeit(per_field, number=number), number)
+    report('serialize_fields()', timeit.timeit(lambda: serialize_fields(human, fields), number=number), number)
+    report('SerializationPlan.serialize()', timeit.timeit(lambda: plan.serialize(human, fields), number=number), number)
+
+
+@benchmark
+def field_histories(number=20000):
+    """Building the unsaved FieldHistory objects of four changed fields."""
+    from tests.models import Human
+
+    human = Human.objects.create(age=18, body_temp=Decimal('98.60'),
+                                 birth_date=datetime.date(1991, 11, 6))
+    fields = sorted(Human.field_history.fields)
+    tracker = Human.field_history
+
+    report('get_field_histories()', timeit.timeit(lambda: tracker.get_field_histories(human, fields), number=number),
+           number)
+
+
+@benchmark
+def writers(counts=(2000, 8000)):
+    """Saves in one transaction with the immediate and transaction writers."""
+    from django.db import transaction
+    from field_history.models import FieldHistory
+    from field_history.writers import ImmediateWriter, TransactionWriter
+    from tests.models import PizzaOrder
+
+    tracker = PizzaOrder.field_history
+    for writer in (ImmediateWriter(), TransactionWriter()):
+        for count in counts:
+            PizzaOrder.objects.bulk_create(PizzaOrder(status='ORDERED') for _ in range(count))
+            orders = list(PizzaOrder.objects.all())
+
+            def save():
+                with transaction.atomic():
+                    for order in orders:
+                        order.status = 'COOKING' if order.status == 'ORDERED' else 'ORDERED'
+                        order.save()
+
+            tracker.writer = writer
+            try:
+                report('{}: {} saves'.format(writer.__class__.__name__, count), timeit.timeit(save, number=1), count)
+            finally:
+                tracker.writer = None
+            PizzaOrder.objects.all().delete()
+            FieldHistory.objects.all().delete()
+
+
+@benchmark
+def loading(number=20, count=2000):
+    """Iterating a queryset of tracked objects versus untracked objects."""
+    from tests.models import Pet, PizzaOrder
+
+    PizzaOrder.objects.bulk_create(PizzaOrder(status='ORDERED') for _ in range(count))
+    Pet.objects.bulk_create(Pet(name='Garfield') for _ in range(count))
+
+    report('untracked: {} Pets'.format(count),
+           timeit.timeit(lambda: list(Pet.objects.all()), number=number), number)
+
+    # The least any post_init receiver costs, which tracking can't go below
+    def receiver(sender, instance, **kwargs):
+        pass
+
+    models.signals.post_init.connect(receiver, sender=Pet)
+    try:
+        report('no-op post_init: {} Pets'.format(count),
+               timeit.timeit(lambda: list(Pet.objects.all()), number=number), number)
+    finally:
+        models.signals.post_init.disconnect(receiver, sender=Pet)
+    report('tracked: {} PizzaOrders'.format(count),
+           timeit.timeit(lambda: list(PizzaOrder.objects.all()), number=number), number)
+
+
+@benchmark
+def snapshots(number=5, count=2000):
+    """Loading objects with a tracked JSON field: deepcopy versus snapshot_value()."""
+    from copy import deepcopy
+    from field_history import tracker
+    from tests.models import Document
+
+    data = {
+        'title': 'Draft',
+        'tags': ['tag{}'.format(i) for i in range(20)],
+        'sections': [{'heading': 'Section {}'.format(i), 'words': i * 100} for i in range(20)],
+    }
+    Document.objects.bulk_create(Document(data=data) for _ in range(count))
+
+    snapshot_value = tracker.snapshot_value
+    for label, snapshot in (('deepcopy', deepcopy), ('snapshot_value', snapshot_value)):
+        tracker.snapshot_value = snapshot
+        try:
+            seconds = timeit.timeit(lambda: list(Document.objects.all()), number=number)
+            report('{}: {} Documents'.format(label, count), seconds, number)
+            report_memory('{}: {} Documents'.format(label, count), lambda: list(Document.objects.all()))
+        finally:
+            tracker.snapshot_value = snapshot_value
+
+
+@benchmark
+def indexes(number=1000, count=1000000, objects=100000):
+    """Manager lookups on a large table: composite indexes versus single-column indexes."""
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import models
+    from django.utils import timezone
+    from field_history.models import FieldHistory
+    from tests.models import Person
+
+    content_type_id = ContentType.objects.get_for_model(Person).pk
+    table = FieldHistory._meta.db_table
+    now = timezone.now()
+    rows = ((content_type_id, str(i % objects), ('name', 'created_by')[i % 2], '[]', now) for i in range(count))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO {} (content_type_id, object_id, field_name, serialized_data, date_created) '
+            'VALUES (%s, %s, %s, %s, %s)'.format(connection.ops.quote_name(table)), rows)
+    print('  {} FieldHistory rows for {} objects'.format(count, objects))
+
+    person = Person(pk=objects // 2)
+    lookups = (
+        ('get_for_model()', FieldHistory.objects.get_for_model(person)),
+        ('get_for_model_and_field()', FieldHistory.objects.get_for_model_and_field(person, 'name')),
+    )
+    composite = FieldHistory._meta.indexes
+    single_column = [models.Index(fields=[field], name='field_history_bench_{}'.format(field))
+                     for field in ('object_id', 'content_type', 'field_name')]
+
+    def run(label):
+        for name, queryset in lookups:
+            queryset = queryset.order_by('-date_created')[:10]
+            report('{}: {}'.format(label, name), timeit.timeit(lambda: list(queryset.all()), number=number), number)
+            print('    {}'.format(queryset.explain().replace('\n', '\n    ')))
+
+    run('composite')
+    with connection.schema_editor() as schema_editor:
+        for index in composite:
+            schema_editor.remove_index(FieldHistory, index)
+        for index in single_column:
+            schema_editor.add_index(FieldHistory, index)
+    try:
+        run('single-column')
+    finally:
+        with connection.schema_editor() as schema_editor:
+            for index in single_column:
+                schema_editor.remove_index(FieldHistory, index)
+            for index in composite:
+                schema_editor.add_index(FieldHistory, index)
+        FieldHistory.objects.all().delete()
+
+
+@benchmark
+def decoding(count=100000):
+    """Scanning history and decoding field values, per row."""
+    from django.contrib.contenttypes.models import ContentType
+    from django.utils import timezone
+    from field_history.models import FieldHistory
+    from tests.models import Human
+
+    human = Human.objects.create(age=18, body_temp=Decimal('98.60'),
+                                 birth_date=datetime.date(1991, 11, 6))
+    fields = sorted(Human.field_history.fields)
+    serialized_data = Human.field_history.get_serialization_plan(human).serialize(human, fields)
+    content_type_id = ContentType.objects.get_for_model(Human).pk
+    now = timezone.now()
+    rows = ((content_type_id, str(human.pk), fields[i % len(fields)], serialized_data[fields[i % len(fields)]], now)
+            for i in range(count))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO {} (content_type_id, object_id, field_name, serialized_data, date_created) '
+            'VALUES (%s, %s, %s, %s, %s)'.format(connection.ops.quote_name(FieldHistory._meta.db_table)), rows)
+
+    def deserialize():
+        for field_history in FieldHistory.objects.all():
+            getattr(list(serializers.deserialize('json', field_history.serialized_data))[0].object,
+                    field_history.field_name)
+
+    def field_value():
+        for field_history in FieldHistory.objects.all():
+            field_history.field_value
+
+    def field_values():
+        for row in FieldHistory.objects.field_values('field_name'):
+            row['field_value']
+
+    report('{} rows: serializers.deserialize()'.format(count), timeit.timeit(deserialize, number=1), count)
+    report('{} rows: FieldHistory.field_value'.format(count), timeit.timeit(field_value, number=1), count)
+    report('{} rows: QuerySet.field_values()'.format(count), timeit.timeit(field_values, number=1), count)
+
+
+@benchmark
+def deltas(versions=200, words=4000):
+    """Storing edits of a large text field as deltas: storage size versus read latency."""
+    import random
+    from django.db.models import Sum
+    from django.db.models.functions import Length
+    from field_history.models import FieldHistory
+    from tests.models import Article
+
+    vocabulary = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+    rng = random.Random(0)
+    body = [rng.choice(vocabulary) for _ in range(words)]
+    edits = []
+    for _ in range(versions):
+        start = rng.randrange(words)
+        edits.append((start, [rng.choice(vocabulary) for _ in range(rng.randint(1, 20))]))
+
+    tracker = Article.field_history
+    keyframe_interval = tracker.keyframe_interval
+    try:
+        for interval in (1, 5, 20, 50):
+            tracker.keyframe_interval = interval
+            article = Article.objects.create(title='Draft', body=' '.join(body))
+            text = list(body)
+            for start, words_added in edits:
+                text[start:start + len(words_added)] = words_added
+                article.body = ' '.join(text)
+                article.save()
+            histories = article.get_body_history()
+            size = histories.aggregate(size=Sum(Length('serialized_data')))['size']
+            latest = histories.latest()
+            label = 'keyframe_interval={}'.format(interval)
+            print('  {:<48} {:>10.1f} KiB'.format('{}: {} versions'.format(label, versions + 1), size / 1024.0))
+            report('{}: field_value of the latest'.format(label),
+                   timeit.timeit(lambda: FieldHistory.objects.get(pk=latest.pk).field_value, number=20), 20)
+            report('{}: field_values() per row'.format(label),
+                   timeit.timeit(lambda: list(histories.field_values('pk')), number=1), versions + 1)
+    finally:
+        tracker.keyframe_interval = keyframe_interval
+
+
+@benchmark
+def initial_history(count=20000):
+    """createinitialfieldhistory for objects without history, per object."""
+    from django.core.management import call_command
+    from field_history.models import FieldHistory
+    from tests.models import PizzaOrder
+
+    # PizzaOrder's default manager doesn't record history of bulk_create()
+    PizzaOrder.objects.bulk_create(PizzaOrder(status='ORDERED') for _ in range(count))
+    queries = []
+
+    def count_queries(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        seconds = timeit.timeit(lambda: call_command('createinitialfieldhistory', stdout=open(os.devnull, 'w')),
+                                number=1)
+    report('{} objects: createinitialfieldhistory'.format(count), seconds, count)
+    print('  {:<48} {:>10}'.format('queries', len(queries)))
+    FieldHistory.objects.all().delete()
+
+
+@benchmark
+def pruning(count=200000, objects=10000):
+    """prune_field_history() keeping the latest 5 FieldHistory objects of each field."""
+    from django.contrib.contenttypes.models import ContentType
+    from django.utils import timezone
+    from field_history.models import FieldHistory
+    from field_history.retention import RetentionPolicy, iter_prune_field_history
+    from tests.models import Person
+
+    content_type_id = ContentType.objects.get_for_model(Person).pk
+    now = timezone.now()
+    rows = ((content_type_id, str(i % objects), 'name', '[]', now - datetime.timedelta(minutes=i))
+            for i in range(count))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO {} (content_type_id, object_id, field_name, serialized_data, date_created) '
+            'VALUES (%s, %s, %s, %s, %s)'.format(connection.ops.quote_name(FieldHistory._meta.db_table)), rows)
+
+    batches = []
+    deleted = 0
+    start = timeit.default_timer()
+    for batch_deleted in iter_prune_field_history(Person, RetentionPolicy(keep_last=5)):
+        batches.append(timeit.default_timer() - start - sum(batches))
+        deleted += batch_deleted
+    report('{} of {} rows deleted'.format(deleted, count), sum(batches), deleted)
+    print('  {:<48} {:>10.1f} ms'.format('longest batch of 1000 objects', max(batches) * 1000))
+    FieldHistory.objects.all().delete()
+
+
+def main(names):
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        for func in BENCHMARKS:
+            if not names or func.__name__ in names:
+                print('{}: {}'.format(func.__name__, func.__doc__))
+                func()
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict['NAME'], verbosity=0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,200 @@
+from __future__ import unicode_literals
+
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+try:
+    from django.utils import six
+except ImportError:
+    import six
+
+from .deltas import DELTA_PREFIX, encode_keyframe, get_delta_text
+from .managers import OBJECT_FIELDS
+from .models import FieldHistory, get_content_type_id
+from .retention import rebase_deltas
+from .serialization import deserialize_field_value
+
+ARCHIVE_DIR_SETTING = 'FIELD_HISTORY_ARCHIVE_DIR'
+
+# FieldHistory objects archived per transaction
+BATCH_SIZE = 1000
+
+# FieldHistory fields written to the archive, besides the object id
+ARCHIVED_FIELDS = ('pk', 'field_name', 'serialized_data', 'date_created', 'user_id')
+
+MONTH_FORMAT = '%Y-%m'
+FILE_SUFFIX = '.jsonl.gz'
+
+
+def get_archive_dir(directory=None):
+    directory = directory or getattr(settings, ARCHIVE_DIR_SETTING, None)
+    if not directory:
+        raise ValueError('settings.{} must be set to archive field history'.format(ARCHIVE_DIR_SETTING))
+    return directory
+
+
+def get_month(date):
+    """Returns the month of ``date``, in UTC if it's aware, as ``'YYYY-MM'``"""
+    if timezone.is_aware(date):
+        date = date.astimezone(timezone.utc)
+    return date.strftime(MONTH_FORMAT)
+
+
+def get_archive_path(directory, label, month):
+    """Returns the archive of the history of model ``label`` created in ``month`` (``'YYYY-MM'``)"""
+    return os.path.join(directory, label, '{}{}'.format(month, FILE_SUFFIX))
+
+
+class ArchivedFieldHistory(object):
+    """A FieldHistory read from an archive"""
+
+    def __init__(self, content_type_id, data):
+        self.content_type_id = content_type_id
+        self.pk = self.id = data['id']
+        self.object_pk = data['object_id']
+        self.field_name = data['field_name']
+        self.serialized_data = data['serialized_data']
+        self.date_created = parse_datetime(data['date_created'])
+        self.user_id = data['user_id']
+
+    def __repr__(self):
+        return '<ArchivedFieldHistory: {} field history for {}>'.format(self.field_name, self.object_pk)
+
+    @property
+    def field_value(self):
+        return deserialize_field_value(self.serialized_data, self.field_name, self.content_type_id)
+
+
+def iter_archive_field_history(before, directory=None, models=None, batch_size=BATCH_SIZE, using=None):
+    """
+    Moves FieldHistory objects created before ``before`` (only of
+    ``models``, if given) to gzip'd JSON Lines files, yielding the number
+    moved for each batch of ``batch_size``.
+
+    Each content type and month of history has its own file under
+    ``directory`` (default: ``settings.FIELD_HISTORY_ARCHIVE_DIR``), named
+    ``app_label.model/YYYY-MM.jsonl.gz``. Every batch is appended to the files
+    as a new gzip member, which are synced to disk before the batch is
+    deleted in the same transaction. Deltas are archived as full values, and
+    remaining deltas based on archived history are rewritten as keyframes.
+    """
+    directory = get_archive_dir(directory)
+    manager = FieldHistory.objects.db_manager(using)
+    field_histories = manager.filter(date_created__lt=before)
+    if models is not None:
+        field_histories = field_histories.filter(
+            content_type_id__in=[get_content_type_id(model, manager.db) for model in models])
+
+    last_pk = None
+    while True:
+        batch = field_histories.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        with transaction.atomic(using=manager.db):
+            rows = list(batch.values(*OBJECT_FIELDS + ARCHIVED_FIELDS)[:batch_size])
+            if not rows:
+                return
+            last_pk = rows[-1]['pk']
+            pks = [row['pk'] for row in rows]
+
+            if any(row['serialized_data'].startswith(DELTA_PREFIX) for row in rows):
+                resolve_deltas(rows, set(pks), manager.db)
+            write_archive(directory, rows, manager.db)
+            manager.filter(pk__in=pks).delete()
+        yield len(rows)
+
+
+def archive_field_history(before, directory=None, models=None, batch_size=BATCH_SIZE, using=None):
+    """Moves FieldHistory objects created before ``before`` to archive files and returns how many"""
+    return sum(iter_archive_field_history(before, directory, models, batch_size, using))
+
+
+def resolve_deltas(rows, archived, using=None):
+    """
+    Replaces the serialized data of deltas in ``rows`` with keyframes, and
+    rewrites remaining deltas based on ``archived`` FieldHistory objects.
+    """
+    lookups = Q()
+    for row in rows:
+        if row['serialized_data'].startswith(DELTA_PREFIX):
+            lookups |= Q(field_name=row['field_name'], **dict((field, row[field]) for field in OBJECT_FIELDS))
+    histories = FieldHistory.objects.using(using).filter(lookups)
+    deltas = dict(histories.filter(serialized_data__startswith=DELTA_PREFIX).values_list('pk', 'serialized_data'))
+    for row in rows:
+        if row['serialized_data'].startswith(DELTA_PREFIX):
+            row['serialized_data'] = encode_keyframe(get_delta_text(row['serialized_data'], using, deltas))
+    rebase_deltas(histories, archived, using)
+
+
+def write_archive(directory, rows, using=None):
+    files = {}
+    for row in rows:
+        content_type = ContentType.objects.db_manager(using).get_for_id(row['content_type_id'])
+        label = '{}.{}'.format(content_type.app_label, content_type.model)
+        path = get_archive_path(directory, label, get_month(row['date_created']))
+        object_id = next((row[field] for field in OBJECT_FIELDS[1:] if row[field] is not None), None)
+        data = dict((field, row[field]) for field in ARCHIVED_FIELDS[1:])
+        data.update(id=row['pk'], object_id=None if object_id is None else six.text_type(object_id))
+        files.setdefault(path, []).append(json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True))
+
+    for path, lines in files.items():
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as archive:
+                archive.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def iter_archived_field_history(model, directory=None, start=None, end=None):
+    """
+    Yields the archived FieldHistory objects of ``model``, reading only the
+    files of months from ``start`` to ``end`` (datetimes), if given.
+    Objects archived more than once are yielded once.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    label_directory = os.path.join(get_archive_dir(directory), '{}.{}'.format(content_type.app_label, content_type.model))
+    if not os.path.isdir(label_directory):
+        return
+    first_month = None if start is None else get_month(start)
+    last_month = None if end is None else get_month(end)
+    seen = set()
+    for name in sorted(os.listdir(label_directory)):
+        if not name.endswith(FILE_SUFFIX):
+            continue
+        month = name[:-len(FILE_SUFFIX)]
+        if (first_month is not None and month < first_month) or (last_month is not None and month > last_month):
+            continue
+        with gzip.open(os.path.join(label_directory, name), 'rb') as archive:
+            for line in archive:
+                field_history = ArchivedFieldHistory(content_type.pk, json.loads(line.decode('utf-8')))
+                if field_history.pk not in seen:
+                    seen.add(field_history.pk)
+                    yield field_history
+
+
+def get_archived_field_history(obj, field=None, directory=None, start=None, end=None):
+    """
+    Returns the archived FieldHistory objects of ``obj`` (only of ``field``,
+    if given) created from ``start`` to ``end``, if given, latest first.
+    """
+    object_pk = six.text_type(obj.pk)
+    histories = []
+    for field_history in iter_archived_field_history(obj.__class__, directory, start, end):
+        if field_history.object_pk != object_pk or (field is not None and field_history.field_name != field):
+            continue
+        if (start is not None and field_history.date_created < start) or \
+                (end is not None and field_history.date_created > end):
+            continue
+        histories.append(field_history)
+    histories.sort(key=lambda field_history: (field_history.date_created, field_history.pk), reverse=True)
+    return histories
@@ -0,0 +1,154 @@
+"""
+Delta encoding of the values of large text and JSON fields.
+
+The history of a field tracked with ``FieldHistoryTracker(delta_fields=...)``
+is stored as a chain of rows: a keyframe holding the field's whole value,
+followed by deltas that each hold only the changes from the row before
+them. Every row starts with a header::
+
+    ~<value hash>:<pks of the rows it's based on>:<payload>
+
+A keyframe isn't based on any rows and its payload is the value, encoded
+as JSON. The payload of a delta is a list of operations turning the value
+of the last row it's based on into its own: positive integers copy that
+many characters of the previous value, negative integers skip that many
+and strings are inserted. A delta lists every row back to its keyframe,
+so its value is rebuilt with a single query.
+"""
+from __future__ import unicode_literals
+
+import difflib
+import hashlib
+import json
+import re
+
+from django.apps import apps
+try:
+    from django.utils import six
+except ImportError:
+    import six
+
+DELTA_PREFIX = '~'
+
+# Rows in a chain, counting its keyframe, before another keyframe is stored
+KEYFRAME_INTERVAL = 20
+
+# Words, runs of whitespace and single other characters are diffed as a whole
+TOKEN_RE = re.compile(r'\w+|\s+|.', re.DOTALL | re.UNICODE)
+
+
+def is_delta(serialized_data):
+    return serialized_data.startswith(DELTA_PREFIX)
+
+
+def value_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def get_header_length(keyframe_interval):
+    """Returns how many leading characters of a row hold its header at most"""
+    return len(DELTA_PREFIX) + 18 + 21 * keyframe_interval
+
+
+def parse_header(serialized_data):
+    """
+    Returns the value hash, the primary keys of the rows it's based on and
+    the payload of delta ``serialized_data``. Raises ``ValueError`` if the
+    header is incomplete.
+    """
+    digest, chain, payload = serialized_data[len(DELTA_PREFIX):].split(':', 2)
+    return digest, [int(pk) for pk in chain.split(',') if pk], payload
+
+
+def encode_keyframe(text):
+    """Returns the serialized data of a keyframe holding ``text``, a JSON encoded value"""
+    return '{}{}::{}'.format(DELTA_PREFIX, value_hash(text), text)
+
+
+def encode_delta(text, base_text, chain):
+    """
+    Returns the serialized data of a delta from ``base_text``, the value of
+    the last of the rows in ``chain``, to ``text``. A keyframe is returned
+    instead if it's no larger.
+    """
+    payload = json.dumps(diff(base_text, text), separators=(',', ':'))
+    if len(payload) >= len(text):
+        return encode_keyframe(text)
+    return '{}{}:{}:{}'.format(DELTA_PREFIX, value_hash(text), ','.join(str(pk) for pk in chain), payload)
+
+
+def diff(a, b):
+    """Returns the operations turning ``a`` into ``b``"""
+    # Most edits leave the start and end of a value alone
+    prefix = 0
+    length = min(len(a), len(b))
+    while prefix < length and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < length - prefix and a[-suffix - 1] == b[-suffix - 1]:
+        suffix += 1
+
+    ops = [prefix]
+    a_tokens = TOKEN_RE.findall(a[prefix:len(a) - suffix])
+    b_tokens = TOKEN_RE.findall(b[prefix:len(b) - suffix])
+    offsets = [0]
+    for token in a_tokens:
+        offsets.append(offsets[-1] + len(token))
+    matcher = difflib.SequenceMatcher(None, a_tokens, b_tokens)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(offsets[i2] - offsets[i1])
+            continue
+        if i2 > i1:
+            ops.append(offsets[i1] - offsets[i2])
+        if j2 > j1:
+            ops.append(''.join(b_tokens[j1:j2]))
+    ops.append(suffix)
+    return [op for op in ops if op != 0]
+
+
+def patch(a, ops):
+    """Returns the result of applying ``ops`` to ``a``"""
+    parts = []
+    position = 0
+    for op in ops:
+        if isinstance(op, six.string_types):
+            parts.append(op)
+        elif op > 0:
+            parts.append(a[position:position + op])
+            position += op
+        else:
+            position -= op
+    return ''.join(parts)
+
+
+def get_delta_text(serialized_data, using=None, rows=None, history_model=None):
+    """
+    Returns the JSON encoded value held by delta ``serialized_data``,
+    fetching the rows it's based on from the ``using`` database, out of
+    ``history_model`` (default: FieldHistory).
+
+    ``rows`` may be a dict mapping FieldHistory primary keys to their
+    serialized data, which is used and updated in place to share fetched
+    rows between calls.
+    """
+    digest, chain, text = parse_header(serialized_data)
+    if chain:
+        if rows is None:
+            rows = {}
+        missing = [pk for pk in chain if pk not in rows]
+        if missing:
+            if history_model is None:
+                history_model = apps.get_model('field_history', 'FieldHistory')
+            rows.update(history_model._default_manager.using(using).filter(pk__in=missing)
+                        .values_list('pk', 'serialized_data'))
+        try:
+            value = parse_header(rows[chain[0]])[2]
+            for pk in chain[1:]:
+                value = patch(value, json.loads(parse_header(rows[pk])[2]))
+        except KeyError:
+            raise ValueError('The field history this delta is based on has been deleted')
+        text = patch(value, json.loads(text))
+    if value_hash(text) != digest:
+        raise ValueError("The value rebuilt from this delta doesn't match its hash")
+    return text
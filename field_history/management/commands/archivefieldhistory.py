@@ -0,0 +1,97 @@
+import datetime
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from field_history.archive import BATCH_SIZE, get_archive_dir, iter_archive_field_history
+from field_history.models import FieldHistory
+from field_history.tracker import get_history_model
+
+
+class Command(BaseCommand):
+
+    help = """Moves FieldHistory objects older than a cutoff to gzip'd JSON Lines files, in batches.
+
+Files are written under --directory (default: settings.FIELD_HISTORY_ARCHIVE_DIR), one per content type and
+month, and are only ever appended to. Read them with field_history.archive.get_archived_field_history().
+
+Example:
+
+    python manage.py archivefieldhistory --older-than-days=365
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days',
+            type=int,
+            help='Archive history created more than this many days ago')
+
+        parser.add_argument(
+            '--before',
+            help='Archive history created before this date (YYYY-MM-DD)')
+
+        parser.add_argument(
+            '--directory',
+            help='The directory to write archives to')
+
+        parser.add_argument(
+            '--model',
+            action='append',
+            dest='models',
+            help='Only archive history of this model, in app_label.model_name format (e.g. auth.User). '
+                 'May be given more than once.')
+
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='The number of FieldHistory objects archived per transaction')
+
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to wait between batches, to let other queries through')
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        try:
+            directory = get_archive_dir(options.get('directory'))
+        except ValueError as e:
+            raise CommandError(e)
+        before = self.get_cutoff(options.get('older_than_days'), options.get('before'))
+        models = None
+        if options.get('models'):
+            models = [apps.get_model(model_name) for model_name in options['models']]
+            for model in models:
+                if get_history_model(model) is not FieldHistory:
+                    raise CommandError("The history of {} is kept in a table of its own, which can't be archived"
+                                       .format(model._meta.label))
+
+        self.stdout.write('Archiving FieldHistory objects created before {} to {}\n'.format(before, directory))
+        count = 0
+        for archived in iter_archive_field_history(before, directory, models, batch_size):
+            count += archived
+            self.stdout.write('  {}\n'.format(count))
+            if options.get('sleep'):
+                time.sleep(options['sleep'])
+        self.stdout.write('Archived {} FieldHistory object(s)\n'.format(count))
+
+    def get_cutoff(self, older_than_days, before):
+        if (older_than_days is None) == (before is None):
+            raise CommandError('Either --older-than-days or --before is required')
+        if older_than_days is not None:
+            return timezone.now() - datetime.timedelta(days=older_than_days)
+        date = parse_date(before)
+        if date is None:
+            raise CommandError('--before must be a date in YYYY-MM-DD format')
+        cutoff = datetime.datetime.combine(date, datetime.time())
+        if settings.USE_TZ:
+            cutoff = timezone.make_aware(cutoff)
+        return cutoff
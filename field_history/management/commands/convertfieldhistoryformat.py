@@ -0,0 +1,136 @@
+import json
+
+from django.apps import apps
+from django.core import serializers
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management import BaseCommand, CommandError
+from django.db.models import Case, TextField, Value, When
+
+from field_history.deltas import DELTA_PREFIX
+from field_history.models import FieldHistory, get_content_type_id
+from field_history.serialization import (
+    COMPACT, COMPACT_PREFIX, SerializationPlan, _value_from_field, decode_compact_value, encode_compact_value,
+    get_model, get_serializer_name, get_storage_format,
+)
+from field_history.tracker import get_history_model, get_model_trackers
+
+
+class Command(BaseCommand):
+
+    help = """Rewrites the serialized_data of FieldHistory objects in the format set by
+settings.FIELD_HISTORY_STORAGE_FORMAT ('document' or 'compact'), in batches.
+
+History of many-to-many fields is always kept as documents, and deltas are left as they are. Documents are written by the serializer named
+by settings.FIELD_HISTORY_SERIALIZER_NAME.
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='The number of FieldHistory objects updated per query')
+
+        parser.add_argument(
+            '--model',
+            action='append',
+            dest='models',
+            help='Only convert FieldHistory objects of this model, in app_label.model_name format '
+                 '(e.g. auth.User). May be given more than once. Defaults to all models.')
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+
+        storage_format = get_storage_format()
+        self.plans = {}
+        if storage_format == COMPACT:
+            field_histories = FieldHistory.objects.exclude(serialized_data__startswith=COMPACT_PREFIX) \
+                .exclude(serialized_data__startswith=DELTA_PREFIX)
+            convert = self.to_compact
+        else:
+            field_histories = FieldHistory.objects.filter(serialized_data__startswith=COMPACT_PREFIX)
+            convert = self.to_document
+
+        field_histories = self.filter_models(field_histories, options.get('models'))
+
+        count = 0
+        skipped = 0
+        last_pk = None
+        while True:
+            batch = field_histories.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list(
+                'pk', 'content_type_id', 'field_name', 'serialized_data',
+                'object_id_int', 'object_id_uuid', 'object_id')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+
+            whens, batch_skipped = self.convert_rows(rows, convert)
+            skipped += batch_skipped
+            if whens:
+                count += FieldHistory.objects.filter(pk__in=list(whens)).update(
+                    serialized_data=Case(*whens.values(), output_field=TextField()))
+            self.stdout.write('Converted {} FieldHistory object(s) to the {} format\n'.format(count, storage_format))
+        if skipped:
+            self.stdout.write('Skipped {} FieldHistory object(s) of fields that no longer exist\n'.format(skipped))
+
+    def convert_rows(self, rows, convert):
+        """Returns the When()s setting the converted data of ``rows``, and the number of rows skipped"""
+        whens = {}
+        skipped = 0
+        for row in rows:
+            pk, content_type_id, field_name, serialized_data = row[:4]
+            object_pk = next((object_id for object_id in row[4:] if object_id is not None), None)
+            model = get_model(content_type_id)
+            if model is None:
+                continue  # The model no longer exists
+            try:
+                field = model._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                # The field was renamed or removed, so its history is left as it is
+                skipped += 1
+                continue
+            converted = convert(model, field, object_pk, serialized_data)
+            if converted is not None:
+                whens[pk] = When(pk=pk, then=Value(converted))
+        return whens, skipped
+
+    def filter_models(self, field_histories, model_names):
+        if not model_names:
+            for model in apps.get_models():
+                if get_model_trackers(model) and not model._meta.proxy and get_history_model(model) is not FieldHistory:
+                    self.stderr.write("The history of {} is kept in a table of its own, which isn't converted\n"
+                                      .format(model._meta.label))
+            return field_histories
+        models = [apps.get_model(model_name) for model_name in model_names]
+        for model in models:
+            if get_history_model(model) is not FieldHistory:
+                raise CommandError("The history of {} is kept in a table of its own, which can't be converted"
+                                   .format(model._meta.label))
+        return field_histories.filter(content_type_id__in=[get_content_type_id(model) for model in models])
+
+    def to_compact(self, model, field, object_pk, serialized_data):
+        if field.many_to_many:
+            return None
+        if serialized_data.startswith('['):
+            field_data = json.loads(serialized_data)[0]['fields']
+            if field.name in field_data:
+                return encode_compact_value(field_data[field.name])
+            deserialized = serializers.deserialize('json', serialized_data)
+        else:
+            deserialized = serializers.deserialize(get_serializer_name(), serialized_data)
+        # Documents without the field (e.g. parent fields) hold its default
+        return encode_compact_value(_value_from_field(list(deserialized)[0].object, field))
+
+    def to_document(self, model, field, object_pk, serialized_data):
+        # Serialize an instance holding the compact value, like the one it was read from
+        instance = model(**{field.attname: field.to_python(decode_compact_value(serialized_data))})
+        instance.pk = model._meta.pk.to_python(object_pk)
+        key = (model, field.name)
+        if key not in self.plans:
+            self.plans[key] = SerializationPlan(model, [field.name])
+        return self.plans[key].serialize_documents(instance, [field.name])[field.name]
@@ -0,0 +1,118 @@
+import re
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand, CommandError
+from django.db.models import BigIntegerField, Case, UUIDField, Value, When
+from django.db.models.functions import Cast
+
+from field_history.models import FieldHistory, TYPED_OBJECT_ID_SETTING, get_typed_object_id_attname
+from field_history.tracker import get_history_model, get_model_trackers
+
+# Object ids that can be cast to a bigint by every database
+INTEGER_RE = re.compile(r'^-?[0-9]+$')
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
+
+
+class Command(BaseCommand):
+
+    help = """Copies FieldHistory object ids of models with integer or UUID primary keys to the object_id_int and
+object_id_uuid fields, in batches. Once settings.FIELD_HISTORY_TYPED_OBJECT_ID is set, the object_id
+field of those FieldHistory objects is also cleared.
+
+Run this before and again after setting FIELD_HISTORY_TYPED_OBJECT_ID.
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            action='append',
+            dest='models',
+            help='Only convert FieldHistory objects of this model, in app_label.model_name format '
+                 '(e.g. auth.User). May be given more than once. Defaults to all tracked models.')
+
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='The number of FieldHistory objects updated per query')
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        clear_object_id = getattr(settings, TYPED_OBJECT_ID_SETTING, False)
+
+        if options.get('models'):
+            models = [apps.get_model(model_name) for model_name in options['models']]
+            for model in models:
+                if get_history_model(model) is not FieldHistory:
+                    raise CommandError('The history of {} is kept in a table of its own, with a foreign key '
+                                       'instead of object ids'.format(model._meta.label))
+        else:
+            models = [model for model in apps.get_models()
+                      if get_model_trackers(model) and not model._meta.proxy and get_history_model(model) is FieldHistory]
+
+        for model in models:
+            attname = get_typed_object_id_attname(model)
+            if attname == 'object_id':
+                continue
+            count = self.convert(model, attname, batch_size, clear_object_id)
+            self.stdout.write('Converted {} FieldHistory object(s) for {}\n'.format(count, model._meta.label))
+
+    def convert(self, model, attname, batch_size, clear_object_id):
+        content_type = ContentType.objects.get_for_model(model)
+        field_histories = FieldHistory.objects.filter(content_type=content_type, object_id__isnull=False)
+        if not clear_object_id:
+            field_histories = field_histories.filter(**{'{}__isnull'.format(attname): True})
+
+        count = 0
+        last_pk = None
+        while True:
+            batch = field_histories.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', 'object_id')[:batch_size])
+            if not rows:
+                return count
+            last_pk = rows[-1][0]
+
+            typed_object_ids = {}
+            for pk, object_id in rows:
+                typed_object_id = self.get_typed_object_id(attname, object_id)
+                if typed_object_id is None:
+                    # Left as it is, so the object id isn't lost
+                    self.stderr.write('FieldHistory {} of {} has an invalid object id: {!r}\n'.format(
+                        pk, model._meta.label, object_id))
+                else:
+                    typed_object_ids[pk] = typed_object_id
+            if not typed_object_ids:
+                continue
+
+            values = {attname: self.get_typed_value(attname, typed_object_ids)}
+            if clear_object_id:
+                values['object_id'] = None
+            count += FieldHistory.objects.filter(pk__in=list(typed_object_ids)).update(**values)
+            self.stdout.write('  {}: {}\n'.format(model._meta.label, count))
+
+    def get_typed_object_id(self, attname, object_id):
+        """Returns ``object_id`` as an integer or UUID, or None if it isn't a valid one"""
+        if attname == 'object_id_int':
+            if not INTEGER_RE.match(object_id):
+                return None
+            value = int(object_id)
+            return value if BIGINT_MIN <= value <= BIGINT_MAX else None
+        try:
+            return uuid.UUID(object_id)
+        except ValueError:
+            return None
+
+    def get_typed_value(self, attname, typed_object_ids):
+        if attname == 'object_id_int':
+            return Cast('object_id', BigIntegerField())
+        return Case(*[When(pk=pk, then=Value(object_id, output_field=UUIDField()))
+                      for pk, object_id in typed_object_ids.items()],
+                    output_field=UUIDField())
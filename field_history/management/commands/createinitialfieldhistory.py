@@ -1,47 +1,261 @@
+from collections import defaultdict
 import inspect
+import json
+import multiprocessing
+import os
+import time
 
-from django.contrib.contenttypes.models import ContentType
 from django.apps import apps
-from django.core import serializers
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+try:
+    from django.utils import six
+except ImportError:
+    import six
 
-from field_history.models import FieldHistory
-from field_history.tracker import FieldHistoryTracker, get_serializer_name
+from field_history.models import FieldHistory, get_content_type_id
+from field_history.tracker import FieldHistoryTracker
+
+
+def get_tracked_models():
+    """Returns a list of (model, FieldHistoryTracker) for every concrete tracked model"""
+    models = []
+    for model in apps.get_models():
+        if model._meta.proxy:
+            continue  # Its history is that of the concrete model
+        for member in inspect.getmembers(model):
+            if isinstance(member[1], FieldHistoryTracker):
+                models.append((model, member[1]))
+                break
+    return models
+
+
+def get_partitions(model, count):
+    """
+    Splits the primary keys of ``model`` into at most ``count`` ranges of
+    about as many objects. Returns a list of ``(lower, upper)`` pairs of
+    primary keys as text, excluding ``lower`` and including ``upper``, where
+    ``None`` leaves a range unbounded.
+    """
+    bounds = []
+    if count > 1:
+        pks = model._default_manager.order_by('pk').values_list('pk', flat=True)
+        total = pks.count()
+        for i in range(1, count):
+            index = total * i // count - 1
+            if index >= 0:
+                bound = six.text_type(pks[index])
+                if bound not in bounds:
+                    bounds.append(bound)
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def iter_initial_field_histories(model, tracker, lower=None, upper=None, batch_size=1000):
+    """
+    Creates FieldHistory objects for the tracked fields without history of
+    ``model`` objects with primary keys after ``lower`` up to ``upper``, in
+    batches. Yields the last primary key, the number of objects and the
+    number of FieldHistory objects created of each batch.
+    """
+    fields = sorted(tracker.fields)
+    history_model = tracker.history_model
+    manager = history_model._default_manager
+    object_id_attname = manager.get_object_id_attname(model)
+    existing_history = manager.get_for_model_class(model).filter(field_name__in=fields)
+    object_id_field = history_model._meta.get_field(object_id_attname)
+    object_fields = {}
+    if history_model is FieldHistory:
+        object_fields['content_type_id'] = get_content_type_id(model)
+    objects = model._default_manager.order_by('pk')
+    if upper is not None:
+        objects = objects.filter(pk__lte=model._meta.pk.to_python(upper))
+    last_pk = None if lower is None else model._meta.pk.to_python(lower)
+
+    while True:
+        batch = objects
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        objs = list(batch[:batch_size])
+        if not objs:
+            break
+        last_pk = objs[-1].pk
+
+        # Fields of these objects that already have history
+        existing = set(existing_history.filter(**{'{}__in'.format(object_id_attname): [obj.pk for obj in objs]})
+                       .values_list(object_id_attname, 'field_name').distinct())
+        field_histories = []
+        for obj in objs:
+            object_id = object_id_field.to_python(obj.pk)
+            missing_fields = [field for field in fields if (object_id, field) not in existing]
+            if not missing_fields:
+                continue
+            serialized_data = tracker.get_serialization_plan(obj).serialize(obj, missing_fields)
+            object_fields[object_id_attname] = obj.pk
+            field_histories.extend(
+                history_model(
+                    field_name=field,
+                    serialized_data=serialized_data[field],
+                    **object_fields
+                )
+                for field in missing_fields
+            )
+        # Split into as many inserts as the database needs
+        manager.bulk_create(field_histories)
+        yield last_pk, len(objs), len(field_histories)
+
+
+def initialize_worker():
+    # Workers that don't start as a copy of the parent process set Django up again
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def create_partition(args):
+    """Creates the initial history of one partition of a model, in a worker process"""
+    label, index, lower, upper, batch_size = args
+    model = apps.get_model(label)
+    tracker = dict(get_tracked_models())[model]
+    start = time.time()
+    objects = created = 0
+    for last_pk, batch_objects, batch_created in iter_initial_field_histories(model, tracker, lower, upper, batch_size):
+        objects += batch_objects
+        created += batch_created
+    connections.close_all()
+    return label, index, objects, created, time.time() - start, os.getpid()
 
 
 class Command(BaseCommand):
 
-    help = "Adds initial FieldHistory objects"
+    help = """Adds initial FieldHistory objects for tracked fields without any history.
+
+Objects are read in batches of --batch-size, in primary key order. With --workers, the primary keys of each
+model are split into that many ranges, which a pool of processes works through in parallel.
+
+With --checkpoint, progress is saved to the given file after every batch (or range, with --workers), and a
+later run with the same file resumes from there. Delete the file to start over.
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='The number of objects read per query')
+        parser.add_argument(
+            '--checkpoint',
+            help='A file recording progress, to resume an interrupted run')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='The number of processes creating history in parallel')
+        parser.add_argument(
+            '--models',
+            nargs='+',
+            metavar='APP_LABEL.MODEL_NAME',
+            help='Only create history for these tracked models')
 
     def handle(self, *args, **options):
-        models = []
-        for model in apps.get_models():
-            for member in inspect.getmembers(model):
-                if isinstance(member[1], FieldHistoryTracker):
-                    models.append((model, member[1].fields))
-                    break
+        batch_size = options.get('batch_size')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        workers = options.get('workers')
+        if workers < 1:
+            raise CommandError('--workers must be a positive integer')
+        if workers > 1 and getattr(connections[DEFAULT_DB_ALIAS], 'is_in_memory_db', lambda: False)():
+            raise CommandError("--workers can't be used with an in-memory database")
+
+        models = get_tracked_models()
+        if options.get('models'):
+            tracked = dict((model._meta.label_lower, (model, tracker)) for model, tracker in models)
+            models = []
+            for label in options['models']:
+                if label.lower() not in tracked:
+                    raise CommandError('{} is not a tracked model'.format(label))
+                models.append(tracked[label.lower()])
+
+        self.checkpoint_path = options.get('checkpoint')
+        self.checkpoint = self.read_checkpoint()
 
         if models:
             self.stdout.write('Creating initial field history for {} models\n'.format(len(models)))
 
-            for model_fields in models:
-                model = model_fields[0]
-                fields = model_fields[1]
-
-                for obj in model._default_manager.all():
-                    for field in list(fields):
-                        content_type = ContentType.objects.get_for_model(obj)
-                        if not FieldHistory.objects.filter(
-                                object_id=obj.pk,
-                                content_type=content_type,
-                                field_name=field).exists():
-                            data = serializers.serialize(get_serializer_name(),
-                                                         [obj],
-                                                         fields=[field])
-                            FieldHistory.objects.create(
-                                object=obj,
-                                field_name=field,
-                                serialized_data=data,
-                            )
+            progress = [(model, tracker, self.get_partitions(model, workers)) for model, tracker in models]
+            if workers > 1:
+                self.create_in_parallel(progress, workers, batch_size)
+            else:
+                for model, tracker, partitions in progress:
+                    self.create_initial_field_history(model, tracker, partitions, batch_size)
         else:
             self.stdout.write('There are no models to create field history for.')
+
+    def get_partitions(self, model, workers):
+        """Returns the progress of each partition of ``model``, as recorded in the checkpoint"""
+        label = model._meta.label
+        if label not in self.checkpoint:
+            self.checkpoint[label] = [{'lower': lower, 'upper': upper, 'last_pk': None, 'done': False}
+                                      for lower, upper in get_partitions(model, workers)]
+            self.write_checkpoint()
+        return self.checkpoint[label]
+
+    def create_initial_field_history(self, model, tracker, partitions, batch_size):
+        label = model._meta.label
+        count = 0
+        for partition in partitions:
+            if partition['done']:
+                continue
+            lower = partition['last_pk'] or partition['lower']
+            for last_pk, objects, created in iter_initial_field_histories(
+                    model, tracker, lower, partition['upper'], batch_size):
+                count += created
+                partition['last_pk'] = six.text_type(last_pk)
+                self.write_checkpoint()
+                self.stdout.write('{}: created {} FieldHistory object(s), up to pk {}\n'.format(label, count, last_pk))
+            partition['done'] = True
+            self.write_checkpoint()
+
+    def create_in_parallel(self, progress, workers, batch_size):
+        tasks = [
+            (model._meta.label, index, partition['last_pk'] or partition['lower'], partition['upper'], batch_size)
+            for model, tracker, partitions in progress
+            for index, partition in enumerate(partitions) if not partition['done']
+        ]
+        # Workers open connections of their own rather than sharing these
+        connections.close_all()
+        # pid -> [partitions, objects, FieldHistory objects, seconds]
+        stats = defaultdict(lambda: [0, 0, 0, 0.0])
+        pool = multiprocessing.Pool(workers, initializer=initialize_worker)
+        try:
+            for label, index, objects, created, seconds, pid in pool.imap_unordered(create_partition, tasks):
+                self.checkpoint[label][index]['done'] = True
+                self.write_checkpoint()
+                worker_stats = stats[pid]
+                worker_stats[0] += 1
+                worker_stats[1] += objects
+                worker_stats[2] += created
+                worker_stats[3] += seconds
+                self.stdout.write('{} partition {}: created {} FieldHistory object(s) for {} objects in {:.1f}s\n'.format(
+                    label, index + 1, created, objects, seconds))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for pid, (partitions, objects, created, seconds) in sorted(stats.items()):
+            self.stdout.write('Worker {}: {} partition(s), {} objects, {} FieldHistory object(s), {:.0f} objects/s\n'.format(
+                pid, partitions, objects, created, objects / seconds if seconds else 0))
+
+    def read_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def write_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        # Replace the file in one step, so an interrupted write doesn't lose it
+        temporary_path = '{}.tmp'.format(self.checkpoint_path)
+        with open(temporary_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.rename(temporary_path, self.checkpoint_path)
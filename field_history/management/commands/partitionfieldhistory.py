@@ -0,0 +1,99 @@
+import datetime
+
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+from field_history.models import FieldHistory
+from field_history.partitions import (
+    AHEAD, CONTENT_TYPE, check_connection, create_content_type_partitions, create_range_partitions,
+    detach_partitions, get_ahead_end, get_partitioned_by, get_partitioning, get_tracked_content_type_ids,
+    partition_table,
+)
+
+
+class Command(BaseCommand):
+
+    help = """Maintains the partitions of the FieldHistory table on PostgreSQL, as set by
+settings.FIELD_HISTORY_PARTITIONING.
+
+Run it once with --convert to turn the FieldHistory table into a partitioned table, then regularly (e.g.
+daily) to create partitions ahead of time: --ahead periods after the current one, or one for each tracked
+model when partitioning by content type. With --detach-older-than-days, range partitions holding only older
+history are detached from the table, and dropped as well with --drop.
+
+Example:
+
+    python manage.py partitionfieldhistory --ahead=3 --detach-older-than-days=365 --drop
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help='Turn the FieldHistory table into a partitioned table, copying its rows. '
+                 'The table is locked until they are copied.')
+
+        parser.add_argument(
+            '--ahead',
+            type=int,
+            default=AHEAD,
+            help='The number of periods after the current one to create partitions for')
+
+        parser.add_argument(
+            '--detach-older-than-days',
+            type=int,
+            help='Detach partitions holding only history older than this many days')
+
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            help='Drop the partitions that are detached')
+
+        parser.add_argument(
+            '--database',
+            default=DEFAULT_DB_ALIAS,
+            help='The database to partition the FieldHistory table of')
+
+    def handle(self, *args, **options):
+        connection = connections[options.get('database')]
+        try:
+            partitioning = get_partitioning()
+            check_connection(connection)
+        except ValueError as e:
+            raise CommandError(e)
+        if options.get('ahead') < 0:
+            raise CommandError('--ahead must not be negative')
+        if options.get('drop') and options.get('detach_older_than_days') is None:
+            raise CommandError('--drop requires --detach-older-than-days')
+        if partitioning == CONTENT_TYPE and options.get('detach_older_than_days') is not None:
+            raise CommandError('Only partitions by date can be detached')
+
+        now = timezone.now()
+        created = self.create_partitions(connection, partitioning, now, options)
+        for name in created:
+            self.stdout.write('Created partition {}\n'.format(name))
+
+        if options.get('detach_older_than_days') is not None:
+            before = now - datetime.timedelta(days=options['detach_older_than_days'])
+            for name in detach_partitions(connection, before, options.get('drop')):
+                self.stdout.write('{} partition {}\n'.format('Dropped' if options.get('drop') else 'Detached', name))
+
+    def create_partitions(self, connection, partitioning, now, options):
+        table = FieldHistory._meta.db_table
+        partitioned_by = get_partitioned_by(connection, table)
+        if partitioning == CONTENT_TYPE:
+            column = FieldHistory._meta.get_field('content_type').column
+        else:
+            column = FieldHistory._meta.get_field('date_created').column
+
+        if partitioned_by is None:
+            if not options.get('convert'):
+                raise CommandError('{} is not partitioned. Run this command with --convert first.'.format(table))
+            self.stdout.write('Partitioning {} by {}\n'.format(table, column))
+            return partition_table(connection, partitioning, now, options['ahead'])
+        if partitioned_by != column:
+            raise CommandError('{} is partitioned by {}, not {}'.format(table, partitioned_by, column))
+        if partitioning == CONTENT_TYPE:
+            return create_content_type_partitions(connection, get_tracked_content_type_ids(connection.alias))
+        return create_range_partitions(connection, partitioning, now, get_ahead_end(now, partitioning, options['ahead']))
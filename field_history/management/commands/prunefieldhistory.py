@@ -0,0 +1,119 @@
+import datetime
+import time
+
+from django.apps import apps
+from django.core.management import BaseCommand, CommandError
+
+from field_history.retention import BATCH_SIZE, RetentionPolicy, get_retention_policies, iter_prune_field_history
+
+
+class Command(BaseCommand):
+
+    help = """Deletes FieldHistory objects expired by retention policies, in batches of objects.
+
+Without policy options, the policies in settings.FIELD_HISTORY_RETENTION are applied (only to the history of
+--model and --field, if given). Otherwise the policy
+given by --max-age-days, --keep-last and --daily-after-days is applied to the history of --model (only of
+--field, if given). The latest FieldHistory of each field of each object is always kept.
+
+Example:
+
+    python manage.py prunefieldhistory --model=myapp.Person --keep-last=100 --daily-after-days=30
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            action='append',
+            dest='models',
+            help='Prune history of this model, in app_label.model_name format (e.g. auth.User). '
+                 'May be given more than once.')
+
+        parser.add_argument(
+            '--field',
+            action='append',
+            dest='fields',
+            help='Only prune history of this field. May be given more than once.')
+
+        parser.add_argument(
+            '--max-age-days',
+            type=int,
+            help='Delete history older than this many days')
+
+        parser.add_argument(
+            '--keep-last',
+            type=int,
+            help='Keep only this many of the latest FieldHistory objects of each field of each object')
+
+        parser.add_argument(
+            '--daily-after-days',
+            type=int,
+            help='Keep only the latest FieldHistory of each day for history older than this many days')
+
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='The number of objects whose history is pruned per transaction')
+
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to wait between batches, to let other queries through')
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+
+        if any(options.get(option) is not None for option in ('max_age_days', 'keep_last', 'daily_after_days')):
+            if not options.get('models'):
+                raise CommandError('--model is required with a retention policy')
+            try:
+                policy = RetentionPolicy(
+                    max_age=self.get_timedelta(options.get('max_age_days')),
+                    keep_last=options.get('keep_last'),
+                    daily_after=self.get_timedelta(options.get('daily_after_days')),
+                )
+            except ValueError as e:
+                raise CommandError(e)
+            policy = dict((field, policy) for field in options.get('fields') or [None])
+            policies = [(apps.get_model(model_name), policy) for model_name in options['models']]
+        else:
+            policies = self.get_settings_policies(options.get('models'), options.get('fields'))
+
+        for model, policy in policies:
+            count = 0
+            for deleted in iter_prune_field_history(model, policy, batch_size):
+                count += deleted
+                self.stdout.write('  {}: {}\n'.format(model._meta.label, count))
+                if options.get('sleep'):
+                    time.sleep(options['sleep'])
+            self.stdout.write('Deleted {} FieldHistory object(s) of {}\n'.format(count, model._meta.label))
+
+    def get_settings_policies(self, model_names, fields):
+        """Returns the policies in settings, of only ``model_names`` and ``fields`` if given"""
+        policies = get_retention_policies()
+        if not policies:
+            raise CommandError('There are no retention policies in settings.FIELD_HISTORY_RETENTION')
+        if model_names:
+            models = [apps.get_model(model_name) for model_name in model_names]
+            for model in models:
+                if model not in policies:
+                    raise CommandError('There is no retention policy for {} in settings.FIELD_HISTORY_RETENTION'
+                                       .format(model._meta.label))
+            policies = dict((model, policies[model]) for model in models)
+        if fields:
+            # The policy of each field, or the model's policy for its other fields
+            policies = dict((model, dict((field, policy[field] if field in policy else policy[None])
+                                         for field in fields if field in policy or None in policy))
+                            for model, policy in policies.items())
+            policies = dict((model, policy) for model, policy in policies.items() if policy)
+            if not policies:
+                raise CommandError('There are no retention policies for these fields in '
+                                   'settings.FIELD_HISTORY_RETENTION')
+        return list(policies.items())
+
+    def get_timedelta(self, days):
+        return None if days is None else datetime.timedelta(days=days)
@@ -1,8 +1,17 @@
+from collections import defaultdict
+import time
+
 from django.apps import apps
-from django.contrib.contenttypes.models import ContentType
 from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+try:
+    from django.utils import six
+except ImportError:
+    import six
 
-from field_history.models import FieldHistory
+from field_history.models import FieldHistory, get_content_type_id
+from field_history.tracker import get_history_model
 
 
 class Command(BaseCommand):
@@ -12,14 +21,23 @@ class Command(BaseCommand):
 Example:
 
     python manage.py renamefieldhistory --model=myapp.User --from_field=username to_field=handle
+
+--model may be given more than once, and --rename renames more fields in the same run:
+
+    python manage.py renamefieldhistory --model=myapp.User --model=myapp.Admin --rename username handle \\
+        --rename email email_address
+
+FieldHistory objects are updated in batches of --batch-size by primary key range, each in its own short
+transaction.
 """
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--model',
+            action='append',
             type=str,
             help='The model class to update in '
-                 'app_label.model_name format (e.g. auth.User)')
+                 'app_label.model_name format (e.g. auth.User). May be given more than once.')
 
         parser.add_argument(
             '--from_field',
@@ -31,22 +49,80 @@ Example:
             type=str,
             help='The new model field name')
 
+        parser.add_argument(
+            '--rename',
+            action='append',
+            nargs=2,
+            dest='renames',
+            metavar=('FROM_FIELD', 'TO_FIELD'),
+            help='An old and new model field name. May be given more than once.')
+
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='The number of FieldHistory objects updated per query')
+
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to wait between batches, to let other queries through')
+
     def handle(self, *args, **options):
-        model_name = options.get('model')
+        model_names = options.get('model')
+        if isinstance(model_names, six.string_types):
+            model_names = [model_names]
         from_field = options.get('from_field')
         to_field = options.get('to_field')
+        renames = list(options.get('renames') or [])
+        batch_size = options.get('batch_size')
 
-        if not model_name:
+        if not model_names:
             raise CommandError('--model_name is a required argument')
-        if not from_field:
-            raise CommandError('--from_field is a required argument')
-        if not to_field:
-            raise CommandError('--to_field is a required argument')
+        if from_field or to_field or not renames:
+            if not from_field:
+                raise CommandError('--from_field is a required argument')
+            if not to_field:
+                raise CommandError('--to_field is a required argument')
+            renames.insert(0, (from_field, to_field))
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        renames = dict(renames)
+
+        # Models with a history table of their own are renamed in it
+        history_models = defaultdict(list)
+        for model_name in model_names:
+            model = apps.get_model(model_name)
+            history_models[get_history_model(model)].append(model)
+        for history_model, models in history_models.items():
+            self.rename_field_history(history_model, models, renames, batch_size, options.get('sleep'))
+
+    def rename_field_history(self, history_model, models, renames, batch_size, sleep):
+        field_histories = history_model._default_manager.filter(field_name__in=list(renames))
+        if history_model is FieldHistory:
+            field_histories = field_histories.filter(
+                content_type_id__in=[get_content_type_id(model) for model in models])
+        total = field_histories.count()
 
-        model = apps.get_model(model_name)
-        content_type = ContentType.objects.get_for_model(model)
-        field_histories = FieldHistory.objects.filter(content_type=content_type, field_name=from_field)
+        self.stdout.write('Updating {} FieldHistory object(s)\n'.format(total))
 
-        self.stdout.write('Updating {} FieldHistory object(s)\n'.format(field_histories.count()))
+        # All fields are renamed at once, so renames may swap names
+        field_name = Case(*[When(field_name=old, then=Value(new)) for old, new in renames.items()],
+                          output_field=CharField())
+        count = 0
+        last_pk = None
+        while True:
+            batch = field_histories.order_by('pk')
+            if last_pk is not None:
+                if sleep:
+                    time.sleep(sleep)
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
 
-        field_histories.update(field_name=to_field)
+            with transaction.atomic():
+                count += field_histories.filter(pk__gte=pks[0], pk__lte=last_pk).update(field_name=field_name)
+            self.stdout.write('Updated {} of {} FieldHistory object(s)\n'.format(count, total))
@@ -1,13 +1,226 @@
-from django.db.models import Manager
-from django.contrib.contenttypes.models import ContentType
+from collections import defaultdict
 
+from django.db import connections
+from django.db.models import F, Manager, Model, Q, QuerySet
+try:
+    from django.db.models import Window
+    from django.db.models.functions import RowNumber
+except ImportError:
+    Window = RowNumber = None  # Django < 2.0
+try:
+    from django.utils import six
+except ImportError:
+    import six
 
-class FieldHistoryManager(Manager):
+from .serialization import deserialize_field_values
+from .utils import chunked
+
+# Orders the history of each object latest first
+LATEST_FIRST = ('-date_created', '-pk')
+
+# Fields identifying the object a FieldHistory belongs to
+OBJECT_FIELDS = ('content_type_id', 'object_id', 'object_id_int', 'object_id_uuid')
+
+# Objects whose history as_of() reads per query
+AS_OF_BATCH_SIZE = 500
+
+# FieldHistory objects decoded at a time by field_values()
+DECODE_BATCH_SIZE = 2000
+
+
+def get_object_key(content_type_id, pk):
+    """Returns a key identifying an object across models and object id fields"""
+    return content_type_id, six.text_type(pk)
+
+
+def latest_field_histories(queryset, limit=1, per_field=False):
+    """
+    Returns the latest ``limit`` FieldHistory objects in ``queryset`` for each
+    object (or for each field of each object, if ``per_field``), using a
+    single query.
+    """
+    partition = queryset.model.object_fields + (('field_name',) if per_field else ())
+    connection = connections[queryset.db]
+
+    if limit == 1 and connection.features.can_distinct_on_fields:
+        return queryset.order_by(*partition + LATEST_FIRST).distinct(*partition)
+
+    if Window is None or not getattr(connection.features, 'supports_over_clause', False):
+        field_histories = defaultdict(list)
+        for field_history in queryset.order_by(*LATEST_FIRST).iterator():
+            latest = field_histories[tuple(getattr(field_history, field) for field in partition)]
+            if len(latest) < limit:
+                latest.append(field_history)
+        return [field_history for latest in field_histories.values() for field_history in latest]
+
+    # Number each object's history latest first and keep the first rows of each
+    queryset = queryset.annotate(field_history_row=Window(
+        expression=RowNumber(),
+        partition_by=[F(field) for field in partition],
+        order_by=[F(field[1:]).desc() for field in LATEST_FIRST],
+    ))
+    sql, params = queryset.query.sql_with_params()
+    return queryset.model._default_manager.db_manager(queryset.db).raw(
+        'SELECT * FROM ({}) field_history WHERE field_history_row <= %s'.format(sql),
+        tuple(params) + (limit,),
+    )
+
+
+class FieldHistoryQuerySet(QuerySet):
+
+    def field_values(self, *fields):
+        """
+        Yields a dict of ``fields`` (as ``values()`` does) for each FieldHistory,
+        with its decoded value under the ``field_value`` key.
+
+        FieldHistory instances aren't created. Rows are decoded in batches,
+        fetching the related objects of foreign keys with one query per
+        related model and batch.
+        """
+        extra_fields = ('serialized_data', 'field_name', 'content_type_id')
+        content_type_id = None
+        if self.model.tracked_model is not None:
+            # The history of a single model has no content type field
+            from .models import get_content_type_id
+
+            extra_fields = extra_fields[:2]
+            content_type_id = get_content_type_id(self.model.tracked_model, self.db)
+        if fields:
+            rows = self.values(*fields + extra_fields)
+            extra_fields = [field for field in extra_fields if field not in fields]
+        else:
+            rows = self.values()
+            extra_fields = []
+        for batch in chunked(rows.iterator(), DECODE_BATCH_SIZE):
+            values = deserialize_field_values(
+                ((row['serialized_data'], row['field_name'], row.get('content_type_id', content_type_id)) for row in batch),
+                self.db, self.model)
+            for row, value in zip(batch, values):
+                for field in extra_fields:
+                    del row[field]
+                row['field_value'] = value
+                yield row
+
+
+class FieldHistoryManager(Manager.from_queryset(FieldHistoryQuerySet)):
 
     def get_for_model(self, object):
-        content_type = ContentType.objects.get_for_model(object)
-        return self.filter(object_id=object.pk,
-                           content_type=content_type)
+        from .models import get_content_type_id, get_object_id_attname
+        from .tracker import get_history_model
+
+        history_model = get_history_model(object.__class__)
+        if history_model is not self.model:
+            # The model's history is in a table of its own
+            return history_model._default_manager.db_manager(self.db).get_for_model(object)
+        return self.filter(content_type_id=get_content_type_id(object.__class__, self.db),
+                           **{get_object_id_attname(object.__class__): object.pk})
 
     def get_for_model_and_field(self, object, field):
         return self.get_for_model(object).filter(field_name=field)
+
+    def get_for_models(self, objects):
+        """Returns the history of all of ``objects``, which may be of different models"""
+        from .models import get_content_type_id, get_object_id_attname
+        from .tracker import get_history_model
+
+        pks = defaultdict(list)
+        for obj in objects:
+            history_model = get_history_model(obj.__class__)
+            if history_model is not self.model:
+                raise ValueError('The history of {} objects is in {}'.format(
+                    obj._meta.label, history_model._meta.label))
+            pks[(get_content_type_id(obj.__class__, self.db), get_object_id_attname(obj.__class__))].append(obj.pk)
+
+        lookups = Q()
+        for (content_type_id, attname), object_pks in pks.items():
+            lookups |= Q(content_type=content_type_id, **{'{}__in'.format(attname): object_pks})
+        return self.filter(lookups) if lookups else self.none()
+
+    def get_for_model_class(self, model):
+        """Returns the history of all ``model`` objects"""
+        from .models import get_content_type_id
+
+        return self.filter(content_type_id=get_content_type_id(model, self.db))
+
+    def get_object_id_attname(self, model):
+        """Returns the field holding the primary keys of ``model`` objects"""
+        from .models import get_object_id_attname
+
+        return get_object_id_attname(model)
+
+    def get_object_key(self, obj):
+        """Returns a key identifying ``obj`` among the objects whose history this manager holds"""
+        from .models import get_content_type_id
+
+        return get_object_key(get_content_type_id(obj.__class__, self.db), obj.pk)
+
+    def get_history_object_key(self, field_history):
+        """Returns the key of the object ``field_history`` belongs to, see get_object_key()"""
+        return get_object_key(field_history.content_type_id, field_history.object_pk)
+
+    def as_of(self, objects, timestamp, fields=None):
+        """
+        Returns the values the tracked fields of ``objects`` had at
+        ``timestamp``, read from the latest FieldHistory of each field
+        created at or before then.
+
+        ``objects`` may be a model instance, for which a dict mapping field
+        names to values is returned, or a queryset or list of instances, for
+        which a dict mapping each instance's primary key to such a dict is
+        returned. Fields without history by ``timestamp`` are left out. Only
+        ``fields`` are read, if given.
+        """
+        if isinstance(objects, Model):
+            return self.as_of([objects], timestamp, fields)[objects.pk]
+
+        from .tracker import get_history_model
+
+        values = {}
+        for batch in chunked(objects, AS_OF_BATCH_SIZE):
+            history_batches = defaultdict(list)
+            for obj in batch:
+                history_batches[get_history_model(obj.__class__)].append(obj)
+            for history_model, objs in history_batches.items():
+                manager = history_model._default_manager.db_manager(self.db)
+                values.update(manager.get_values_as_of(objs, timestamp, fields))
+        return values
+
+    def get_values_as_of(self, objects, timestamp, fields=None):
+        """Returns what ``as_of()`` does for a list of objects whose history this manager holds"""
+        values = {}
+        keys = {}
+        for obj in objects:
+            keys[self.get_object_key(obj)] = values[obj.pk] = {}
+
+        queryset = self.get_for_models(objects).filter(date_created__lte=timestamp)
+        if fields is not None:
+            queryset = queryset.filter(field_name__in=fields)
+        field_histories = list(latest_field_histories(queryset, per_field=True))
+        field_values = deserialize_field_values(
+            [(field_history.serialized_data, field_history.field_name, field_history.content_type_id)
+             for field_history in field_histories], self.db, self.model)
+        for field_history, value in zip(field_histories, field_values):
+            keys[self.get_history_object_key(field_history)][field_history.field_name] = value
+        return values
+
+
+class ModelFieldHistoryManager(FieldHistoryManager):
+    """The manager of the history of a single model, with the API of ``FieldHistory.objects``"""
+
+    def get_for_model(self, object):
+        return self.filter(object=object.pk)
+
+    def get_for_models(self, objects):
+        return self.filter(object__in=[obj.pk for obj in objects])
+
+    def get_for_model_class(self, model):
+        return self.all()
+
+    def get_object_id_attname(self, model):
+        return 'object_id'
+
+    def get_object_key(self, obj):
+        return six.text_type(obj.pk)
+
+    def get_history_object_key(self, field_history):
+        return six.text_type(field_history.object_pk)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from field_history.models import OBJECT_ID_TYPE_SETTING, instantiate_object_id_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('field_history', '0002_auto_20160413_1824'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fieldhistory',
+            index=models.Index(fields=['content_type', 'object_id', 'field_name', 'date_created'],
+                               name='field_history_object_field_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fieldhistory',
+            index=models.Index(fields=['content_type', 'object_id', 'date_created'],
+                               name='field_history_object_idx'),
+        ),
+        # The composite indexes above lead with these columns
+        migrations.AlterField(
+            model_name='fieldhistory',
+            name='object_id',
+            field=instantiate_object_id_field(getattr(settings, OBJECT_ID_TYPE_SETTING, models.TextField), db_index=False),
+        ),
+        migrations.AlterField(
+            model_name='fieldhistory',
+            name='content_type',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType'),
+        ),
+        migrations.AlterField(
+            model_name='fieldhistory',
+            name='field_name',
+            field=models.CharField(max_length=500),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+from field_history.models import OBJECT_ID_TYPE_SETTING, instantiate_object_id_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('field_history', '0003_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fieldhistory',
+            name='object_id_int',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fieldhistory',
+            name='object_id_uuid',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='fieldhistory',
+            name='object_id',
+            field=instantiate_object_id_field(getattr(settings, OBJECT_ID_TYPE_SETTING, models.TextField),
+                                              db_index=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='fieldhistory',
+            index=models.Index(fields=['content_type', 'object_id_int', 'field_name', 'date_created'],
+                               name='field_history_int_field_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fieldhistory',
+            index=models.Index(fields=['content_type', 'object_id_uuid', 'field_name', 'date_created'],
+                               name='field_history_uuid_field_idx'),
+        ),
+    ]
@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
+import sys
+
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.fields import GenericForeignKey
-from django.core import serializers
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.utils import timezone
 
-from .managers import FieldHistoryManager
+from .managers import OBJECT_FIELDS, FieldHistoryManager, ModelFieldHistoryManager
+from .serialization import deserialize_field_value
 
 OBJECT_ID_TYPE_SETTING = 'FIELD_HISTORY_OBJECT_ID_TYPE'
+TYPED_OBJECT_ID_SETTING = 'FIELD_HISTORY_TYPED_OBJECT_ID'
+TABLES_SETTING = 'FIELD_HISTORY_TABLES'
+
+INTEGER_FIELD_TYPES = (
+    'AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField', 'BigIntegerField',
+    'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField',
+)
 
 
-def instantiate_object_id_field(object_id_class_or_tuple=models.TextField):
+def instantiate_object_id_field(object_id_class_or_tuple=models.TextField, db_index=True, null=False):
     """
     Instantiates and returns a model field for FieldHistory.object_id.
 
@@ -28,16 +40,114 @@ def instantiate_object_id_field(object_id_class_or_tuple=models.TextField):
     if not isinstance(object_id_kwargs, dict):
         raise TypeError('settings.%s kwargs must be a dict' % OBJECT_ID_TYPE_SETTING)
 
-    return object_id_class(db_index=True, **object_id_kwargs)
+    return object_id_class(db_index=db_index, null=null, **object_id_kwargs)
+
+
+def get_typed_object_id_attname(model):
+    """
+    Returns the FieldHistory field suited to storing primary keys of
+    ``model``: ``object_id_int`` for integer primary keys, ``object_id_uuid``
+    for UUID primary keys and ``object_id`` for any other type.
+    """
+    pk = model._meta.pk
+    while pk.remote_field is not None:
+        # Child models share the primary key of their parent
+        pk = pk.target_field
+    if isinstance(pk, models.UUIDField):
+        return 'object_id_uuid'
+    if pk.get_internal_type() in INTEGER_FIELD_TYPES:
+        return 'object_id_int'
+    return 'object_id'
+
+
+def get_object_id_attname(model):
+    """
+    Returns the FieldHistory field holding primary keys of ``model``. This is
+    ``object_id`` unless ``settings.FIELD_HISTORY_TYPED_OBJECT_ID`` is set.
+    """
+    if getattr(settings, TYPED_OBJECT_ID_SETTING, False):
+        return get_typed_object_id_attname(model)
+    return 'object_id'
+
+
+# (database alias, concrete model) -> ContentType id, pinned when first used
+_content_type_ids = {}
+
 
+def get_content_type_id(model, using=None):
+    """Returns the id of the ContentType that history of ``model`` objects belongs to"""
+    key = (using, model._meta.concrete_model)
+    try:
+        return _content_type_ids[key]
+    except KeyError:
+        content_type_id = _content_type_ids[key] = ContentType.objects.db_manager(using).get_for_model(model).pk
+        return content_type_id
+
+
+def clear_content_type_ids(**kwargs):
+    # Content types may be recreated with new ids, e.g. when flushing the database
+    _content_type_ids.clear()
+
+
+models.signals.post_migrate.connect(clear_content_type_ids, dispatch_uid='field_history.clear_content_type_ids')
+
+
+class ObjectForeignKey(GenericForeignKey):
+    """A GenericForeignKey whose object id is read from ``FieldHistory.object_pk``"""
+
+    def __init__(self):
+        super(ObjectForeignKey, self).__init__(fk_field='object_pk')
+
+    def _check_object_id_field(self):
+        return []
+
+
+class AbstractFieldHistory(models.Model):
+    """The behavior shared by FieldHistory and the history models of single models"""
+
+    # Fields identifying the object a FieldHistory belongs to
+    object_fields = OBJECT_FIELDS
+    # The model whose objects the history belongs to, if it's only of one
+    tracked_model = None
+
+    class Meta:
+        abstract = True
 
-class FieldHistory(models.Model):
-    object_id = instantiate_object_id_field(getattr(settings, OBJECT_ID_TYPE_SETTING, models.TextField))
-    content_type = models.ForeignKey('contenttypes.ContentType', db_index=True, on_delete=models.CASCADE)
-    object = GenericForeignKey()
-    field_name = models.CharField(max_length=500, db_index=True)
+    def __str__(self):
+        try:
+            obj = self.object
+        except ObjectDoesNotExist:
+            obj = None  # Deleted, which FieldHistory.object also reads as None
+        return u'{} field history for {}'.format(self.field_name, obj)
+
+    @property
+    def field_value(self):
+        # Decoded once for each value of serialized_data
+        try:
+            serialized_data, value = self.__dict__['_field_value']
+        except KeyError:
+            pass
+        else:
+            if serialized_data is self.serialized_data:
+                return value
+        value = deserialize_field_value(self.serialized_data, self.field_name, self.content_type_id,
+                                        using=self._state.db, history_model=self.__class__)
+        self.__dict__['_field_value'] = (self.serialized_data, value)
+        return value
+
+
+class FieldHistory(AbstractFieldHistory):
+    # Looked up through the composite indexes in Meta.indexes. Only one of the
+    # object id fields is set, see get_object_id_attname().
+    object_id = instantiate_object_id_field(getattr(settings, OBJECT_ID_TYPE_SETTING, models.TextField),
+                                            db_index=False, null=True)
+    object_id_int = models.BigIntegerField(blank=True, null=True)
+    object_id_uuid = models.UUIDField(blank=True, null=True)
+    content_type = models.ForeignKey('contenttypes.ContentType', db_index=False, on_delete=models.CASCADE)
+    object = ObjectForeignKey()
+    field_name = models.CharField(max_length=500)
     serialized_data = models.TextField()
-    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+    date_created = models.DateTimeField(default=timezone.now, db_index=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.CASCADE)
 
     objects = FieldHistoryManager()
@@ -45,12 +155,93 @@ class FieldHistory(models.Model):
     class Meta:
         app_label = 'field_history'
         get_latest_by = 'date_created'
+        indexes = [
+            # get_for_model_and_field(), ordered by date
+            models.Index(fields=['content_type', 'object_id', 'field_name', 'date_created'],
+                         name='field_history_object_field_idx'),
+            # get_for_model(), ordered by date
+            models.Index(fields=['content_type', 'object_id', 'date_created'],
+                         name='field_history_object_idx'),
+            models.Index(fields=['content_type', 'object_id_int', 'field_name', 'date_created'],
+                         name='field_history_int_field_idx'),
+            models.Index(fields=['content_type', 'object_id_uuid', 'field_name', 'date_created'],
+                         name='field_history_uuid_field_idx'),
+        ]
+
+    @property
+    def object_pk(self):
+        """The primary key of the object this history belongs to"""
+        for attname in ('object_id_int', 'object_id_uuid', 'object_id'):
+            value = getattr(self, attname)
+            if value is not None:
+                return value
+        return None
+
+    @object_pk.setter
+    def object_pk(self, value):
+        attname = 'object_id'
+        if value is not None:
+            attname = get_object_id_attname(self.content_type.model_class())
+        self.object_id = self.object_id_int = self.object_id_uuid = None
+        setattr(self, attname, value)
 
-    def __str__(self):
-        return u'{} field history for {}'.format(self.field_name, self.object)
+
+class ModelFieldHistory(AbstractFieldHistory):
+    """
+    The history of the objects of a single model, for trackers with a table
+    of their own. See create_history_model().
+    """
+    field_name = models.CharField(max_length=500)
+    serialized_data = models.TextField()
+    date_created = models.DateTimeField(default=timezone.now, db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.CASCADE,
+                             related_name='+')
+
+    objects = ModelFieldHistoryManager()
+
+    object_fields = ('object_id',)
+
+    class Meta:
+        abstract = True
 
     @property
-    def field_value(self):
-        instances = serializers.deserialize('json', self.serialized_data)
-        instance = list(instances)[0].object
-        return getattr(instance, self.field_name)
+    def content_type_id(self):
+        return get_content_type_id(self.tracked_model, self._state.db)
+
+    @property
+    def object_pk(self):
+        return self.object_id
+
+
+def create_history_model(model, db_table=None):
+    """
+    Returns a new model holding the history of ``model`` objects only, with
+    a foreign key to them that has no database constraint. It's named
+    ``<ModelName>FieldHistory``, added to the module of ``model`` and belongs
+    to its app, whose migrations create its table (named ``db_table``, if
+    given).
+    """
+    meta = {
+        'app_label': model._meta.app_label,
+        'get_latest_by': 'date_created',
+        'indexes': [
+            # get_for_model_and_field(), ordered by date
+            models.Index(fields=['object', 'field_name', 'date_created']),
+            # get_for_model(), ordered by date
+            models.Index(fields=['object', 'date_created']),
+        ],
+    }
+    if db_table:
+        meta['db_table'] = db_table
+    name = str('{}FieldHistory'.format(model._meta.object_name))
+    history_model = type(name, (ModelFieldHistory,), {
+        '__module__': model.__module__,
+        'Meta': type(str('Meta'), (), meta),
+        # Like FieldHistory, history outlives its object and doesn't slow down its deletion
+        'object': models.ForeignKey(model, db_index=False, db_constraint=False, on_delete=models.DO_NOTHING,
+                                    related_name='+'),
+        'tracked_model': model,
+    })
+    # Importable like the models defined there
+    setattr(sys.modules[model.__module__], name, history_model)
+    return history_model
@@ -0,0 +1,339 @@
+"""
+Partitioning of the FieldHistory table on PostgreSQL (11 or later).
+
+With ``settings.FIELD_HISTORY_PARTITIONING`` set to ``'day'``, ``'week'``,
+``'month'`` or ``'year'``, the table is range partitioned by
+``date_created``, one partition per period. Set to ``'content_type'``, it's
+list partitioned by ``content_type_id``, one partition per tracked model.
+Either way a default partition holds rows no other partition accepts, and
+its rows are moved when a partition for them is created.
+
+The primary key of a partitioned table must include the partition key, so
+it becomes ``(id, date_created)`` or ``(id, content_type_id)``. Django still
+treats ``id`` alone as the primary key, which stays unique as it's taken
+from the same sequence.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import re
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import FieldHistory, get_content_type_id
+from .tracker import get_model_trackers
+
+PARTITIONING_SETTING = 'FIELD_HISTORY_PARTITIONING'
+
+INTERVALS = ('day', 'week', 'month', 'year')
+CONTENT_TYPE = 'content_type'
+
+# Periods after the current one created ahead of time
+AHEAD = 3
+
+# Partition name suffixes of each period
+NAME_FORMATS = {'day': '%Y%m%d', 'week': '%Y%m%d', 'month': '%Y%m', 'year': '%Y'}
+
+RANGE_BOUND_RE = re.compile(r"FOR VALUES FROM \((.+)\) TO \((.+)\)")
+LIST_BOUND_RE = re.compile(r"FOR VALUES IN \((.+)\)")
+
+
+def get_partitioning(partitioning=None):
+    """
+    Returns how the FieldHistory table is partitioned, ``partitioning`` or
+    else ``settings.FIELD_HISTORY_PARTITIONING``. Raises ``ValueError`` if
+    it's not set or not valid.
+    """
+    partitioning = partitioning or getattr(settings, PARTITIONING_SETTING, None)
+    if not partitioning:
+        raise ValueError('settings.{} must be set to partition field history'.format(PARTITIONING_SETTING))
+    if partitioning not in INTERVALS + (CONTENT_TYPE,):
+        raise ValueError('settings.{} must be one of {}'.format(
+            PARTITIONING_SETTING, ', '.join(repr(value) for value in INTERVALS + (CONTENT_TYPE,))))
+    return partitioning
+
+
+def get_period_start(date, interval):
+    """Returns the start of the ``interval`` ``date`` falls in, in UTC"""
+    if timezone.is_aware(date):
+        date = date.astimezone(timezone.utc)
+    start = datetime.datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+    if interval == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    elif interval == 'month':
+        start = start.replace(day=1)
+    elif interval == 'year':
+        start = start.replace(month=1, day=1)
+    return start
+
+
+def get_next_period_start(start, interval):
+    """Returns the start of the ``interval`` after the one starting at ``start``"""
+    if interval == 'day':
+        return start + datetime.timedelta(days=1)
+    if interval == 'week':
+        return start + datetime.timedelta(days=7)
+    if interval == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start.replace(year=start.year + 1)
+
+
+def get_ahead_end(now, interval, ahead=AHEAD):
+    """Returns the start of the ``ahead``-th ``interval`` after the one ``now`` falls in"""
+    end = get_period_start(now, interval)
+    for i in range(ahead):
+        end = get_next_period_start(end, interval)
+    return end
+
+
+def get_range_partitions(table, interval, start, end):
+    """
+    Returns a list of ``(name, lower, upper)`` of the partitions of
+    ``table`` covering the ``interval`` periods from ``start`` to ``end``.
+    """
+    partitions = []
+    lower = get_period_start(start, interval)
+    while lower <= end:
+        upper = get_next_period_start(lower, interval)
+        partitions.append(('{}_p{}'.format(table, lower.strftime(NAME_FORMATS[interval])), lower, upper))
+        lower = upper
+    return partitions
+
+
+def get_content_type_partition_name(table, content_type_id):
+    return '{}_ct{}'.format(table, content_type_id)
+
+
+def get_default_partition_name(table):
+    return '{}_default'.format(table)
+
+
+def get_tracked_content_type_ids(using=None):
+    """Returns the ids of the content types of the tracked models"""
+    return sorted(set(get_content_type_id(model, using) for model in apps.get_models()
+                      if not model._meta.proxy and get_model_trackers(model)))
+
+
+def check_connection(connection):
+    """Raises ``ValueError`` if ``connection`` doesn't support partitioning FieldHistory"""
+    if connection.vendor != 'postgresql':
+        raise ValueError('Field history can only be partitioned on PostgreSQL')
+    if connection.pg_version < 110000:
+        raise ValueError('Field history can only be partitioned on PostgreSQL 11 or later')
+
+
+def format_timestamp(date):
+    return "'{}'".format(date.isoformat())
+
+
+def get_partitioned_by(connection, table):
+    """Returns the column ``table`` is partitioned by, or ``None`` if it isn't partitioned"""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT a.attname FROM pg_partitioned_table p
+            JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+            WHERE p.partrelid = %s::regclass
+        """, [table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_partitions(connection, table):
+    """
+    Returns a dict mapping the names of the partitions of ``table`` to their
+    bounds: ``(lower, upper)`` datetimes (``None`` if unbounded) of range
+    partitions, a list of values of list partitions and ``None`` for the
+    default partition.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+        """, [table])
+        rows = cursor.fetchall()
+
+    partitions = {}
+    for name, bound in rows:
+        match = RANGE_BOUND_RE.match(bound)
+        if match:
+            partitions[name] = tuple(None if value.endswith('VALUE') else parse_datetime(value.strip("'"))
+                                     for value in match.groups())
+            continue
+        match = LIST_BOUND_RE.match(bound)
+        if match:
+            partitions[name] = [int(value) for value in match.group(1).split(',')]
+        else:
+            partitions[name] = None
+    return partitions
+
+
+def create_partition(connection, table, name, bound, condition, default=None):
+    """
+    Creates partition ``name`` of ``table`` for ``bound`` (the SQL following
+    ``FOR VALUES``), moving the rows matching SQL ``condition`` out of the
+    ``default`` partition first, if given.
+    """
+    quote_name = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+            quote_name(name), quote_name(table)))
+        if default is not None:
+            cursor.execute('WITH moved AS (DELETE FROM {} WHERE {} RETURNING *) '
+                           'INSERT INTO {} SELECT * FROM moved'.format(quote_name(default), condition, quote_name(name)))
+        # Matching indexes are created on the partition as it's attached
+        cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES {}'.format(
+            quote_name(table), quote_name(name), bound))
+
+
+def create_range_partitions(connection, interval, start, end):
+    """
+    Creates the missing partitions of the FieldHistory table for the
+    ``interval`` periods from ``start`` to ``end``. Returns their names.
+    """
+    table = FieldHistory._meta.db_table
+    existing = get_partitions(connection, table)
+    default = next((name for name, bounds in existing.items() if bounds is None), None)
+    ranges = [bounds for bounds in existing.values() if isinstance(bounds, tuple)]
+    created = []
+    for name, lower, upper in get_range_partitions(table, interval, start, end):
+        if name in existing or any((a is None or a < upper) and (b is None or lower < b) for a, b in ranges):
+            continue
+        column = connection.ops.quote_name(FieldHistory._meta.get_field('date_created').column)
+        create_partition(
+            connection, table, name,
+            'FROM ({}) TO ({})'.format(format_timestamp(lower), format_timestamp(upper)),
+            '{0} >= {1} AND {0} < {2}'.format(column, format_timestamp(lower), format_timestamp(upper)),
+            default,
+        )
+        created.append(name)
+    return created
+
+
+def create_content_type_partitions(connection, content_type_ids):
+    """Creates the missing partitions of the FieldHistory table for ``content_type_ids``. Returns their names."""
+    table = FieldHistory._meta.db_table
+    existing = get_partitions(connection, table)
+    default = next((name for name, values in existing.items() if values is None), None)
+    listed = set(value for values in existing.values() if isinstance(values, list) for value in values)
+    created = []
+    for content_type_id in content_type_ids:
+        name = get_content_type_partition_name(table, content_type_id)
+        if name in existing or content_type_id in listed:
+            continue
+        column = connection.ops.quote_name(FieldHistory._meta.get_field('content_type').column)
+        create_partition(
+            connection, table, name,
+            'IN ({:d})'.format(content_type_id),
+            '{} = {:d}'.format(column, content_type_id),
+            default,
+        )
+        created.append(name)
+    return created
+
+
+def detach_partitions(connection, before, drop=False):
+    """
+    Detaches the range partitions of the FieldHistory table holding only
+    history created before ``before``, and drops them if ``drop``. Returns
+    their names.
+    """
+    quote_name = connection.ops.quote_name
+    table = FieldHistory._meta.db_table
+    detached = []
+    for name, bounds in sorted(get_partitions(connection, table).items()):
+        if not isinstance(bounds, tuple) or bounds[1] is None or bounds[1] > before:
+            continue
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(quote_name(table), quote_name(name)))
+            if drop:
+                cursor.execute('DROP TABLE {}'.format(quote_name(name)))
+        detached.append(name)
+    return detached
+
+
+def partition_table(connection, partitioning, now=None, ahead=AHEAD):
+    """
+    Turns the FieldHistory table into a table partitioned as given by
+    ``partitioning``, copying its rows into the partitions they belong to,
+    and returns the names of the partitions created.
+
+    The table is locked while its rows are copied, in a single transaction.
+    Its indexes and foreign keys are recreated on the partitioned table.
+    """
+    quote_name = connection.ops.quote_name
+    table = FieldHistory._meta.db_table
+    legacy = '{}_unpartitioned'.format(table)
+    pk_column = FieldHistory._meta.pk.column
+    if partitioning == CONTENT_TYPE:
+        column = FieldHistory._meta.get_field('content_type').column
+    else:
+        column = FieldHistory._meta.get_field('date_created').column
+    if now is None:
+        now = timezone.now()
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(quote_name(table)))
+        cursor.execute("""
+            SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i
+            WHERE i.indrelid = %s::regclass AND NOT i.indisprimary
+        """, [table])
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = %s::regclass AND contype = 'f'
+        """, [table])
+        foreign_keys = cursor.fetchall()
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk_column])
+        sequence = cursor.fetchone()[0]
+
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(quote_name(table), quote_name(legacy)))
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY) '
+            'PARTITION BY {} ({})'.format(
+                quote_name(table), quote_name(legacy), 'LIST' if partitioning == CONTENT_TYPE else 'RANGE',
+                quote_name(column)))
+        cursor.execute('SELECT attidentity FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s',
+                       [table, pk_column])
+        identity = bool(cursor.fetchone()[0])
+        if not identity and sequence:
+            # A serial column's sequence would be dropped with the old table
+            cursor.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(sequence, quote_name(table), quote_name(pk_column)))
+
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            quote_name(get_default_partition_name(table)), quote_name(table)))
+        if partitioning == CONTENT_TYPE:
+            cursor.execute('SELECT DISTINCT {} FROM {}'.format(quote_name(column), quote_name(legacy)))
+            content_type_ids = set(row[0] for row in cursor.fetchall())
+            content_type_ids.update(get_tracked_content_type_ids(connection.alias))
+            partitions = [(get_content_type_partition_name(table, content_type_id), 'IN ({:d})'.format(content_type_id))
+                          for content_type_id in sorted(content_type_ids)]
+        else:
+            cursor.execute('SELECT MIN({}) FROM {}'.format(quote_name(column), quote_name(legacy)))
+            start = cursor.fetchone()[0] or now
+            partitions = [(name, 'FROM ({}) TO ({})'.format(format_timestamp(lower), format_timestamp(upper)))
+                          for name, lower, upper in get_range_partitions(
+                              table, partitioning, start, get_ahead_end(now, partitioning, ahead))]
+        for name, bound in partitions:
+            cursor.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES {}'.format(
+                quote_name(name), quote_name(table), bound))
+
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(quote_name(table), quote_name(legacy)))
+        if identity:
+            # The copied identity column starts a sequence of its own
+            cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE(MAX({}), 0) + 1, false) FROM {}'.format(
+                quote_name(pk_column), quote_name(table)), [table, pk_column])
+        cursor.execute('DROP TABLE {}'.format(quote_name(legacy)))
+
+        cursor.execute('ALTER TABLE {} ADD PRIMARY KEY ({}, {})'.format(
+            quote_name(table), quote_name(pk_column), quote_name(column)))
+        # Defined on the table's own name, which the partitioned table now has
+        for index in indexes:
+            cursor.execute(index)
+        for name, definition in foreign_keys:
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(quote_name(table), quote_name(name), definition))
+    return [name for name, bound in partitions]
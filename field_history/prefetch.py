@@ -0,0 +1,83 @@
+from .managers import LATEST_FIRST, latest_field_histories
+from .models import FieldHistory
+from .utils import chunked
+
+PREFETCH_CACHE_NAME = '_prefetched_field_history'
+
+# Objects whose history is read per query, keeping lookups within SQLite's limit of 999 parameters
+PREFETCH_BATCH_SIZE = 500
+
+
+def prefetch_field_history(objects, fields=None, limit_per_object=None):
+    """
+    Fetches the field history of ``objects`` (a queryset or list of tracked
+    model instances) with one query per ``PREFETCH_BATCH_SIZE`` objects (and
+    history table, see the ``table`` argument of FieldHistoryTracker) and
+    attaches it to each of them.
+
+    Afterwards the ``field_history`` attribute and the ``get_<field>_history()``
+    methods of those instances return the prefetched history, latest first,
+    without a query. Only history of ``fields`` is fetched (default: all
+    tracked fields). ``limit_per_object`` keeps only the latest that many
+    FieldHistory objects of each instance.
+
+    Returns the instances as a list.
+    """
+    objects = list(objects)
+    if not objects:
+        return objects
+
+    from .tracker import get_history_model
+
+    using = objects[0]._state.db
+    # Models with a history table of their own are fetched from it
+    history_models = [get_history_model(obj.__class__) for obj in objects]
+    managers = dict((history_model, history_model._default_manager.db_manager(using))
+                    for history_model in set(history_models))
+    keys = [(history_model, managers[history_model].get_object_key(obj))
+            for history_model, obj in zip(history_models, objects)]
+    histories = dict((key, []) for key in keys)
+
+    for history_model, manager in managers.items():
+        model_objects = [obj for model, obj in zip(history_models, objects) if model is history_model]
+        for batch in chunked(model_objects, PREFETCH_BATCH_SIZE):
+            queryset = manager.get_for_models(batch)
+            if fields is not None:
+                queryset = queryset.filter(field_name__in=fields)
+            if limit_per_object is not None:
+                queryset = latest_field_histories(queryset, limit_per_object)
+
+            for field_history in queryset:
+                histories[(history_model, manager.get_history_object_key(field_history))].append(field_history)
+
+    for obj, key in zip(objects, keys):
+        object_histories = histories[key]
+        object_histories.sort(key=lambda field_history: (field_history.date_created, field_history.pk), reverse=True)
+        # None when the history of all fields was fetched
+        obj.__dict__[PREFETCH_CACHE_NAME] = (None if fields is None else set(fields), object_histories)
+    return objects
+
+
+def get_prefetched_field_history(instance, field=None):
+    """
+    Returns a queryset holding the prefetched history of ``instance`` (only
+    of ``field`` if given), or ``None`` if it wasn't prefetched.
+    """
+    try:
+        fields, histories = instance.__dict__[PREFETCH_CACHE_NAME]
+    except KeyError:
+        return None
+
+    if field is None:
+        if fields is not None:
+            return None
+        queryset = FieldHistory.objects.get_for_model(instance)
+    elif fields is None or field in fields:
+        queryset = FieldHistory.objects.get_for_model_and_field(instance, field)
+        histories = [field_history for field_history in histories if field_history.field_name == field]
+    else:
+        return None
+    queryset = queryset.order_by(*LATEST_FIRST)
+    queryset._result_cache = histories
+    queryset._prefetch_done = True
+    return queryset
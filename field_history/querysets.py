@@ -0,0 +1,189 @@
+import logging
+import threading
+
+from django.db import connections, models, transaction
+
+from .tracker import get_model_trackers
+from .utils import chunked
+
+# Primary keys per query when reading back values computed by the database
+PK_BATCH_SIZE = 500
+
+# Set while bulk_update() runs, as it writes through update()
+_bulk_update = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+class TrackedQuerySetMixin(object):
+    """
+    Records field history for bulk writes to tracked models.
+
+    ``update()`` and ``bulk_update()`` create the same ``FieldHistory`` objects
+    that saving each changed object would, reading the objects' previous
+    values with one query and creating all of the history with a single
+    ``bulk_create``. ``bulk_create()`` records the initial history of every
+    tracked field, like creating each object would.
+    """
+
+    def bulk_create(self, objs, batch_size=None, **kwargs):
+        trackers = get_model_trackers(self.model)
+        if not trackers or kwargs.get('ignore_conflicts'):
+            # Objects that conflicted weren't created, and there's no telling which
+            return super(TrackedQuerySetMixin, self).bulk_create(objs, batch_size=batch_size, **kwargs)
+
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            max_pk = None
+            needs_pks = not self._can_return_pks() and any(obj.pk is None for obj in objs)
+            if needs_pks:
+                max_pk = self._get_max_pk()
+            objs_without_pk = [obj for obj in objs if obj.pk is None]
+            explicit_pks = [obj.pk for obj in objs if obj.pk is not None]
+            objs = super(TrackedQuerySetMixin, self).bulk_create(objs, batch_size=batch_size, **kwargs)
+            if needs_pks:
+                self._set_created_pks(objs_without_pk, max_pk, explicit_pks)
+
+            for tracker in trackers:
+                tracker.write_field_histories(self._iter_created_field_histories(objs, tracker), using=self.db)
+
+        for tracker in trackers:
+            for obj in objs:
+                tracker._initialize_tracker(obj)
+        return objs
+    bulk_create.alters_data = True
+
+    def update(self, **kwargs):
+        trackers = get_model_trackers(self.model)
+        if getattr(_bulk_update, 'active', False) or \
+                not any(tracker.get_update_fields(kwargs) for tracker in trackers):
+            return super(TrackedQuerySetMixin, self).update(**kwargs)
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = self._get_tracked_objects(trackers)
+            # Only the rows that were read are updated, so rows created or
+            # changed to match meanwhile can't be updated without history
+            rows = 0
+            for pks in chunked([obj.pk for obj in objs], PK_BATCH_SIZE):
+                rows += super(TrackedQuerySetMixin, self.filter(pk__in=pks)).update(**kwargs)
+            self._apply_update(objs, kwargs)
+            self._create_field_histories(objs, kwargs, trackers)
+        return rows
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        trackers = get_model_trackers(self.model)
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            for tracker in trackers:
+                update_fields = tracker.get_update_fields(fields)
+                for obj in objs:
+                    tracker.get_instance_tracker(obj).set_deferred_saved_fields(update_fields)
+            _bulk_update.active = True
+            try:
+                rows = super(TrackedQuerySetMixin, self).bulk_update(objs, fields, batch_size=batch_size)
+            finally:
+                _bulk_update.active = False
+            self._create_field_histories(objs, fields, trackers)
+        return rows
+    bulk_update.alters_data = True
+
+    def _iter_created_field_histories(self, objs, tracker):
+        for obj in objs:
+            if obj.pk is None:
+                continue  # Its primary key couldn't be determined
+            fields = tracker.get_changed_fields(obj, created=True)
+            for field_history in tracker.get_field_histories(obj, fields, created=True):
+                yield field_history
+
+    def _can_return_pks(self):
+        features = connections[self.db].features
+        return getattr(features, 'can_return_rows_from_bulk_insert',
+                       getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+    def _get_max_pk(self):
+        return self.model._base_manager.using(self.db).order_by('-pk').values_list('pk', flat=True).first()
+
+    def _set_created_pks(self, objs, max_pk, explicit_pks=()):
+        """
+        Sets the primary keys of ``objs`` on databases that don't return them
+        from bulk inserts. Auto-incremented keys are assigned in insertion
+        order, so the new rows are the ones after the previous highest key,
+        other than ``explicit_pks`` of the objects created with one.
+
+        If other rows were inserted meanwhile, ``objs`` are left without
+        primary keys and no history is recorded for them.
+        """
+        pks = self.model._base_manager.using(self.db).order_by('pk').values_list('pk', flat=True)
+        if max_pk is not None:
+            pks = pks.filter(pk__gt=max_pk)
+            explicit_pks = [pk for pk in explicit_pks if pk > max_pk]
+        if explicit_pks:
+            pks = pks.exclude(pk__in=explicit_pks)
+        pks = list(pks)
+        if len(pks) != len(objs):
+            logger.warning("Can't determine the primary keys of %d bulk created %s objects, "
+                           "their field history isn't recorded.", len(objs), self.model._meta.object_name)
+            return
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+
+    def _get_tracked_objects(self, trackers):
+        """
+        Reads the primary keys and tracked fields of the objects to update,
+        locking their rows on databases that can.
+        """
+        # Looked up by primary key, as this queryset may return values() or
+        # have deferred fields, and rows can't be locked through outer joins
+        queryset = self.model._base_manager.using(self.db).filter(pk__in=self.values('pk'))
+        fields = set()
+        for tracker in trackers:
+            fields.update(tracker.field_attnames)
+        queryset = queryset.only(*fields)
+        if connections[self.db].features.has_select_for_update:
+            queryset = queryset.select_for_update()
+        return list(queryset)
+
+    def _apply_update(self, objs, values):
+        """Sets the values written by ``update(**values)`` on ``objs``."""
+        expression_fields = []
+        for name, value in values.items():
+            field = self.model._meta.get_field(name)
+            if hasattr(value, 'resolve_expression'):
+                expression_fields.append(field.attname)
+            elif isinstance(value, models.Model):
+                for obj in objs:
+                    setattr(obj, field.name, value)
+            else:
+                for obj in objs:
+                    setattr(obj, field.attname, value)
+
+        if expression_fields:
+            # Expressions are evaluated by the database, so read back their results
+            objs_by_pk = dict((obj.pk, obj) for obj in objs)
+            manager = self.model._base_manager.using(self.db)
+            for pks in chunked(objs_by_pk, PK_BATCH_SIZE):
+                for row in manager.filter(pk__in=pks).values_list('pk', *expression_fields):
+                    obj = objs_by_pk[row[0]]
+                    for attname, value in zip(expression_fields, row[1:]):
+                        setattr(obj, attname, value)
+
+    def _create_field_histories(self, objs, update_fields, trackers):
+        for tracker in trackers:
+            field_histories = []
+            fields = tracker.get_update_fields(update_fields)
+            for obj in objs:
+                changed_fields = tracker.get_changed_fields(obj, fields)
+                if changed_fields:
+                    field_histories.extend(tracker.get_field_histories(obj, changed_fields))
+                    tracker.get_instance_tracker(obj).set_saved_fields(fields=changed_fields)
+            if field_histories:
+                tracker.write_field_histories(field_histories, using=self.db)
+
+
+class TrackedQuerySet(TrackedQuerySetMixin, models.QuerySet):
+    pass
+
+
+class TrackedManager(models.Manager.from_queryset(TrackedQuerySet)):
+    pass
@@ -0,0 +1,157 @@
+from itertools import groupby
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, TextField, Value, When
+from django.utils import timezone
+
+from .deltas import DELTA_PREFIX, encode_keyframe, get_delta_text, parse_header
+from .tracker import get_history_model, get_model_trackers
+from .utils import chunked
+
+RETENTION_SETTING = 'FIELD_HISTORY_RETENTION'
+
+# Objects whose history is pruned per transaction
+BATCH_SIZE = 1000
+
+
+class RetentionPolicy(object):
+    """
+    Decides which FieldHistory objects of a field to delete.
+
+    ``max_age`` (a timedelta) deletes history older than that. ``keep_last``
+    keeps only the latest that many FieldHistory objects. ``daily_after`` (a
+    timedelta) keeps only the latest FieldHistory of each day for history
+    older than that. The latest FieldHistory, which holds the field's
+    current value, is always kept.
+    """
+
+    def __init__(self, max_age=None, keep_last=None, daily_after=None):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be a positive integer')
+        self.max_age = max_age
+        self.keep_last = keep_last
+        self.daily_after = daily_after
+
+    def __repr__(self):
+        return 'RetentionPolicy(max_age={!r}, keep_last={!r}, daily_after={!r})'.format(
+            self.max_age, self.keep_last, self.daily_after)
+
+    def get_expired(self, histories, now):
+        """
+        Returns the primary keys to delete of ``histories``, a list of
+        ``(pk, date_created)`` of the history of one field of one object,
+        latest first.
+        """
+        expired = []
+        days = set()
+        for index, (pk, date_created) in enumerate(histories):
+            if index == 0:
+                days.add(self.get_day(date_created))
+            elif self.keep_last is not None and index >= self.keep_last:
+                expired.append(pk)
+            elif self.max_age is not None and date_created < now - self.max_age:
+                expired.append(pk)
+            elif self.daily_after is not None and date_created < now - self.daily_after:
+                day = self.get_day(date_created)
+                if day in days:
+                    expired.append(pk)
+                days.add(day)
+            else:
+                days.add(self.get_day(date_created))
+        return expired
+
+    def get_day(self, date_created):
+        if timezone.is_aware(date_created):
+            date_created = timezone.localtime(date_created)
+        return date_created.date()
+
+
+def get_retention_policies():
+    """
+    Returns the policies in ``settings.FIELD_HISTORY_RETENTION``, as a dict
+    mapping each model to a dict mapping field names to their policy, where
+    the policy under ``None`` applies to the model's other fields.
+
+    The setting maps ``'app_label.ModelName'`` or
+    ``'app_label.ModelName.field_name'`` to a ``RetentionPolicy`` or a dict
+    of its arguments.
+    """
+    policies = {}
+    for key, policy in getattr(settings, RETENTION_SETTING, {}).items():
+        parts = key.split('.')
+        model = apps.get_model(parts[0], parts[1])
+        if isinstance(policy, dict):
+            policy = RetentionPolicy(**policy)
+        policies.setdefault(model, {})[parts[2] if len(parts) > 2 else None] = policy
+    return policies
+
+
+def iter_prune_field_history(model, policy, batch_size=BATCH_SIZE, now=None, using=None):
+    """
+    Deletes the FieldHistory objects of ``model`` that ``policy`` expires,
+    yielding the number deleted for each batch of ``batch_size`` objects.
+
+    ``policy`` is a ``RetentionPolicy`` for all fields, or a dict mapping
+    field names to their policy, where the policy under ``None`` applies to
+    the other fields. History of fields without a policy is kept.
+
+    Objects are visited in order of their object id, and the history of each
+    batch of them is read and deleted in its own transaction, by primary
+    key. Deltas based on deleted history are rewritten as keyframes.
+    """
+    if isinstance(policy, RetentionPolicy):
+        policy = {None: policy}
+    if now is None:
+        now = timezone.now()
+    manager = get_history_model(model)._default_manager.db_manager(using)
+    attname = manager.get_object_id_attname(model)
+    field_histories = manager.get_for_model_class(model)
+    if None not in policy:
+        field_histories = field_histories.filter(field_name__in=list(policy))
+    has_deltas = any(tracker.delta_fields for tracker in get_model_trackers(model))
+    object_ids = field_histories.filter(**{'{}__isnull'.format(attname): False}) \
+        .order_by(attname).values_list(attname, flat=True).distinct()
+
+    last_object_id = None
+    while True:
+        batch = object_ids
+        if last_object_id is not None:
+            batch = batch.filter(**{'{}__gt'.format(attname): last_object_id})
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        last_object_id = batch[-1]
+
+        with transaction.atomic(using=manager.db):
+            histories = field_histories.filter(**{'{}__in'.format(attname): batch})
+            expired = []
+            rows = histories.order_by(attname, 'field_name', '-date_created', '-pk') \
+                .values_list(attname, 'field_name', 'pk', 'date_created')
+            for (object_id, field_name), group in groupby(rows, key=lambda row: row[:2]):
+                field_policy = policy.get(field_name, policy.get(None))
+                if field_policy is not None:
+                    expired.extend(field_policy.get_expired([row[2:] for row in group], now))
+            if expired and has_deltas:
+                rebase_deltas(histories, set(expired), manager.db)
+            for pks in chunked(expired, batch_size):
+                manager.filter(pk__in=pks).delete()
+        yield len(expired)
+
+
+def prune_field_history(model, policy, batch_size=BATCH_SIZE, now=None, using=None):
+    """Deletes the FieldHistory objects of ``model`` that ``policy`` expires and returns how many"""
+    return sum(iter_prune_field_history(model, policy, batch_size, now, using))
+
+
+def rebase_deltas(histories, expired, using=None):
+    """Rewrites deltas of ``histories`` based on ``expired`` FieldHistory objects as keyframes"""
+    rows = dict(histories.filter(serialized_data__startswith=DELTA_PREFIX).values_list('pk', 'serialized_data'))
+    whens = {}
+    for pk, serialized_data in list(rows.items()):
+        if pk not in expired and expired.intersection(parse_header(serialized_data)[1]):
+            text = get_delta_text(serialized_data, using, rows, histories.model)
+            whens[pk] = When(pk=pk, then=Value(encode_keyframe(text)))
+    if whens:
+        histories.filter(pk__in=list(whens)).update(serialized_data=Case(*whens.values(), output_field=TextField()))
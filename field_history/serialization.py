@@ -0,0 +1,371 @@
+from __future__ import unicode_literals
+
+import json
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder, Serializer as JsonSerializer
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.query_utils import DeferredAttribute
+from django.utils.encoding import is_protected_type
+
+from .deltas import get_delta_text, is_delta
+from .json_nested_serializer import Serializer as NestedJsonSerializer
+
+FIELD = 'field'
+FOREIGN_KEY = 'foreign_key'
+MANY_TO_MANY = 'many_to_many'
+
+STORAGE_FORMAT_SETTING = 'FIELD_HISTORY_STORAGE_FORMAT'
+# A serializer document holding the model, primary key and field
+DOCUMENT = 'document'
+# Only the field's value, encoded as JSON and prefixed with COMPACT_PREFIX
+COMPACT = 'compact'
+STORAGE_FORMATS = (DOCUMENT, COMPACT)
+
+COMPACT_PREFIX = '='
+
+compact_encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+# Set by get_json_encoder()
+_json_encoder = None
+
+
+def get_json_encoder():
+    """
+    Returns an encoder writing JSON like Django's ``json`` serializer, which
+    escapes non-ASCII characters in some Django versions and not in others.
+    """
+    global _json_encoder
+    if _json_encoder is None:
+        document = serializers.serialize('json', [ContentType(app_label='\xe9')], fields=['app_label'])
+        _json_encoder = DjangoJSONEncoder(ensure_ascii='\xe9' not in document)
+    return _json_encoder
+
+
+def get_serializer_name():
+    return getattr(settings, 'FIELD_HISTORY_SERIALIZER_NAME', 'json')
+
+
+def get_storage_format():
+    storage_format = getattr(settings, STORAGE_FORMAT_SETTING, DOCUMENT)
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError('settings.{} must be one of {}'.format(STORAGE_FORMAT_SETTING, ', '.join(STORAGE_FORMATS)))
+    return storage_format
+
+
+def is_compact(serialized_data):
+    return serialized_data.startswith(COMPACT_PREFIX)
+
+
+def encode_compact_value(value):
+    """Returns the compact serialized data of ``value``, a serializer's value of a field"""
+    return COMPACT_PREFIX + compact_encoder.encode(value)
+
+
+def decode_compact_value(serialized_data):
+    return json.loads(serialized_data[len(COMPACT_PREFIX):])
+
+
+def serialize_fields(instance, fields):
+    """
+    Returns a dict mapping each of ``fields`` to its serialized data.
+
+    ``instance`` is serialized once for all of the fields and the result is
+    split into one document per field, each identical to the output of
+    ``serializers.serialize(name, [instance], fields=[field])``.
+    """
+    serializer_name = get_serializer_name()
+    serializer = serializers.get_serializer(serializer_name)()
+    if not isinstance(serializer, JsonSerializer):
+        # Only JSON documents can be split apart, serialize other formats per field
+        return dict((field, serializers.serialize(serializer_name, [instance], fields=[field]))
+                    for field in fields)
+
+    data = json.loads(serializer.serialize([instance], fields=list(fields)))[0]
+    field_data = data.pop('fields')
+    serialized = {}
+    for field in fields:
+        data['fields'] = {field: field_data[field]} if field in field_data else {}
+        serialized[field] = json.dumps([data], **serializer.json_kwargs)
+    return serialized
+
+
+def _value_from_field(obj, field):
+    # Mirrors django.core.serializers.python.Serializer._value_from_field
+    value = field.value_from_object(obj)
+    return value if is_protected_type(value) else field.value_to_string(obj)
+
+
+class SerializationPlan(object):
+    """
+    Serializes the tracked fields of a concrete model.
+
+    The model fields behind each tracked field name are looked up once when
+    the plan is built. For the ``json`` and ``json_nested`` serializers the
+    plan then encodes values directly, producing the same documents as
+    ``serialize_fields`` without a serializer registry lookup or a scan of
+    the model's metadata on every save. Any other serializer falls back to
+    ``serialize_fields``.
+
+    With the ``compact`` storage format, fields other than many-to-many
+    fields are stored as their bare value instead of a document.
+    """
+    def __init__(self, model, fields):
+        opts = model._meta.concrete_model._meta
+        local_fields = set(opts.local_fields) | set(opts.local_many_to_many)
+
+        # field name -> (model field, kind, whether the field is local)
+        self.steps = {}
+        for field in opts.fields:
+            if not field.serialize:
+                continue
+            if field.remote_field is None:
+                name, kind = field.attname, FIELD
+            else:
+                name, kind = field.attname[:-3], FOREIGN_KEY
+            if name in fields:
+                self.steps[name] = (field, kind, field in local_fields)
+        for field in opts.many_to_many:
+            if field.serialize and field.attname in fields:
+                self.steps[field.attname] = (field, MANY_TO_MANY, field in local_fields)
+
+        self.serializer_name = None
+        self.include_parents = None
+
+    def resolve_serializer(self, serializer_name):
+        serializer_class = serializers.get_serializer(serializer_name)
+        if serializer_class is NestedJsonSerializer:
+            self.include_parents = True
+        elif serializer_class is JsonSerializer:
+            self.include_parents = False
+        else:
+            self.include_parents = None
+        self.serializer_name = serializer_name
+
+    def serialize(self, instance, fields):
+        """Returns a dict mapping each of ``fields`` to its serialized data."""
+        if get_storage_format() == COMPACT:
+            return self.serialize_compact(instance, fields)
+        return self.serialize_documents(instance, fields)
+
+    def serialize_compact(self, instance, fields):
+        serialized = {}
+        documents = []
+        for name in fields:
+            step = self.steps.get(name)
+            if step is None or step[1] == MANY_TO_MANY:
+                documents.append(name)
+            else:
+                serialized[name] = encode_compact_value(_value_from_field(instance, step[0]))
+        if documents:
+            serialized.update(self.serialize_documents(instance, documents))
+        return serialized
+
+    def serialize_documents(self, instance, fields):
+        serializer_name = get_serializer_name()
+        if serializer_name != self.serializer_name:
+            self.resolve_serializer(serializer_name)
+        if self.include_parents is None:
+            return serialize_fields(instance, fields)
+
+        data = {
+            'model': instance._meta.label_lower,
+            'pk': _value_from_field(instance, instance._meta.pk),
+        }
+        encoder = get_json_encoder()
+        serialized = {}
+        for name in fields:
+            field_data = {}
+            try:
+                field, kind, is_local = self.steps[name]
+            except KeyError:
+                pass
+            else:
+                if is_local or self.include_parents:
+                    if kind == MANY_TO_MANY:
+                        if field.remote_field.through._meta.auto_created:
+                            field_data[name] = [
+                                _value_from_field(related, related._meta.pk)
+                                for related in getattr(instance, name).iterator()
+                            ]
+                    else:
+                        field_data[name] = _value_from_field(instance, field)
+            data['fields'] = field_data
+            serialized[name] = encoder.encode([data])
+        return serialized
+
+
+class FieldDecoder(object):
+    """
+    Converts the serialized value of a model field back to the value of the
+    model attribute it was read from, as deserializing the document and
+    reading that attribute from the unsaved instance would.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.related_model = None
+        if field.remote_field is not None:
+            self.related_model = field.remote_field.model
+            self.to_field = field.remote_field.field_name
+            self.to_python = field.target_field.to_python
+        else:
+            self.to_python = field.to_python
+
+    @classmethod
+    def for_field(cls, model, field_name):
+        """
+        Returns a decoder for ``field_name`` of ``model``, or ``None`` for fields
+        (e.g. file fields) whose attribute isn't simply their value.
+        """
+        field = model._meta.get_field(field_name)
+        if not field.concrete or field.many_to_many:
+            return None
+        descriptor = getattr(model, field.name, None)
+        if field.remote_field is not None:
+            if type(descriptor) is not ForwardManyToOneDescriptor:
+                return None
+        elif type(descriptor) is not DeferredAttribute:
+            return None
+        return cls(field)
+
+    def get_value(self, field_data):
+        """
+        Returns the value of the field in ``field_data``, the ``fields`` of a
+        serialized object. For foreign keys, this is the related object's key.
+        """
+        if self.field.name in field_data:
+            return self.to_python(field_data[self.field.name])
+        # Unserialized fields (e.g. of parent models) keep their default
+        return self.field.get_default()
+
+    def decode(self, field_data):
+        """Returns the attribute value of the field in ``field_data``"""
+        return self.get_attribute_value(self.get_value(field_data))
+
+    def get_attribute_value(self, value):
+        if self.related_model is None or value is None:
+            return value
+        return self.get_related_objects([value])[value]
+
+    def get_related_objects(self, values):
+        """Returns a dict mapping each of ``values`` to the related object it refers to"""
+        related_objects = dict(
+            (getattr(obj, self.field.target_field.attname), obj)
+            for obj in self.related_model._base_manager.filter(**{'{}__in'.format(self.to_field): values})
+        )
+        for value in values:
+            if value not in related_objects:
+                raise self.related_model.DoesNotExist(
+                    '{} matching query does not exist.'.format(self.related_model._meta.object_name))
+        return related_objects
+
+
+# (model label, field name) -> FieldDecoder, or None if the field can't be decoded directly
+_field_decoders = {}
+
+
+def get_field_decoder(model_label, field_name):
+    key = (model_label, field_name)
+    try:
+        return _field_decoders[key]
+    except KeyError:
+        decoder = _field_decoders[key] = FieldDecoder.for_field(apps.get_model(model_label), field_name)
+        return decoder
+
+
+def get_model(content_type_id):
+    return ContentType.objects.get_for_id(content_type_id).model_class()
+
+
+def deserialize_field_value(serialized_data, field_name, content_type_id=None, using=None, history_model=None):
+    """
+    Returns the value of ``field_name`` held by ``serialized_data``.
+
+    Compact values and JSON documents are decoded directly, without
+    building a model instance. Decoding a compact value or a delta requires
+    the ``content_type_id`` of the model it belongs to, and deltas are
+    rebuilt from the rows they're based on, read from ``history_model``
+    (default: FieldHistory) in the ``using`` database. Other documents are
+    deserialized by the serializer named by
+    ``settings.FIELD_HISTORY_SERIALIZER_NAME``.
+    """
+    if is_delta(serialized_data):
+        serialized_data = COMPACT_PREFIX + get_delta_text(serialized_data, using, history_model=history_model)
+
+    if is_compact(serialized_data):
+        model = get_model(content_type_id)
+        value = decode_compact_value(serialized_data)
+        decoder = get_field_decoder(model._meta.label_lower, field_name)
+        if decoder is None:
+            return _build_field_value(model, field_name, value)
+        return decoder.get_attribute_value(decoder.to_python(value))
+
+    if not serialized_data.startswith('['):
+        return _deserialize_field_value(get_serializer_name(), serialized_data, field_name)
+
+    data = json.loads(serialized_data)[0]
+    decoder = get_field_decoder(data['model'], field_name)
+    if decoder is None:
+        return _deserialize_field_value('json', serialized_data, field_name)
+    return decoder.decode(data['fields'])
+
+
+def _deserialize_field_value(serializer_name, serialized_data, field_name):
+    instance = list(serializers.deserialize(serializer_name, serialized_data))[0].object
+    return getattr(instance, field_name)
+
+
+def _build_field_value(model, field_name, value):
+    field = model._meta.get_field(field_name)
+    instance = model(**{field.attname: field.to_python(value)})
+    return getattr(instance, field_name)
+
+
+def deserialize_field_values(rows, using=None, history_model=None):
+    """
+    Yields the value held by each ``(serialized_data, field_name,
+    content_type_id)`` tuple of ``rows``, as ``deserialize_field_value()``
+    does.
+
+    Related objects of foreign keys are fetched with one query per related
+    model, rather than one per value, and rows that deltas are based on are
+    fetched once.
+    """
+    decoded = []
+    related_values = {}
+    delta_rows = {}
+    for serialized_data, field_name, content_type_id in rows:
+        if is_delta(serialized_data):
+            serialized_data = COMPACT_PREFIX + get_delta_text(serialized_data, using, delta_rows, history_model)
+        if is_compact(serialized_data):
+            model = get_model(content_type_id)
+            decoder = get_field_decoder(model._meta.label_lower, field_name)
+            if decoder is None:
+                decoded.append((None, _build_field_value(model, field_name, decode_compact_value(serialized_data))))
+                continue
+            value = decoder.to_python(decode_compact_value(serialized_data))
+        elif serialized_data.startswith('['):
+            data = json.loads(serialized_data)[0]
+            decoder = get_field_decoder(data['model'], field_name)
+            if decoder is None:
+                decoded.append((None, _deserialize_field_value('json', serialized_data, field_name)))
+                continue
+            value = decoder.get_value(data['fields'])
+        else:
+            decoded.append((None, _deserialize_field_value(get_serializer_name(), serialized_data, field_name)))
+            continue
+
+        if decoder.related_model is None or value is None:
+            decoded.append((None, value))
+        else:
+            decoded.append((decoder, value))
+            related_values.setdefault(decoder, set()).add(value)
+
+    related_objects = dict((decoder, decoder.get_related_objects(list(values)))
+                           for decoder, values in related_values.items())
+    for decoder, value in decoded:
+        yield value if decoder is None else related_objects[decoder][value]
@@ -1,17 +1,83 @@
 from __future__ import unicode_literals
 
 from copy import deepcopy
+import datetime
+from decimal import Decimal
 import threading
+import uuid
 
-from django.core import serializers
 from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
 from django.db import models
-
-from .models import FieldHistory
-
-
-def get_serializer_name():
-    return getattr(settings, 'FIELD_HISTORY_SERIALIZER_NAME', 'json')
+from django.db.models.functions import Substr
+from django.utils import timezone
+try:
+    from django.utils import six
+except ImportError:
+    import six
+
+from .deltas import (
+    KEYFRAME_INTERVAL, encode_delta, encode_keyframe, get_header_length, is_delta, parse_header, value_hash,
+)
+from .managers import LATEST_FIRST
+from .models import TABLES_SETTING, FieldHistory, create_history_model, get_content_type_id, get_object_id_attname
+from .prefetch import PREFETCH_CACHE_NAME, get_prefetched_field_history
+from .serialization import (  # noqa: F401
+    FIELD, SerializationPlan, _value_from_field, compact_encoder, get_serializer_name, serialize_fields,
+)
+from .writers import get_writer
+
+
+IMMUTABLE_TYPES = frozenset(
+    six.integer_types + six.string_types + (
+        type(None), bool, float, complex, six.text_type, six.binary_type, Decimal,
+        datetime.date, datetime.datetime, datetime.time, datetime.timedelta, uuid.UUID,
+    )
+)
+
+
+def snapshot_value(value):
+    """
+    Returns a copy of ``value`` that is safe from later in-place changes.
+
+    Immutable values are returned as they are. Lists, dicts, sets and tuples
+    are copied container by container, sharing their immutable items with
+    the original (and tuples or frozensets holding only immutable items are
+    shared entirely). Anything else is deep-copied.
+    """
+    value_type = type(value)
+    if value_type in IMMUTABLE_TYPES:
+        return value
+    if value_type is dict:
+        return {key: snapshot_value(item) for key, item in value.items()}
+    if value_type is list:
+        return [snapshot_value(item) for item in value]
+    if value_type in (tuple, frozenset, set):
+        items = [snapshot_value(item) for item in value]
+        if value_type is not set and all(a is b for a, b in zip(items, value)):
+            return value
+        return value_type(items)
+    return deepcopy(value)
+
+
+# Stands for the value of a deferred field in the values recorded at post_init
+DEFERRED = object()
+
+
+# Model class -> FieldHistoryTrackers whose signals are connected for it
+_model_trackers = {}
+
+
+def get_model_trackers(model):
+    """Returns the FieldHistoryTrackers that record history for ``model``"""
+    return _model_trackers.get(model, [])
+
+
+def get_history_model(model):
+    """Returns the model holding the history of ``model`` objects"""
+    for tracker in get_model_trackers(model):
+        return tracker.history_model
+    return FieldHistory
 
 
 def curry(*args, **kwargs):
@@ -25,33 +91,80 @@ def curry(*args, **kwargs):
         return curry(*args, **kwargs)
 
 
+class SavedValue(object):
+    """Holds the saved value of a field in its attribute, to serialize it like the instance's"""
+
+    def __init__(self, attname, value):
+        setattr(self, attname, value)
+
+
 class FieldInstanceTracker(object):
-    def __init__(self, instance, fields):
+    def __init__(self, instance, fields, attnames=None):
         self.instance = instance
         self.fields = fields
+        # Tracked model fields -> attribute holding their value (e.g. pet -> pet_id)
+        self.attnames = attnames or {}
 
     def get_field_value(self, field):
-        return getattr(self.instance, field)
+        return getattr(self.instance, self.attnames.get(field, field))
+
+    def is_deferred(self, field):
+        """Returns ``True`` if the value of a tracked model field hasn't been loaded"""
+        return field in self.attnames and self.attnames[field] not in self.instance.__dict__
 
     def set_saved_fields(self, fields=None):
         if not self.instance.pk:
             self.saved_data = {}
+            self.deferred_fields = set()
         elif not fields:
-            self.saved_data = self.current()
-
-        # preventing mutable fields side effects
-        for field, field_value in self.saved_data.items():
-            self.saved_data[field] = deepcopy(field_value)
+            # Deferred fields are left out so reading them doesn't cost a query
+            self.deferred_fields = set(field for field in self.fields if self.is_deferred(field))
+            # preventing mutable fields side effects
+            self.saved_data = {field: snapshot_value(field_value)
+                               for field, field_value in self.current().items()}
+        else:
+            for field in fields:
+                if self.is_deferred(field):
+                    self.deferred_fields.add(field)
+                    self.saved_data.pop(field, None)
+                else:
+                    self.deferred_fields.discard(field)
+                    self.saved_data[field] = snapshot_value(self.get_field_value(field))
+
+    def set_loaded_fields(self, values):
+        """Sets the saved values of fields to the values the instance was loaded with"""
+        self.deferred_fields = set(field for field, value in values.items() if value is DEFERRED)
+        self.saved_data = {field: value for field, value in values.items() if value is not DEFERRED}
+
+    def set_deferred_saved_fields(self, fields=None):
+        """
+        Loads the saved values of fields that were deferred when the instance
+        was loaded but have been set or loaded since, using a single query.
+        """
+        if fields is None:
+            fields = self.deferred_fields
+        fields = [field for field in fields if field in self.deferred_fields and not self.is_deferred(field)]
+        if not fields:
+            return
+        instance = self.instance
+        values = instance.__class__._base_manager.using(instance._state.db).filter(
+            pk=instance.pk).values(*[self.attnames[field] for field in fields]).first() or {}
+        for field in fields:
+            self.saved_data[field] = values.get(self.attnames[field])
+            self.deferred_fields.discard(field)
 
     def current(self, fields=None):
-        """Returns dict of current values for all tracked fields"""
+        """Returns dict of current values for all tracked fields that aren't deferred"""
         if fields is None:
             fields = self.fields
 
-        return dict((f, self.get_field_value(f)) for f in fields)
+        return dict((f, self.get_field_value(f)) for f in fields if not self.is_deferred(f))
 
     def has_changed(self, field):
         """Returns ``True`` if field has changed from currently saved value"""
+        if field in self.deferred_fields:
+            # Still unloaded (or its saved value was never fetched), so unchanged
+            return False
         return self.previous(field) != self.get_field_value(field)
 
     def previous(self, field):
@@ -64,10 +177,19 @@ class FieldHistoryTracker(object):
     tracker_class = FieldInstanceTracker
     thread = threading.local()
 
-    def __init__(self, fields):
+    def __init__(self, fields, writer=None, delta_fields=None, keyframe_interval=KEYFRAME_INTERVAL, table=None):
         if not fields:
             raise ValueError("Can't track zero fields")
         self.fields = set(fields)
+        self.writer = writer
+        self.delta_fields = set(delta_fields or ())
+        if not self.delta_fields <= self.fields:
+            raise ValueError("Only tracked fields can be stored as deltas")
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be a positive integer")
+        self.keyframe_interval = keyframe_interval
+        # True or a table name to keep the model's history in a table of its own
+        self.table = table
 
     def contribute_to_class(self, cls, name):
         setattr(cls, '_get_field_history', _get_field_history)
@@ -76,58 +198,195 @@ class FieldHistoryTracker(object):
                     curry(cls._get_field_history, field=field))
         self.name = name
         self.attname = '_%s' % name
+        self.loaded_attname = '_%s_loaded' % name
+        # Set early so parent trackers can tell this model has its own tracker
+        setattr(cls, name, self)
         models.signals.class_prepared.connect(self.finalize_class, sender=cls)
 
     def finalize_class(self, sender, **kwargs):
-        self.fields = self.fields
-        models.signals.post_init.connect(self.initialize_tracker)
         self.model_class = sender
-        setattr(sender, self.name, self)
+        table = self.table
+        if table is None:
+            table = getattr(settings, TABLES_SETTING, {}).get(sender._meta.label)
+        if table:
+            self.history_model = create_history_model(sender, None if table is True else table)
+        else:
+            self.history_model = FieldHistory
+        self.field_attnames = {}
+        for field_name in self.fields:
+            try:
+                field = sender._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                continue
+            if field.concrete and not field.many_to_many:
+                self.field_attnames[field_name] = field.attname
+        # Tracked fields in the order of the values recorded at post_init: model
+        # fields, read from their attribute, then any other fields
+        self.loaded_attnames = tuple(self.field_attnames.values())
+        self.loaded_properties = tuple(self.fields.difference(self.field_attnames))
+        self.loaded_fields = tuple(self.field_attnames) + self.loaded_properties
+        # Names and attnames that may be passed to save(update_fields=...)
+        self.update_field_names = dict((field, field) for field in self.fields)
+        self.update_field_names.update((attname, field) for field, attname in self.field_attnames.items())
+        self.serialization_plans = {sender._meta.concrete_model: SerializationPlan(sender, self.fields)}
+        self.connect_signals(sender)
+        models.signals.class_prepared.connect(self.finalize_subclass)
+
+    def finalize_subclass(self, sender, **kwargs):
+        # Child and proxy models without a tracker of their own use this one
+        if issubclass(sender, self.model_class) and getattr(sender, self.name, None) is self:
+            self.connect_signals(sender)
+
+    def connect_signals(self, model):
+        _model_trackers.setdefault(model, []).append(self)
+        models.signals.post_init.connect(self.initialize_tracker, sender=model)
+        models.signals.pre_save.connect(self.pre_save, sender=model)
+        models.signals.post_save.connect(self.post_save, sender=model)
 
     def initialize_tracker(self, sender, instance, **kwargs):
-        if not isinstance(instance, self.model_class):
-            return  # Only init instances of given model (including children)
-        self._initialize_tracker(instance)
-        self.patch_save(instance)
+        # Only the loaded values are recorded, the tracker is created from them
+        # when it's first needed. Unsaved objects have nothing to compare against.
+        if instance.pk is None:
+            return
+        values = instance.__dict__
+        loaded = [values.get(attname, DEFERRED) for attname in self.loaded_attnames]
+        if self.loaded_properties:
+            loaded.extend(getattr(instance, field) for field in self.loaded_properties)
+        for value in loaded:
+            if type(value) not in IMMUTABLE_TYPES and value is not DEFERRED:
+                # preventing mutable fields side effects
+                loaded = [item if item is DEFERRED else snapshot_value(item) for item in loaded]
+                break
+        values[self.loaded_attname] = loaded
 
     def _initialize_tracker(self, instance):
-        tracker = self.tracker_class(instance, self.fields)
+        tracker = self.tracker_class(instance, self.fields, self.field_attnames)
         setattr(instance, self.attname, tracker)
-        tracker.set_saved_fields()
-
-    def patch_save(self, instance):
-        original_save = instance.save
-
-        def save(**kwargs):
-            is_new_object = instance.pk is None
-            ret = original_save(**kwargs)
-            tracker = getattr(instance, self.attname)
-            field_histories = []
-
-            # Create a FieldHistory for all self.fields that have changed
-            for field in self.fields:
-                if tracker.has_changed(field) or is_new_object:
-                    data = serializers.serialize(get_serializer_name(),
-                                                 [instance],
-                                                 fields=[field])
-                    user = self.get_field_history_user(instance)
-                    history = FieldHistory(
-                        object=instance,
-                        field_name=field,
-                        serialized_data=data,
-                        user=user,
-                    )
-                    field_histories.append(history)
-
-            if field_histories:
-                # Create all the FieldHistory objects in one batch
-                FieldHistory.objects.bulk_create(field_histories)
-
-            # Update tracker in case this model is saved again
+        loaded_values = instance.__dict__.pop(self.loaded_attname, None)
+        if loaded_values is None:
+            tracker.set_saved_fields()
+        else:
+            tracker.set_loaded_fields(dict(zip(self.loaded_fields, loaded_values)))
+        return tracker
+
+    def get_instance_tracker(self, instance):
+        try:
+            return instance.__dict__[self.attname]
+        except KeyError:
+            return self._initialize_tracker(instance)
+
+    def get_update_fields(self, update_fields):
+        """Returns the tracked fields saved by ``save(update_fields=update_fields)``"""
+        if update_fields is None:
+            return self.fields
+        return set(self.update_field_names[name] for name in update_fields
+                   if name in self.update_field_names)
+
+    def pre_save(self, sender, instance, raw=False, update_fields=None, **kwargs):
+        if raw or (self.attname not in instance.__dict__ and self.loaded_attname not in instance.__dict__):
+            return
+        self.get_instance_tracker(instance).set_deferred_saved_fields(self.get_update_fields(update_fields))
+
+    def post_save(self, sender, instance, created, raw=False, update_fields=None, **kwargs):
+        if raw:
+            return  # Fixtures are loaded as-is, like the rows they describe
+        tracker = self.get_instance_tracker(instance)
+
+        # Create a FieldHistory for all saved fields that have changed
+        changed_fields = self.get_changed_fields(instance, self.get_update_fields(update_fields), created)
+        if changed_fields:
+            # Create all the FieldHistory objects in one batch
+            self.write_field_histories(self.get_field_histories(instance, changed_fields, created),
+                                       using=instance._state.db)
+            # Prefetched history no longer includes the latest values
+            instance.__dict__.pop(PREFETCH_CACHE_NAME, None)
+
+        # Update tracker in case this model is saved again
+        if created:
             self._initialize_tracker(instance)
+        elif changed_fields:
+            tracker.set_saved_fields(fields=changed_fields)
 
-            return ret
-        instance.save = save
+    def get_changed_fields(self, instance, fields=None, created=False):
+        """Returns which of ``fields`` (default: all tracked fields) changed since ``instance`` was saved"""
+        if fields is None:
+            fields = self.fields
+        if created:
+            return list(fields)
+        tracker = self.get_instance_tracker(instance)
+        return [field for field in fields if tracker.has_changed(field)]
+
+    def get_field_histories(self, instance, fields, created=False):
+        """Returns unsaved FieldHistory objects holding the current values of ``fields``"""
+        plan = self.get_serialization_plan(instance)
+        delta_fields = [field for field in fields
+                        if field in self.delta_fields and field in plan.steps and plan.steps[field][1] == FIELD]
+        serialized_data = plan.serialize(instance, [field for field in fields if field not in delta_fields])
+        for field in delta_fields:
+            serialized_data[field] = self.serialize_delta(instance, field, plan.steps[field][0], created)
+        user = self.get_field_history_user(instance)
+        # Stamped now rather than when the rows are written, which a writer may delay
+        date_created = timezone.now()
+        if self.history_model is FieldHistory:
+            # Set by id, skipping the lookups of FieldHistory.object for every row
+            object_fields = {
+                'content_type_id': get_content_type_id(instance.__class__, instance._state.db),
+                get_object_id_attname(instance.__class__): instance.pk,
+            }
+        else:
+            object_fields = {'object_id': instance.pk}
+        return [
+            self.history_model(
+                field_name=field,
+                serialized_data=serialized_data[field],
+                date_created=date_created,
+                user=user,
+                **object_fields
+            )
+            for field in fields
+        ]
+
+    def serialize_delta(self, instance, field, model_field, created=False):
+        """
+        Returns the serialized data of a delta from the saved value of
+        ``field`` to its current value, or of a keyframe if the latest
+        history of the field doesn't hold the saved value or the chain of
+        deltas is full.
+        """
+        text = compact_encoder.encode(_value_from_field(instance, model_field))
+        if created:
+            return encode_keyframe(text)
+
+        previous = self.get_instance_tracker(instance).previous(field)
+        base_text = compact_encoder.encode(_value_from_field(SavedValue(model_field.attname, previous), model_field))
+        latest = self.history_model._default_manager.db_manager(instance._state.db) \
+            .get_for_model_and_field(instance, field) \
+            .order_by(*LATEST_FIRST) \
+            .annotate(header=Substr('serialized_data', 1, get_header_length(self.keyframe_interval))) \
+            .values_list('pk', 'header').first()
+        if latest is not None and is_delta(latest[1]):
+            try:
+                digest, chain, payload = parse_header(latest[1])
+            except ValueError:
+                pass  # A longer header than this tracker writes
+            else:
+                if digest == value_hash(base_text) and len(chain) + 1 < self.keyframe_interval:
+                    return encode_delta(text, base_text, chain + [latest[0]])
+        return encode_keyframe(text)
+
+    def write_field_histories(self, field_histories, using=None):
+        """Creates ``field_histories`` using this tracker's writer, or the one in settings"""
+        writer = self.writer or get_writer()
+        writer.write(field_histories, using=using)
+
+    def get_serialization_plan(self, instance):
+        model = instance._meta.concrete_model
+        try:
+            return self.serialization_plans[model]
+        except KeyError:
+            # Instances of a child model are serialized using the child's fields
+            plan = self.serialization_plans[model] = SerializationPlan(model, self.fields)
+            return plan
 
     def get_field_history_user(self, instance):
         try:
@@ -144,8 +403,14 @@ class FieldHistoryTracker(object):
         if instance is None:
             return self
         else:
+            prefetched = get_prefetched_field_history(instance)
+            if prefetched is not None:
+                return prefetched
             return FieldHistory.objects.get_for_model(instance)
 
 
 def _get_field_history(self, field):
+    prefetched = get_prefetched_field_history(self, field)
+    if prefetched is not None:
+        return prefetched
     return FieldHistory.objects.get_for_model_and_field(self, field)
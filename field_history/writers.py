@@ -0,0 +1,252 @@
+import atexit
+from collections import OrderedDict
+from functools import partial
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.utils.module_loading import import_string
+try:
+    from django.utils.six.moves import queue
+except ImportError:
+    import queue
+
+from .utils import chunked
+
+WRITER_SETTING = 'FIELD_HISTORY_WRITER'
+WRITER_OPTIONS_SETTING = 'FIELD_HISTORY_WRITER_OPTIONS'
+DEFAULT_WRITER = 'field_history.writers.ImmediateWriter'
+
+# FieldHistory objects inserted per query
+BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+_writers = {}
+
+
+def get_writer():
+    """
+    Returns the writer configured by ``settings.FIELD_HISTORY_WRITER``,
+    created with the keyword arguments in ``settings.FIELD_HISTORY_WRITER_OPTIONS``.
+    """
+    path = getattr(settings, WRITER_SETTING, DEFAULT_WRITER)
+    options = getattr(settings, WRITER_OPTIONS_SETTING, {})
+    key = (path, tuple(sorted(options.items())))
+    try:
+        return _writers[key]
+    except KeyError:
+        writer = _writers[key] = import_string(path)(**options)
+        return writer
+
+
+class ImmediateWriter(object):
+    """Creates FieldHistory objects as soon as they're recorded."""
+
+    batch_size = BATCH_SIZE
+
+    def write(self, field_histories, using=None):
+        """
+        Handles ``field_histories``, which were recorded for objects saved
+        to the ``using`` database.
+        """
+        self.create(field_histories, using)
+
+    def create(self, field_histories, using=None):
+        """Creates ``field_histories`` in the ``using`` database"""
+        # Models with a history table of their own have a history model of their own
+        history_models = OrderedDict()
+        for field_history in field_histories:
+            history_models.setdefault(field_history.__class__, []).append(field_history)
+        for history_model, model_field_histories in history_models.items():
+            for batch in chunked(model_field_histories, self.batch_size):
+                history_model._default_manager.db_manager(using).bulk_create(batch)
+
+
+def is_on_commit_hook(hook):
+    """
+    Returns ``True`` if ``hook`` is laid out like the entries of
+    ``connection.run_on_commit``: ``(savepoint_ids, callback, ...)``, where
+    Django 4.2 added a ``robust`` flag.
+    """
+    return isinstance(hook, tuple) and len(hook) >= 2 and isinstance(hook[0], set) and callable(hook[1])
+
+
+class TransactionBuffer(object):
+
+    def __init__(self, writer, using):
+        self.using = using
+        # History of saves whose on_commit callbacks have run
+        self.committed = []
+        self.flush = partial(writer.flush_buffer, self)
+
+
+class TransactionWriter(ImmediateWriter):
+    """
+    Buffers FieldHistory objects recorded inside a transaction and creates
+    them once it commits.
+
+    Each save's history is kept by an ``on_commit`` callback of its own, so
+    it is discarded along with a rolled back transaction or savepoint. A
+    single flush callback, kept after those, then creates everything that
+    was kept in chunked ``bulk_create`` calls. History recorded outside of a
+    transaction is created immediately.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get_buffer(self, using):
+        buffers = self.local.__dict__.setdefault('buffers', {})
+        try:
+            return buffers[using]
+        except KeyError:
+            buffer = buffers[using] = TransactionBuffer(self, using)
+            return buffer
+
+    def write(self, field_histories, using=None):
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            return self.create(field_histories, connection.alias)
+
+        buffer = self.get_buffer(connection.alias)
+        transaction.on_commit(partial(buffer.committed.extend, list(field_histories)), using)
+        self.schedule_flush(connection, buffer)
+
+    def schedule_flush(self, connection, buffer):
+        """
+        Moves the buffer's flush callback after every other pending callback.
+
+        The callback is registered under the savepoints shared by all of the
+        buffered saves, so it's only discarded when all of them are. This
+        relies on Django's private list of callbacks, whose entries start
+        with the savepoint ids and the callback. When they don't, each save
+        schedules a flush of its own instead.
+        """
+        hooks = getattr(connection, 'run_on_commit', None)
+        if not is_on_commit_hook(hooks[-1] if hooks else None):
+            connection.on_commit(buffer.flush)
+            return
+        savepoint_ids = set(connection.savepoint_ids)
+        # Searched from the end, where it's found right before this save's callback
+        for index in range(len(hooks) - 1, -1, -1):
+            if hooks[index][1] is buffer.flush:
+                savepoint_ids &= hooks[index][0]
+                del hooks[index]
+                break
+        connection.on_commit(buffer.flush)
+        hooks[-1] = (savepoint_ids,) + tuple(hooks[-1][1:])
+
+    def flush_buffer(self, buffer):
+        field_histories = buffer.committed[:]
+        del buffer.committed[:]
+        self.create(field_histories, buffer.using)
+
+
+class BackgroundWriter(TransactionWriter):
+    """
+    Hands FieldHistory objects to a worker thread that creates them in
+    batches, using its own database connection.
+
+    History is queued once its transaction commits (see TransactionWriter).
+    The worker creates up to ``batch_size`` objects at a time, waiting at
+    most ``flush_interval`` seconds for a batch to fill up. The queue holds
+    at most ``max_queue_size`` objects; when it's full, ``on_full`` decides
+    whether to ``'block'`` until there's room, ``'drop'`` the history (which
+    is logged), or ``'write'`` it from the saving thread instead. Queued
+    history is created before the interpreter exits, or when ``close()`` is
+    called.
+    """
+
+    ON_FULL_CHOICES = ('block', 'drop', 'write')
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=1.0, max_queue_size=10000, on_full='block'):
+        super(BackgroundWriter, self).__init__()
+        if on_full not in self.ON_FULL_CHOICES:
+            raise ValueError('on_full must be one of {}'.format(', '.join(self.ON_FULL_CHOICES)))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_full = on_full
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='field-history-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def create(self, field_histories, using=None):
+        self.start()
+        overflow = []
+        for field_history in field_histories:
+            try:
+                # Queued with the database its object was saved to
+                self.queue.put((field_history, using), block=self.on_full == 'block')
+            except queue.Full:
+                overflow.append(field_history)
+        if not overflow:
+            return
+        if self.on_full == 'write':
+            super(BackgroundWriter, self).create(overflow, using)
+        else:
+            logger.warning('Dropped %d FieldHistory objects, the writer queue is full.', len(overflow))
+
+    def run(self):
+        try:
+            stopping = False
+            while not stopping:
+                # None is queued by close(), after everything that's still to be created
+                item = self.queue.get()
+                items = 1
+                deadline = time.time() + self.flush_interval
+                batch = []
+                while True:
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self.queue.get(timeout=max(deadline - time.time(), 0))
+                    except queue.Empty:
+                        break
+                    items += 1
+                if batch:
+                    # Like a request would, drop a connection the database closed or that is too old
+                    close_old_connections()
+                    self.create_batch(batch)
+                for _ in range(items):
+                    self.queue.task_done()
+        finally:
+            connections.close_all()
+
+    def create_batch(self, items):
+        """Creates a batch of queued ``(field_history, using)`` items"""
+        databases = OrderedDict()
+        for field_history, using in items:
+            databases.setdefault(using, []).append(field_history)
+        for using, field_histories in databases.items():
+            try:
+                super(BackgroundWriter, self).create(field_histories, using)
+            except Exception:
+                logger.exception('Failed to create %d FieldHistory objects.', len(field_histories))
+
+    def flush(self):
+        """Waits until all queued history is created."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Creates all queued history and stops the worker thread."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.14 on 2026-10-18 01:18
+
+from django.db import migrations, models
+import tests.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tests', '0002_pizzaorderproxy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', tests.models.JSONTextField(default=dict)),
+            ],
+        ),
+    ]
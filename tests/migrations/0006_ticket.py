@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tests', '0005_article'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ticket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255)),
+                ('description', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TicketFieldHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(max_length=500)),
+                ('serialized_data', models.TextField()),
+                ('date_created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('object', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tests.Ticket')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'get_latest_by': 'date_created',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ticketfieldhistory',
+            index=models.Index(fields=['object', 'field_name', 'date_created'], name='tests_ticke_object__8faa60_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketfieldhistory',
+            index=models.Index(fields=['object', 'date_created'], name='tests_ticke_object__4ddedb_idx'),
+        ),
+    ]
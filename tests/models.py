@@ -1,6 +1,14 @@
+import json
+import uuid
+
 from django.conf import settings
 from django.db import models
+try:
+    from django.utils import six
+except ImportError:
+    import six
 
+from field_history.querysets import TrackedManager
 from field_history.tracker import FieldHistoryTracker
 
 
@@ -12,6 +20,8 @@ class Person(models.Model):
     name = models.CharField(max_length=255)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
 
+    objects = TrackedManager()
+
     field_history = FieldHistoryTracker(['name'])
 
     @property
@@ -31,6 +41,8 @@ class Human(models.Model):
     body_temp = models.DecimalField(max_digits=15, decimal_places=2, blank=True, null=True)
     birth_date = models.DateField(blank=True, null=True)
 
+    objects = TrackedManager()
+
     field_history = FieldHistoryTracker(['age', 'is_female',
                                          'body_temp', 'birth_date'])
 
@@ -48,3 +60,57 @@ class PizzaOrder(models.Model):
     status = models.CharField(max_length=64, choices=STATUS_CHOICES)
 
     field_history = FieldHistoryTracker(['status'])
+
+
+class PizzaOrderProxy(PizzaOrder):
+
+    class Meta:
+        proxy = True
+
+
+class JSONTextField(models.TextField):
+    """Stores JSON-serializable values in a text column on every database."""
+
+    def from_db_value(self, value, *args):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if isinstance(value, six.string_types):
+            return json.loads(value)
+        return value
+
+    def get_prep_value(self, value):
+        return json.dumps(value)
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj))
+
+
+class Document(models.Model):
+    data = JSONTextField(default=dict)
+
+    field_history = FieldHistoryTracker(['data'])
+
+
+class Invoice(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=64)
+
+    field_history = FieldHistoryTracker(['status'])
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=255)
+    body = models.TextField()
+
+    field_history = FieldHistoryTracker(['title', 'body'], delta_fields=['body'], keyframe_interval=3)
+
+
+class Ticket(models.Model):
+    title = models.CharField(max_length=255)
+    description = models.TextField(blank=True)
+
+    objects = TrackedManager()
+
+    field_history = FieldHistoryTracker(['title', 'description'], delta_fields=['description'], keyframe_interval=3,
+                                        table=True)
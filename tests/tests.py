@@ -2,22 +2,50 @@
 # -*- coding: utf-8 -*-
 import datetime
 from decimal import Decimal
+from functools import partial
+import json
+import os
+import shutil
+import tempfile
+from unittest import skipUnless
 
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
 from django.core.management import CommandError, call_command
 from django.urls import reverse
-from django.db import models
-from django.test.utils import override_settings
-from django.test import TestCase
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models, transaction
+from django.db.models import F, QuerySet
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
 try:
     from django.utils import six
 except ImportError:
     import six
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from field_history.archive import archive_field_history, get_archived_field_history
+from field_history.deltas import diff, patch
+from field_history.management.commands.createinitialfieldhistory import get_partitions, iter_initial_field_histories
 from field_history.models import FieldHistory, instantiate_object_id_field
-from field_history.tracker import FieldHistoryTracker
-
-from .models import Human, Owner, Person, Pet, PizzaOrder
-
+from field_history.partitions import get_ahead_end, get_partitioning, get_range_partitions
+from field_history.prefetch import prefetch_field_history
+from field_history.querysets import TrackedQuerySet
+from field_history.retention import RetentionPolicy, prune_field_history
+from field_history.serialization import SerializationPlan, get_serializer_name, serialize_fields
+from field_history.tracker import FieldHistoryTracker, FieldInstanceTracker, snapshot_value
+from field_history.writers import BackgroundWriter, ImmediateWriter, TransactionWriter, get_writer
+
+from .models import (
+    Article, Document, Human, Invoice, Owner, Person, Pet, PizzaOrder, PizzaOrderProxy, Ticket, TicketFieldHistory,
+)
+
+COMPACT_SETTINGS = dict(FIELD_HISTORY_STORAGE_FORMAT='compact')
+TYPED_OBJECT_ID_SETTINGS = dict(FIELD_HISTORY_TYPED_OBJECT_ID=True)
+TRANSACTION_WRITER_SETTINGS = dict(FIELD_HISTORY_WRITER='field_history.writers.TransactionWriter')
 JSON_NESTED_SETTINGS = dict(FIELD_HISTORY_SERIALIZER_NAME='json_nested',
                             SERIALIZATION_MODULES={'json_nested': 'field_history.json_nested_serializer'})
 
@@ -249,6 +277,61 @@ class FieldHistoryTests(TestCase):
         self.assertEqual(FieldHistory.objects.get_for_model_and_field(human, 'body_temp').count(), 2)
         self.assertEqual(FieldHistory.objects.get_for_model_and_field(human, 'age').count(), 2)
 
+    def test_serialize_fields_matches_per_field_serialization(self):
+        pet = Pet.objects.create(name='Garfield')
+        owner = Owner.objects.create(name='Jon', pet=pet)
+        human = Human.objects.create(age=18, body_temp=Decimal('98.60'),
+                                     birth_date=datetime.date(1991, 11, 6))
+
+        for instance, fields in ((owner, ['name', 'pet']),
+                                 (human, ['age', 'is_female', 'body_temp', 'birth_date'])):
+            serialized = serialize_fields(instance, fields)
+            for field in fields:
+                self.assertEqual(serialized[field],
+                                 serializers.serialize('json', [instance], fields=[field]))
+
+        with self.settings(**JSON_NESTED_SETTINGS):
+            self.assertEqual(serialize_fields(owner, ['name'])['name'],
+                             serializers.serialize('json_nested', [owner], fields=['name']))
+
+    def test_serialization_plan_matches_serializer_output(self):
+        pet = Pet.objects.create(name='Garfield')
+        owner = Owner.objects.create(name='Jon', pet=pet)
+        fields = ['name', 'pet', 'created_by']
+        plan = SerializationPlan(Owner, fields)
+
+        for settings in ({}, JSON_NESTED_SETTINGS):
+            with self.settings(**settings):
+                serialized = plan.serialize(owner, fields)
+                for field in fields:
+                    self.assertEqual(serialized[field],
+                                     serialize_fields(owner, [field])[field])
+
+    def test_serialization_plan_matches_serializer_output_of_non_ascii_values(self):
+        person = Person.objects.create(name=u'Zo\xeb \u4e2d\u6587')
+        plan = SerializationPlan(Person, ['name'])
+
+        for settings in ({}, JSON_NESTED_SETTINGS):
+            with self.settings(**settings):
+                self.assertEqual(plan.serialize(person, ['name'])['name'],
+                                 serializers.serialize(get_serializer_name(), [person], fields=['name']))
+        self.assertEqual(person.get_name_history().get().field_value, u'Zo\xeb \u4e2d\u6587')
+
+    def test_save_does_not_look_up_serializer(self):
+        human = Human.objects.create(age=18)
+
+        human.age = 21
+        human.is_female = False
+        human.birth_date = datetime.date(1991, 11, 6)
+        with mock.patch('django.core.serializers.get_serializer') as get_serializer:
+            human.save()
+
+        self.assertFalse(get_serializer.called)
+        self.assertEqual(human.get_age_history().latest().field_value, 21)
+        self.assertEqual(human.get_is_female_history().latest().field_value, False)
+        self.assertEqual(human.get_birth_date_history().latest().field_value,
+                         datetime.date(1991, 11, 6))
+
     def test_field_history_works_with_foreign_key_field(self):
         pet = Pet.objects.create(name='Garfield')
         owner = Owner.objects.create(name='Jon', pet=pet)
@@ -261,6 +344,109 @@ class FieldHistoryTests(TestCase):
         self.assertEqual(history.field_value, pet)
         self.assertIsNotNone(history.date_created)
 
+    def test_field_value_is_decoded_without_deserializing(self):
+        pet = Pet.objects.create(name='Garfield')
+        owner = Owner.objects.create(name='Jon', pet=pet)
+        history = owner.get_pet_history().get()
+
+        with mock.patch('django.core.serializers.deserialize') as deserialize, self.assertNumQueries(1):
+            self.assertEqual(history.field_value, pet)
+            # Memoized
+            self.assertEqual(history.field_value, pet)
+        self.assertFalse(deserialize.called)
+
+        history.serialized_data = history.serialized_data.replace('"pet": {}'.format(pet.pk), '"pet": null')
+        self.assertIsNone(history.field_value)
+
+    @override_settings(FIELD_HISTORY_SERIALIZER_NAME='xml')
+    def test_field_value_uses_serializer_setting(self):
+        human = Human.objects.create(age=18, birth_date=datetime.date(1991, 11, 6))
+
+        self.assertTrue(human.get_age_history().get().serialized_data.startswith('<?xml'))
+        self.assertEqual(human.get_age_history().get().field_value, 18)
+        self.assertEqual(human.get_birth_date_history().get().field_value, datetime.date(1991, 11, 6))
+
+    def test_field_values(self):
+        pet = Pet.objects.create(name='Garfield')
+        Owner.objects.create(name='Jon', pet=pet)
+        Owner.objects.create(name='Arya', pet=pet)
+        Human.objects.create(age=18, body_temp=Decimal('98.60'))
+
+        with self.assertNumQueries(2):
+            values = list(FieldHistory.objects.filter(field_name__in=['pet', 'age', 'body_temp'])
+                          .order_by('field_name', 'pk').field_values('field_name'))
+
+        self.assertEqual(values, [
+            {'field_name': 'age', 'field_value': 18},
+            {'field_name': 'body_temp', 'field_value': Decimal('98.60')},
+            {'field_name': 'pet', 'field_value': pet},
+            {'field_name': 'pet', 'field_value': pet},
+        ])
+        self.assertEqual([row['field_value'] for row in FieldHistory.objects.filter(field_name='age').field_values()],
+                         [18])
+
+    @override_settings(**COMPACT_SETTINGS)
+    def test_compact_storage_format(self):
+        pet = Pet.objects.create(name='Garfield')
+        owner = Owner.objects.create(name='Jon', pet=pet)
+        human = Human.objects.create(age=18, body_temp=Decimal('98.60'), birth_date=datetime.date(1991, 11, 6))
+
+        self.assertEqual(human.get_age_history().get().serialized_data, '=18')
+        self.assertEqual(human.get_body_temp_history().get().serialized_data, '="98.60"')
+        self.assertEqual(human.get_birth_date_history().get().field_value, datetime.date(1991, 11, 6))
+        self.assertEqual(owner.get_pet_history().get().field_value, pet)
+        # Unlike json documents, compact values include fields of parent models
+        self.assertEqual(owner.get_name_history().get().field_value, 'Jon')
+        self.assertEqual([row['field_value'] for row in human.get_body_temp_history().field_values()],
+                         [Decimal('98.60')])
+
+    @override_settings(FIELD_HISTORY_STORAGE_FORMAT='binary')
+    def test_storage_format_must_be_valid(self):
+        with self.assertRaises(ValueError):
+            Person.objects.create(name='Initial Name')
+
+    def test_delta_fields(self):
+        paragraph = 'The quick brown fox jumps over the lazy dog. ' * 20
+        bodies = [paragraph * 3, paragraph * 3 + 'The end.', 'Preface. ' + paragraph * 3 + 'The end.',
+                  'Preface. ' + paragraph * 2 + 'The end.', 'Preface. ' + paragraph * 2 + 'The End.']
+        article = Article.objects.create(title='Draft', body=bodies[0])
+        for body in bodies[1:]:
+            article.body = body
+            article.save()
+
+        histories = list(article.get_body_history().order_by('pk'))
+        # A keyframe is followed by at most keyframe_interval - 1 deltas
+        self.assertEqual([field_history.serialized_data.split(':', 2)[1] for field_history in histories],
+                         ['', str(histories[0].pk), '{},{}'.format(histories[0].pk, histories[1].pk),
+                          '', str(histories[3].pk)])
+        self.assertLess(len(histories[1].serialized_data), 100)
+        self.assertEqual([field_history.field_value for field_history in histories], bodies)
+        self.assertEqual([row['field_value'] for row in article.get_body_history().order_by('pk').field_values()],
+                         bodies)
+        self.assertEqual(article.get_title_history().get().field_value, 'Draft')
+
+    def test_delta_fields_store_keyframe_when_history_is_stale(self):
+        article = Article.objects.create(title='Draft', body='Version 1 ' * 100)
+        # Not recorded, so the latest history doesn't hold the saved value
+        Article.objects.update(body='Version 2 ' * 100)
+        article = Article.objects.get()
+        article.body = 'Version 3 ' * 100
+        article.save()
+
+        latest = article.get_body_history().latest()
+        self.assertEqual(latest.serialized_data.split(':', 2)[1], '')
+        self.assertEqual(latest.field_value, 'Version 3 ' * 100)
+
+    def test_delta_fields_must_be_tracked(self):
+        with self.assertRaises(ValueError):
+            FieldHistoryTracker(['title'], delta_fields=['body'])
+
+    def test_diff_and_patch(self):
+        pairs = [('', ''), ('', 'abc'), ('abc', ''), ('a b c', 'a x c'), ('aaa', 'aaaa'), ('one two', 'two one'),
+                 ('{"a":[1,2,3]}', '{"a":[1,3],"b":"caf\u00e9"}')]
+        for a, b in pairs:
+            self.assertEqual(patch(a, diff(a, b)), b)
+
     def test_field_history_works_with_field_set_to_None(self):
         owner = Owner.objects.create(pet=None)
 
@@ -270,6 +456,151 @@ class FieldHistoryTests(TestCase):
         self.assertEqual(history.field_name, 'pet')
         self.assertEqual(history.field_value, None)
 
+    def test_child_model_with_own_tracker_does_not_duplicate_parent_fields(self):
+        owner = Owner.objects.create(name='Jon')
+
+        self.assertEqual(owner.get_name_history().count(), 1)
+        self.assertEqual(owner.get_pet_history().count(), 1)
+
+    def test_proxy_model_is_tracked_by_concrete_model_tracker(self):
+        order = PizzaOrderProxy.objects.create(status='ORDERED')
+        order.status = 'COOKING'
+        order.save()
+
+        self.assertEqual(order.get_status_history().count(), 2)
+        self.assertEqual(order.get_status_history().latest().field_value, 'COOKING')
+
+    def test_save_is_not_patched_on_instances(self):
+        Person.objects.create(name='Initial Name')
+        Pet.objects.create(name='Garfield')
+
+        person = Person.objects.get()
+        pet = Pet.objects.get()
+
+        self.assertNotIn('save', person.__dict__)
+        self.assertNotIn('_field_history', pet.__dict__)
+
+    def test_field_history_detects_in_place_changes_to_mutable_values(self):
+        document = Document.objects.create(data={'tags': ['a'], 'title': 'Draft'})
+        document = Document.objects.get()
+
+        document.save()
+        self.assertEqual(document.get_data_history().count(), 1)
+
+        document.data['tags'].append('b')
+        document.save()
+        self.assertEqual(document.get_data_history().count(), 2)
+        self.assertEqual(document.get_data_history().latest().field_value,
+                         {'tags': ['a', 'b'], 'title': 'Draft'})
+
+    def test_in_place_changes_before_the_tracker_is_created_are_detected(self):
+        Document.objects.create(data={'tags': ['a'], 'title': 'Draft'})
+        document = Document.objects.get()
+
+        document.data['tags'].append('b')
+        document.save()
+
+        self.assertEqual(document.get_data_history().count(), 2)
+
+    def test_loading_objects_does_not_create_trackers(self):
+        PizzaOrder.objects.create(status='ORDERED')
+        order = PizzaOrder.objects.get()
+
+        self.assertNotIn('_field_history', order.__dict__)
+        self.assertFalse(PizzaOrder.field_history.get_instance_tracker(order).has_changed('status'))
+        order.status = 'COOKING'
+        self.assertTrue(PizzaOrder.field_history.get_instance_tracker(order).has_changed('status'))
+
+    def test_snapshot_value_shares_immutable_values(self):
+        for value in (1, 'text', Decimal('1.5'), datetime.date(2020, 1, 1), None, True,
+                      (1, 'a'), frozenset([1, 2])):
+            self.assertIs(snapshot_value(value), value)
+
+    def test_snapshot_value_copies_mutable_values(self):
+        value = {'list': [1, {'a': 'b'}], 'tuple': (1, [2])}
+        snapshot = snapshot_value(value)
+
+        self.assertEqual(snapshot, value)
+        self.assertIsNot(snapshot['list'], value['list'])
+        self.assertIsNot(snapshot['list'][1], value['list'][1])
+        self.assertIsNot(snapshot['tuple'][1], value['tuple'][1])
+        self.assertIs(snapshot['list'][0], value['list'][0])
+
+    def test_loading_objects_does_not_fetch_tracked_foreign_keys(self):
+        Owner.objects.create(name='Jon', pet=Pet.objects.create(name='Garfield'))
+
+        with self.assertNumQueries(1):
+            owner = Owner.objects.get()
+
+        self.assertEqual(Owner.field_history.get_instance_tracker(owner).previous('pet'), owner.pet_id)
+
+    def test_loading_objects_does_not_load_deferred_tracked_fields(self):
+        pet = Pet.objects.create(name='Garfield')
+        Owner.objects.create(name='Jon', pet=pet)
+        Owner.objects.create(name='Liz', pet=pet)
+
+        with self.assertNumQueries(1):
+            owners = list(Owner.objects.defer('name', 'pet'))
+
+        for owner in owners:
+            self.assertEqual(owner.get_deferred_fields(), {'name', 'pet_id'})
+
+    def test_unloaded_deferred_field_is_not_tracked_on_save(self):
+        Owner.objects.create(name='Jon', pet=Pet.objects.create(name='Garfield'))
+        owner = Owner.objects.defer('pet').get()
+
+        owner.name = 'Jonathan'
+        owner.save()
+
+        self.assertEqual(owner.get_name_history().count(), 2)
+        self.assertEqual(owner.get_pet_history().count(), 1)
+
+    def test_changed_deferred_field_is_tracked_on_save(self):
+        pet = Pet.objects.create(name='Garfield')
+        Owner.objects.create(name='Jon', pet=pet)
+        owner = Owner.objects.defer('pet').get()
+
+        # Loading a deferred field without changing it doesn't create history
+        self.assertEqual(owner.pet, pet)
+        owner.save()
+        self.assertEqual(owner.get_pet_history().count(), 1)
+
+        new_pet = Pet.objects.create(name='Odie')
+        owner = Owner.objects.defer('pet').get()
+        owner.pet = new_pet
+        owner.save()
+
+        self.assertEqual(owner.get_pet_history().count(), 2)
+        self.assertEqual(owner.get_pet_history().latest().field_value, new_pet)
+
+    def test_save_with_update_fields_only_tracks_those_fields(self):
+        human = Human.objects.create(age=18, is_female=True)
+
+        human.age = 21
+        human.is_female = False
+        with mock.patch.object(FieldInstanceTracker, 'has_changed', autospec=True,
+                               side_effect=FieldInstanceTracker.has_changed) as has_changed:
+            human.save(update_fields=['age'])
+
+        self.assertEqual([call[0][1] for call in has_changed.call_args_list], ['age'])
+        self.assertEqual(human.get_age_history().count(), 2)
+        self.assertEqual(human.get_is_female_history().count(), 1)
+
+        # The unsaved change is still tracked by the next save
+        human.save()
+        self.assertEqual(human.get_age_history().count(), 2)
+        self.assertEqual(human.get_is_female_history().count(), 2)
+
+    def test_save_with_update_fields_accepts_attnames(self):
+        owner = Owner.objects.create(name='Jon')
+        pet = Pet.objects.create(name='Garfield')
+
+        owner.pet = pet
+        owner.save(update_fields=['pet_id'])
+
+        self.assertEqual(owner.get_pet_history().count(), 2)
+        self.assertEqual(owner.get_pet_history().latest().field_value, pet)
+
     @override_settings(**JSON_NESTED_SETTINGS)
     def test_field_history_works_with_field_of_parent_model(self):
         owner = Owner.objects.create(name='Jon')
@@ -280,6 +611,18 @@ class FieldHistoryTests(TestCase):
         self.assertEqual(history.field_name, 'name')
         self.assertEqual(history.field_value, 'Jon')
 
+    @skipUnless(connection.vendor == 'sqlite', 'Query plans are checked on SQLite')
+    def test_manager_lookups_use_composite_indexes(self):
+        person = Person.objects.create(name='Initial Name')
+
+        plan = person.get_name_history().order_by('-date_created').explain()
+        self.assertIn('field_history_object_field_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+        plan = FieldHistory.objects.get_for_model(person).order_by('-date_created').explain()
+        self.assertIn('field_history_object_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
     def test_object_id_field_type_class(self):
         field = instantiate_object_id_field(models.PositiveIntegerField)
         self.assertIsInstance(field, models.PositiveIntegerField)
@@ -296,6 +639,790 @@ class FieldHistoryTests(TestCase):
         object_id_tuple_bad_kwargs = (models.TextField, 10)
         self.assertRaises(TypeError, lambda: instantiate_object_id_field(object_id_tuple_bad_kwargs))
 
+    def test_content_type_id_is_pinned_per_model(self):
+        Person.objects.create(name='Initial Name')
+        with mock.patch.object(ContentType.objects, 'get_for_model') as get_for_model:
+            person = Person.objects.create(name='Second Name')
+            history = person.get_name_history().get()
+
+        get_for_model.assert_not_called()
+        self.assertEqual(history.content_type, ContentType.objects.get_for_model(Person))
+        self.assertEqual(history.object, person)
+
+    @override_settings(**TYPED_OBJECT_ID_SETTINGS)
+    def test_typed_object_id_stores_integer_primary_keys(self):
+        owner = Owner.objects.create(name='Jon')
+
+        history = owner.get_name_history().get()
+        self.assertIsNone(history.object_id)
+        self.assertEqual(history.object_id_int, owner.pk)
+        self.assertEqual(history.object, owner)
+        six.assertCountEqual(self, list(owner.field_history), list(FieldHistory.objects.filter(object_id_int=owner.pk)))
+
+    @override_settings(**TYPED_OBJECT_ID_SETTINGS)
+    def test_typed_object_id_stores_uuid_primary_keys(self):
+        invoice = Invoice.objects.create(status='DRAFT')
+
+        history = invoice.get_status_history().get()
+        self.assertIsNone(history.object_id)
+        self.assertEqual(history.object_id_uuid, invoice.pk)
+        self.assertEqual(history.object, invoice)
+
+
+class TrackedQuerySetTests(TestCase):
+
+    def test_update_creates_field_history_for_changed_objects(self):
+        Human.objects.create(age=18)
+        Human.objects.create(age=18)
+        unchanged = Human.objects.create(age=21)
+
+        # Previous values, the update and the history
+        with self.assertNumQueries(3):
+            rows = Human.objects.filter(age__gte=18).update(age=21)
+
+        self.assertEqual(rows, 3)
+        self.assertEqual(FieldHistory.objects.filter(field_name='age').count(), 5)
+        self.assertEqual(unchanged.get_age_history().count(), 1)
+        for human in Human.objects.exclude(pk=unchanged.pk):
+            self.assertEqual(human.get_age_history().latest().field_value, 21)
+
+    def test_update_with_expression_records_database_values(self):
+        human = Human.objects.create(age=18)
+
+        Human.objects.update(age=F('age') + 1)
+
+        self.assertEqual(human.get_age_history().latest().field_value, 19)
+
+    def test_update_with_foreign_key(self):
+        owner = Owner.objects.create(name='Jon')
+        pet = Pet.objects.create(name='Garfield')
+
+        Owner.objects.update(pet=pet)
+
+        self.assertEqual(owner.get_pet_history().latest().field_value, pet)
+
+    def test_update_of_untracked_fields_does_not_read_objects(self):
+        Person.objects.create(name='Jon')
+
+        with self.assertNumQueries(1):
+            Person.objects.update(created_by=None)
+
+        self.assertEqual(FieldHistory.objects.count(), 1)
+
+    def test_update_of_deferred_fields(self):
+        Person.objects.create(name='a')
+
+        Person.objects.only('id').update(name='b')
+        Person.objects.defer('name').update(name='c')
+
+        self.assertEqual([history.field_value for history in FieldHistory.objects.order_by('pk')], ['a', 'b', 'c'])
+
+    def test_update_reads_only_tracked_fields(self):
+        Person.objects.create(name='Jon')
+
+        with CaptureQueriesContext(connection) as queries:
+            Person.objects.update(name='Jonathan')
+
+        self.assertIn('"name"', queries[0]['sql'])
+        self.assertNotIn('created_by_id', queries[0]['sql'])
+
+    def test_update_only_updates_the_objects_it_read(self):
+        person = Person.objects.create(name='Jon')
+        get_tracked_objects = TrackedQuerySet._get_tracked_objects
+
+        def get_tracked_objects_then_create(queryset, trackers):
+            objs = get_tracked_objects(queryset, trackers)
+            Person.objects.create(name='Liz')  # Created while the update runs
+            return objs
+
+        with mock.patch.object(TrackedQuerySet, '_get_tracked_objects', autospec=True,
+                               side_effect=get_tracked_objects_then_create):
+            rows = Person.objects.filter(name__in=['Jon', 'Liz']).update(name='Jonathan')
+
+        self.assertEqual(rows, 1)
+        self.assertEqual(person.get_name_history().latest().field_value, 'Jonathan')
+        liz = Person.objects.get(name='Liz')
+        self.assertEqual(liz.get_name_history().count(), 1)
+
+    def test_bulk_create_creates_field_history_for_all_tracked_fields(self):
+        # Highest primary key, the objects, their primary keys and the history
+        with self.assertNumQueries(4):
+            humans = Human.objects.bulk_create([Human(age=age) for age in range(3)])
+
+        self.assertEqual(FieldHistory.objects.count(), 12)
+        for age, human in enumerate(humans):
+            self.assertEqual(human, Human.objects.get(age=age))
+            self.assertEqual(human.get_age_history().get().field_value, age)
+            self.assertEqual(human.get_is_female_history().get().field_value, True)
+
+        # The saved values are up to date, so saving again records nothing
+        humans[0].save()
+        self.assertEqual(FieldHistory.objects.count(), 12)
+
+    def test_bulk_create_with_primary_keys_does_not_read_them(self):
+        with self.assertNumQueries(2):
+            Human.objects.bulk_create([Human(pk=10, age=1), Human(pk=20, age=2)])
+
+        self.assertEqual(Human.objects.get(pk=20).get_age_history().get().field_value, 2)
+
+    def test_bulk_create_with_some_primary_keys(self):
+        humans = Human.objects.bulk_create([Human(pk=1000, age=1), Human(age=2)])
+
+        self.assertEqual(humans[1], Human.objects.get(age=2))
+        self.assertEqual(humans[0].get_age_history().get().field_value, 1)
+        self.assertEqual(humans[1].get_age_history().get().field_value, 2)
+
+    def test_bulk_create_without_determinable_primary_keys(self):
+        Human.objects.create(age=1)
+        FieldHistory.objects.all().delete()
+
+        # As if another row was inserted after the highest primary key was read
+        with mock.patch.object(TrackedQuerySet, '_get_max_pk', return_value=None), \
+                self.assertLogs('field_history.querysets', 'WARNING'):
+            Human.objects.bulk_create([Human(age=2)])
+
+        self.assertTrue(Human.objects.filter(age=2).exists())
+        self.assertFalse(FieldHistory.objects.exists())
+
+    def test_bulk_update_creates_field_history_for_changed_fields(self):
+        Human.objects.create(age=18, is_female=True)
+        Human.objects.create(age=20, is_female=True)
+        humans = list(Human.objects.order_by('pk'))
+        humans[0].age = 19
+        humans[0].is_female = False
+        humans[1].is_female = False
+
+        Human.objects.bulk_update(humans, ['age', 'is_female'])
+
+        self.assertEqual(humans[0].get_age_history().count(), 2)
+        self.assertEqual(humans[0].get_is_female_history().count(), 2)
+        self.assertEqual(humans[1].get_age_history().count(), 1)
+        self.assertEqual(humans[1].get_is_female_history().latest().field_value, False)
+
+        # The saved values are up to date, so saving again records nothing
+        humans[0].save()
+        self.assertEqual(FieldHistory.objects.count(), 11)
+
+
+class PrefetchFieldHistoryTests(TestCase):
+
+    def setUp(self):
+        for name in ('Jon', 'Arya'):
+            person = Person.objects.create(name=name)
+            for suffix in ('1', '2', '3'):
+                person.name = name + suffix
+                person.save()
+
+    def test_history_is_prefetched_in_one_query(self):
+        with self.assertNumQueries(2):
+            people = prefetch_field_history(Person.objects.order_by('pk'))
+            for person in people:
+                names = [history.field_value for history in person.get_name_history()]
+                self.assertEqual(names, [person.name[:-1] + suffix for suffix in '321'] + [person.name[:-1]])
+                self.assertEqual(list(person.field_history), list(person.get_name_history()))
+
+    def test_history_is_prefetched_in_batches(self):
+        with mock.patch('field_history.prefetch.PREFETCH_BATCH_SIZE', 1), self.assertNumQueries(3):
+            people = prefetch_field_history(Person.objects.order_by('pk'))
+            for person in people:
+                self.assertEqual(len(person.get_name_history()), 4)
+
+    def test_prefetch_only_fields(self):
+        owner = Owner.objects.create(name='Jon')
+        owner = prefetch_field_history(Owner.objects.filter(pk=owner.pk), fields=['pet'])[0]
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(owner.get_pet_history()), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(owner.get_name_history()), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(owner.field_history), 2)
+
+    def test_prefetch_limit_per_object(self):
+        with self.assertNumQueries(2):
+            people = prefetch_field_history(Person.objects.order_by('pk'), limit_per_object=2)
+            for person in people:
+                self.assertEqual([history.field_value for history in person.get_name_history()],
+                                 [person.name, person.name[:-1] + '2'])
+
+    def test_prefetch_limit_per_object_without_window_functions(self):
+        with mock.patch.object(connection.features, 'supports_over_clause', False):
+            people = prefetch_field_history(Person.objects.order_by('pk'), limit_per_object=3)
+
+        for person in people:
+            self.assertEqual(len(person.field_history), 3)
+            self.assertEqual(person.field_history[0].field_value, person.name)
+
+    def test_saving_discards_prefetched_history(self):
+        person = prefetch_field_history(Person.objects.filter(name='Jon3'))[0]
+        person.name = 'Jon4'
+        person.save()
+
+        self.assertEqual(person.get_name_history().latest().field_value, 'Jon4')
+
+
+class AsOfTests(TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.people = []
+        for name in ('Jon', 'Arya'):
+            person = Person.objects.create(name=name)
+            for suffix in ('1', '2'):
+                person.name = name + suffix
+                person.save()
+            self.people.append(person)
+        # One day between each change of each person's name
+        for person in self.people:
+            for day, field_history in enumerate(person.get_name_history().order_by('pk')):
+                FieldHistory.objects.filter(pk=field_history.pk).update(
+                    date_created=self.start + datetime.timedelta(days=day))
+
+    def as_of(self, days):
+        return FieldHistory.objects.as_of(Person.objects.all(), self.start + datetime.timedelta(days=days))
+
+    def test_as_of_instance(self):
+        jon = self.people[0]
+        as_of = FieldHistory.objects.as_of(jon, self.start + datetime.timedelta(hours=36))
+
+        self.assertEqual(as_of, {'name': 'Jon1'})
+
+    def test_as_of_queryset(self):
+        jon, arya = self.people
+        with self.assertNumQueries(2):
+            self.assertEqual(self.as_of(0), {jon.pk: {'name': 'Jon'}, arya.pk: {'name': 'Arya'}})
+        self.assertEqual(self.as_of(2), {jon.pk: {'name': 'Jon2'}, arya.pk: {'name': 'Arya2'}})
+        self.assertEqual(self.as_of(-1), {jon.pk: {}, arya.pk: {}})
+
+    def test_as_of_reads_objects_in_batches(self):
+        jon, arya = self.people
+        with mock.patch('field_history.managers.AS_OF_BATCH_SIZE', 1), self.assertNumQueries(3):
+            self.assertEqual(self.as_of(1), {jon.pk: {'name': 'Jon1'}, arya.pk: {'name': 'Arya1'}})
+
+    def test_as_of_fields(self):
+        human = Human.objects.create(age=18, is_female=True)
+        human.age = 19
+        human.save()
+
+        as_of = FieldHistory.objects.as_of(human, timezone.now(), fields=['age', 'is_female'])
+
+        self.assertEqual(as_of, {'age': 19, 'is_female': True})
+
+    def test_as_of_without_window_functions(self):
+        jon, arya = self.people
+        with mock.patch.object(connection.features, 'supports_over_clause', False):
+            self.assertEqual(self.as_of(1), {jon.pk: {'name': 'Jon1'}, arya.pk: {'name': 'Arya1'}})
+
+
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def create_history(self, obj, field, values_and_ages):
+        """Saves each value of ``field`` and dates its history ``age`` (a timedelta) ago"""
+        for value, age in values_and_ages:
+            setattr(obj, field, value)
+            obj.save()
+            FieldHistory.objects.filter(pk=obj._get_field_history(field).latest().pk).update(
+                date_created=self.now - age)
+
+    def test_retention_policy(self):
+        day = datetime.timedelta(days=1)
+        histories = [(pk, self.now - age) for pk, age in enumerate(
+            [day * 0, day * 1, day * 2, day * 10, day * 10 + datetime.timedelta(hours=1), day * 11, day * 40])]
+
+        self.assertEqual(RetentionPolicy(keep_last=3).get_expired(histories, self.now), [3, 4, 5, 6])
+        self.assertEqual(RetentionPolicy(max_age=day * 5).get_expired(histories, self.now), [3, 4, 5, 6])
+        self.assertEqual(RetentionPolicy(daily_after=day * 5).get_expired(histories, self.now), [4])
+        # The latest history is kept however old it is
+        self.assertEqual(RetentionPolicy(max_age=day).get_expired(histories[-1:], self.now), [])
+        with self.assertRaises(ValueError):
+            RetentionPolicy(keep_last=0)
+
+    def test_prune_field_history(self):
+        day = datetime.timedelta(days=1)
+        people = [Person.objects.create(name='Initial Name') for _ in range(3)]
+        owner = Owner.objects.create(name='Jon')
+        for person in people:
+            self.create_history(person, 'name', [('Name {}'.format(age), day * age) for age in (30, 20, 10, 0)])
+        FieldHistory.objects.filter(field_name='name').filter(date_created__gt=self.now).update(
+            date_created=self.now - day * 40)
+
+        deleted = prune_field_history(Person, RetentionPolicy(max_age=day * 15), batch_size=2)
+
+        self.assertEqual(deleted, 9)
+        for person in people:
+            self.assertEqual([history.field_value for history in person.get_name_history().order_by('date_created')],
+                             ['Name 10', 'Name 0'])
+        self.assertEqual(owner.get_name_history().count(), 1)
+
+    def test_prune_field_history_per_field(self):
+        owner = Owner.objects.create(name='Jon')
+        for i in range(3):
+            owner.name = 'Jon {}'.format(i)
+            owner.pet = Pet.objects.create(name='Pet {}'.format(i))
+            owner.save()
+
+        prune_field_history(Owner, {'pet': RetentionPolicy(keep_last=1)})
+
+        self.assertEqual(owner.get_pet_history().get().field_value, owner.pet)
+        self.assertEqual(owner.get_name_history().count(), 4)
+
+    def test_prune_field_history_rebases_deltas(self):
+        article = Article.objects.create(title='Draft', body='Version 0 ' * 100)
+        for i in range(1, 5):
+            article.body = 'Version 0 ' * 100 + 'Version {}'.format(i)
+            article.save()
+
+        # The third version is a delta from the first two
+        prune_field_history(Article, RetentionPolicy(keep_last=3))
+
+        histories = list(article.get_body_history().order_by('pk'))
+        self.assertEqual([history.field_value for history in histories],
+                         ['Version 0 ' * 100 + 'Version {}'.format(i) for i in (2, 3, 4)])
+        self.assertEqual(histories[0].serialized_data.split(':', 2)[1], '')
+
+    @override_settings(FIELD_HISTORY_RETENTION={'tests.Person': {'keep_last': 1},
+                                                'tests.Owner.pet': RetentionPolicy(keep_last=2)})
+    def test_prunefieldhistory_command(self):
+        person = Person.objects.create(name='Initial Name')
+        owner = Owner.objects.create(name='Jon')
+        for i in range(3):
+            person.name = owner.name = 'Name {}'.format(i)
+            owner.pet = Pet.objects.create(name='Pet {}'.format(i))
+            person.save()
+            owner.save()
+
+        stdout = six.StringIO()
+        call_command('prunefieldhistory', stdout=stdout)
+
+        self.assertEqual(person.get_name_history().count(), 1)
+        self.assertEqual(owner.get_pet_history().count(), 2)
+        self.assertEqual(owner.get_name_history().count(), 4)
+        self.assertIn('Deleted 3 FieldHistory object(s) of tests.Person', stdout.getvalue())
+
+        call_command('prunefieldhistory', model=['tests.Owner'], field=['name'], keep_last=1,
+                     stdout=six.StringIO())
+
+        self.assertEqual(owner.get_name_history().count(), 1)
+        self.assertEqual(owner.get_pet_history().count(), 2)
+
+    @override_settings(FIELD_HISTORY_RETENTION={'tests.Person': {'keep_last': 1},
+                                                'tests.Owner.pet': RetentionPolicy(keep_last=1)})
+    def test_prunefieldhistory_command_limits_settings_policies(self):
+        person = Person.objects.create(name='Initial Name')
+        owner = Owner.objects.create(name='Jon')
+        for i in range(2):
+            person.name = owner.name = 'Name {}'.format(i)
+            owner.pet = Pet.objects.create(name='Pet {}'.format(i))
+            person.save()
+            owner.save()
+
+        with self.assertRaises(CommandError):
+            call_command('prunefieldhistory', model=['tests.Pet'], stdout=six.StringIO())
+        with self.assertRaises(CommandError):
+            call_command('prunefieldhistory', model=['tests.Owner'], field=['name'], stdout=six.StringIO())
+
+        call_command('prunefieldhistory', model=['tests.Owner'], field=['pet'], stdout=six.StringIO())
+
+        self.assertEqual(owner.get_pet_history().count(), 1)
+        self.assertEqual(person.get_name_history().count(), 3)
+
+        call_command('prunefieldhistory', field=['name'], stdout=six.StringIO())
+
+        self.assertEqual(person.get_name_history().count(), 1)
+        self.assertEqual(owner.get_name_history().count(), 3)
+
+    def test_prunefieldhistory_command_needs_policy(self):
+        with self.assertRaises(CommandError):
+            call_command('prunefieldhistory', stdout=six.StringIO())
+        with self.assertRaises(CommandError):
+            call_command('prunefieldhistory', keep_last=1, stdout=six.StringIO())
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_archive_field_history(self):
+        person = Person.objects.create(name='Initial Name')
+        other = Person.objects.create(name='Other')
+        for month, name in ((1, 'January'), (2, 'February'), (3, 'March')):
+            person.name = name
+            person.save()
+            FieldHistory.objects.filter(pk=person.get_name_history().latest().pk).update(
+                date_created=datetime.datetime(2020, month, 15, tzinfo=timezone.utc))
+        FieldHistory.objects.filter(pk=other.get_name_history().get().pk).update(
+            date_created=datetime.datetime(2020, 1, 1, tzinfo=timezone.utc))
+        human = Human.objects.create(age=18)
+
+        archived = archive_field_history(datetime.datetime(2020, 3, 1, tzinfo=timezone.utc), self.directory,
+                                         batch_size=2)
+
+        self.assertEqual(archived, 3)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'tests.person'))),
+                         ['2020-01.jsonl.gz', '2020-02.jsonl.gz'])
+        self.assertEqual([history.field_value for history in person.get_name_history().order_by('pk')],
+                         ['Initial Name', 'March'])
+        self.assertEqual(human.get_age_history().count(), 1)
+
+        histories = get_archived_field_history(person, directory=self.directory)
+        self.assertEqual([(history.field_name, history.field_value) for history in histories],
+                         [('name', 'February'), ('name', 'January')])
+        self.assertEqual(histories[0].date_created, datetime.datetime(2020, 2, 15, tzinfo=timezone.utc))
+        self.assertEqual([history.field_value for history in get_archived_field_history(
+            person, 'name', self.directory, start=datetime.datetime(2020, 2, 1, tzinfo=timezone.utc))], ['February'])
+        self.assertEqual([history.field_value for history in get_archived_field_history(other, 'name', self.directory)],
+                         ['Other'])
+        self.assertEqual(get_archived_field_history(human, directory=self.directory), [])
+
+    def test_archive_field_history_of_deltas(self):
+        article = Article.objects.create(title='Draft', body='Version 0 ' * 100)
+        for i in range(1, 3):
+            article.body = 'Version 0 ' * 100 + 'Version {}'.format(i)
+            article.save()
+        first = article.get_body_history().order_by('pk')[0]
+        FieldHistory.objects.filter(pk=first.pk).update(date_created=datetime.datetime(2020, 1, 1, tzinfo=timezone.utc))
+
+        archive_field_history(datetime.datetime(2021, 1, 1, tzinfo=timezone.utc), self.directory, models=[Article])
+
+        self.assertEqual([history.field_value for history in article.get_body_history().order_by('pk')],
+                         ['Version 0 ' * 100 + 'Version {}'.format(i) for i in (1, 2)])
+        self.assertEqual([history.field_value for history in get_archived_field_history(article, 'body', self.directory)],
+                         ['Version 0 ' * 100])
+
+    def test_archivefieldhistory_command(self):
+        Person.objects.create(name='Initial Name')
+        FieldHistory.objects.update(date_created=timezone.now() - datetime.timedelta(days=10))
+
+        call_command('archivefieldhistory', older_than_days=5, directory=self.directory, stdout=six.StringIO())
+
+        self.assertFalse(FieldHistory.objects.exists())
+        with self.assertRaises(CommandError):
+            call_command('archivefieldhistory', directory=self.directory, stdout=six.StringIO())
+        with self.assertRaises(CommandError):
+            call_command('archivefieldhistory', before='2020-01-01', stdout=six.StringIO())
+
+
+class HistoryTableTests(TestCase):
+
+    def test_history_is_created_in_own_table(self):
+        ticket = Ticket.objects.create(title='Broken', description='It crashes')
+        ticket.title = 'Broken login'
+        ticket.save()
+
+        self.assertFalse(FieldHistory.objects.exists())
+        self.assertEqual(TicketFieldHistory.objects.count(), 3)
+        history = ticket.get_title_history()
+        self.assertIs(history.model, TicketFieldHistory)
+        self.assertEqual([field_history.field_value for field_history in history.order_by('-date_created', '-pk')],
+                         ['Broken login', 'Broken'])
+        self.assertEqual(history.latest().object, ticket)
+        self.assertEqual(ticket.field_history.count(), 3)
+        self.assertEqual(FieldHistory.objects.get_for_model(ticket).count(), 3)
+        self.assertEqual(FieldHistory.objects.get_for_model_and_field(ticket, 'description').count(), 1)
+
+    def test_deltas(self):
+        ticket = Ticket.objects.create(title='Broken', description='It crashes on login. ' * 10)
+        for i in range(4):
+            ticket.description += 'Update {}. '.format(i)
+            ticket.save()
+
+        history = ticket.get_description_history().order_by('-date_created', '-pk')
+        self.assertEqual(history[0].field_value, ticket.description)
+        self.assertTrue(history[0].serialized_data.startswith('~'))
+        self.assertEqual([row['field_value'] for row in TicketFieldHistory.objects.filter(
+            field_name='description').order_by('-date_created', '-pk').field_values()][0], ticket.description)
+
+    def test_bulk_update(self):
+        Ticket.objects.bulk_create([Ticket(title='Broken'), Ticket(title='Slow')])
+        Ticket.objects.update(title='Fixed')
+
+        self.assertEqual(TicketFieldHistory.objects.filter(field_name='title', serialized_data__contains='Fixed').count(), 2)
+
+    def test_prefetch_and_as_of(self):
+        ticket = Ticket.objects.create(title='Broken')
+        person = Person.objects.create(name='Jon')
+        timestamp = timezone.now()
+        ticket.title = 'Fixed'
+        ticket.save()
+
+        ticket, person = prefetch_field_history([Ticket.objects.get(pk=ticket.pk), person])
+        with self.assertNumQueries(0):
+            self.assertEqual([history.field_value for history in ticket.get_title_history()], ['Fixed', 'Broken'])
+            self.assertEqual([history.field_value for history in person.get_name_history()], ['Jon'])
+        self.assertEqual(FieldHistory.objects.as_of([ticket, person], timestamp),
+                         {ticket.pk: {'title': 'Broken', 'description': ''}, person.pk: {'name': 'Jon'}})
+        with self.assertRaises(ValueError):
+            FieldHistory.objects.get_for_models([ticket])
+
+    def test_history_is_kept_when_object_is_deleted(self):
+        ticket = Ticket.objects.create(title='Broken')
+        ticket.delete()
+
+        self.assertEqual(TicketFieldHistory.objects.count(), 2)
+        self.assertEqual(str(TicketFieldHistory.objects.get(field_name='title')), 'title field history for None')
+
+    def test_management_commands(self):
+        ticket = Ticket.objects.create(title='Broken')
+        TicketFieldHistory.objects.all().delete()
+
+        call_command('createinitialfieldhistory', models=['tests.Ticket'], stdout=six.StringIO())
+        self.assertEqual(TicketFieldHistory.objects.count(), 2)
+
+        ticket.title = 'Fixed'
+        ticket.save()
+        self.assertEqual(prune_field_history(Ticket, RetentionPolicy(keep_last=1)), 1)
+        self.assertEqual(ticket.get_title_history().get().field_value, 'Fixed')
+
+        call_command('renamefieldhistory', model='tests.Ticket', from_field='title', to_field='summary',
+                     stdout=six.StringIO())
+        self.assertEqual(TicketFieldHistory.objects.filter(field_name='summary').count(), 1)
+        self.assertFalse(FieldHistory.objects.exists())
+
+    def test_commands_for_field_history_only_refuse_the_model(self):
+        for command in ('convertfieldhistoryformat', 'convertfieldhistoryobjectids'):
+            with self.assertRaises(CommandError):
+                call_command(command, models=['tests.Ticket'], stdout=six.StringIO())
+        with self.assertRaises(CommandError):
+            call_command('archivefieldhistory', older_than_days=0, models=['tests.Ticket'],
+                         directory=tempfile.gettempdir(), stdout=six.StringIO())
+
+        stderr = six.StringIO()
+        call_command('convertfieldhistoryformat', stdout=six.StringIO(), stderr=stderr)
+        self.assertIn('tests.Ticket', stderr.getvalue())
+
+
+class PartitionTests(TestCase):
+
+    def test_get_range_partitions(self):
+        start = datetime.datetime(2020, 11, 15, tzinfo=timezone.utc)
+        end = datetime.datetime(2021, 1, 1, tzinfo=timezone.utc)
+        self.assertEqual(get_range_partitions('history', 'month', start, end), [
+            ('history_p202011', datetime.datetime(2020, 11, 1, tzinfo=timezone.utc),
+             datetime.datetime(2020, 12, 1, tzinfo=timezone.utc)),
+            ('history_p202012', datetime.datetime(2020, 12, 1, tzinfo=timezone.utc),
+             datetime.datetime(2021, 1, 1, tzinfo=timezone.utc)),
+            ('history_p202101', datetime.datetime(2021, 1, 1, tzinfo=timezone.utc),
+             datetime.datetime(2021, 2, 1, tzinfo=timezone.utc)),
+        ])
+        # Weeks start on Monday
+        self.assertEqual(get_range_partitions('history', 'week', start, start), [
+            ('history_p20201109', datetime.datetime(2020, 11, 9, tzinfo=timezone.utc),
+             datetime.datetime(2020, 11, 16, tzinfo=timezone.utc)),
+        ])
+
+    def test_get_ahead_end(self):
+        now = datetime.datetime(2020, 12, 31, 23, tzinfo=timezone.utc)
+        self.assertEqual(get_ahead_end(now, 'month', 2), datetime.datetime(2021, 2, 1, tzinfo=timezone.utc))
+        self.assertEqual(get_ahead_end(now, 'day', 0), datetime.datetime(2020, 12, 31, tzinfo=timezone.utc))
+
+    def test_get_partitioning(self):
+        with override_settings(FIELD_HISTORY_PARTITIONING='month'):
+            self.assertEqual(get_partitioning(), 'month')
+        with self.assertRaises(ValueError):
+            get_partitioning()
+        with self.assertRaises(ValueError):
+            get_partitioning('hour')
+
+    def test_partitionfieldhistory_command(self):
+        with self.assertRaises(CommandError):
+            call_command('partitionfieldhistory', stdout=six.StringIO())
+        with override_settings(FIELD_HISTORY_PARTITIONING='month'):
+            # Only PostgreSQL partitions tables
+            with self.assertRaises(CommandError):
+                call_command('partitionfieldhistory', convert=True, stdout=six.StringIO())
+
+
+class OnCommitConnection(object):
+    """Keeps on_commit callbacks in ``make_hook(savepoint_ids, func)`` entries, like Django versions do"""
+
+    alias = DEFAULT_DB_ALIAS
+
+    def __init__(self, make_hook):
+        self.make_hook = make_hook
+        self.savepoint_ids = []
+        self.run_on_commit = []
+
+    def on_commit(self, func):
+        self.run_on_commit.append(self.make_hook(set(self.savepoint_ids), func))
+
+
+@override_settings(**TRANSACTION_WRITER_SETTINGS)
+class TransactionWriterTests(TransactionTestCase):
+
+    def test_flush_is_moved_after_callbacks_with_a_robust_flag(self):
+        # Django 4.2 added a robust flag to the callbacks
+        connection = OnCommitConnection(lambda savepoint_ids, func: (savepoint_ids, func, False))
+        writer = TransactionWriter()
+        buffer = writer.get_buffer(connection.alias)
+        for i in range(3):
+            connection.savepoint_ids.append('s{}'.format(i))
+            connection.on_commit(partial(buffer.committed.extend, [i]))
+            writer.schedule_flush(connection, buffer)
+
+        self.assertEqual([hook[1] for hook in connection.run_on_commit].count(buffer.flush), 1)
+        self.assertEqual(connection.run_on_commit[-1], ({'s0'}, buffer.flush, False))
+
+    def test_flush_is_scheduled_by_each_save_for_unknown_callbacks(self):
+        connection = OnCommitConnection(lambda savepoint_ids, func: func)
+        writer = TransactionWriter()
+        buffer = writer.get_buffer(connection.alias)
+        for i in range(2):
+            connection.on_commit(partial(buffer.committed.extend, [i]))
+            writer.schedule_flush(connection, buffer)
+
+        self.assertEqual(connection.run_on_commit[1::2], [buffer.flush, buffer.flush])
+
+    def test_history_is_created_once_the_transaction_commits(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for age in range(3):
+                    Human.objects.create(age=age)
+                self.assertEqual(FieldHistory.objects.count(), 0)
+
+        self.assertEqual(FieldHistory.objects.count(), 12)
+        # The history of all three objects is created with one query
+        table = FieldHistory._meta.db_table
+        self.assertEqual(len([query for query in queries if table in query['sql'] and 'INSERT' in query['sql']]), 1)
+
+    def test_history_is_discarded_when_the_transaction_rolls_back(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Person.objects.create(name='Initial Name')
+                raise ValueError
+
+        self.assertEqual(FieldHistory.objects.count(), 0)
+
+        # Later transactions are unaffected
+        with transaction.atomic():
+            Person.objects.create(name='Initial Name')
+        self.assertEqual(FieldHistory.objects.count(), 1)
+
+    def test_history_is_discarded_when_a_savepoint_rolls_back(self):
+        with transaction.atomic():
+            person = Person.objects.create(name='Initial Name')
+            try:
+                with transaction.atomic():
+                    person.name = 'Rolled Back'
+                    person.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            PizzaOrder.objects.create(status='ORDERED')
+
+        self.assertEqual(list(FieldHistory.objects.order_by('pk').values_list('field_name', flat=True)),
+                         ['name', 'status'])
+        self.assertEqual(person.get_name_history().get().field_value, 'Initial Name')
+
+    def test_history_is_created_immediately_outside_of_a_transaction(self):
+        Person.objects.create(name='Initial Name')
+
+        self.assertEqual(FieldHistory.objects.count(), 1)
+
+
+@override_settings(FIELD_HISTORY_WRITER='field_history.writers.BackgroundWriter',
+                   FIELD_HISTORY_WRITER_OPTIONS={'batch_size': 3, 'flush_interval': 0.01})
+class BackgroundWriterTests(TransactionTestCase):
+
+    def tearDown(self):
+        get_writer().close()
+
+    def test_history_is_created_by_the_worker_thread(self):
+        human = Human.objects.create(age=18)
+        Human.objects.create(age=19)
+        human.age = 20
+        human.save()
+
+        get_writer().flush()
+
+        self.assertEqual(FieldHistory.objects.count(), 9)
+        self.assertEqual(human.get_age_history().latest().field_value, 20)
+
+    def test_history_keeps_the_time_of_the_save(self):
+        writer = get_writer()
+        before = timezone.now()
+        with mock.patch.object(writer, 'start'):
+            Person.objects.create(name='Initial Name')
+        after = timezone.now()
+
+        with mock.patch('django.utils.timezone.now', return_value=after + datetime.timedelta(hours=1)):
+            writer.start()
+            writer.flush()
+
+        self.assertTrue(before <= FieldHistory.objects.get().date_created <= after)
+
+    def test_worker_reconnects_when_its_connection_is_lost(self):
+        writer = get_writer()
+        create_batch = writer.create_batch
+
+        def create_batch_and_lose_connection(field_histories):
+            create_batch(field_histories)
+            connections[DEFAULT_DB_ALIAS].connection.close()  # As if the database closed it
+
+        # The test database is in memory, which Django otherwise never closes
+        with mock.patch.object(writer, 'create_batch', side_effect=create_batch_and_lose_connection), \
+                mock.patch.object(connections[DEFAULT_DB_ALIAS].__class__, 'is_in_memory_db', return_value=False):
+            Person.objects.create(name='Initial Name')
+            writer.flush()
+            Person.objects.create(name='Other Name')
+            writer.flush()
+
+        self.assertEqual(FieldHistory.objects.count(), 2)
+
+    def test_history_is_created_in_the_database_of_its_object(self):
+        person = Person.objects.create(name='Initial Name')
+        get_writer().flush()
+        field_history = FieldHistory(object=person, field_name='name', serialized_data='[]')
+
+        with mock.patch.object(QuerySet, 'bulk_create', autospec=True) as bulk_create:
+            ImmediateWriter().write([field_history], using='other')
+            get_writer().create_batch([(field_history, 'other')])
+
+        self.assertEqual([call[0][0].db for call in bulk_create.call_args_list], ['other', 'other'])
+
+    def test_close_creates_queued_history(self):
+        with transaction.atomic():
+            Person.objects.create(name='Initial Name')
+
+        get_writer().close()
+
+        self.assertEqual(FieldHistory.objects.count(), 1)
+        self.assertFalse(get_writer().thread.is_alive())
+
+    def test_full_queue_drops_history(self):
+        person = Person.objects.create(name='Initial Name')
+        get_writer().flush()
+        writer = BackgroundWriter(max_queue_size=1, on_full='drop')
+        field_histories = [FieldHistory(object=person, field_name='name', serialized_data='[]')
+                           for _ in range(3)]
+
+        with mock.patch.object(writer, 'start'), mock.patch('field_history.writers.logger') as logger:
+            writer.create(field_histories)
+
+        self.assertEqual(writer.queue.qsize(), 1)
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(FieldHistory.objects.count(), 1)
+
+    def test_full_queue_writes_history_from_the_saving_thread(self):
+        person = Person.objects.create(name='Initial Name')
+        get_writer().flush()
+        writer = BackgroundWriter(max_queue_size=1, on_full='write')
+        field_histories = [FieldHistory(object=person, field_name='name', serialized_data='[]')
+                           for _ in range(3)]
+
+        with mock.patch.object(writer, 'start'):
+            writer.create(field_histories)
+
+        self.assertEqual(writer.queue.qsize(), 1)
+        self.assertEqual(FieldHistory.objects.count(), 3)
+
+    def test_on_full_must_be_valid(self):
+        self.assertRaises(ValueError, lambda: BackgroundWriter(on_full='ignore'))
+
 
 class ManagementCommandsTests(TestCase):
 
@@ -330,6 +1457,157 @@ class ManagementCommandsTests(TestCase):
 
         self.assertEqual(FieldHistory.objects.count(), 2)
 
+    def test_createinitialfieldhistory_command_in_batches(self):
+        people = [Person.objects.create(name='Person {}'.format(i)) for i in range(5)]
+        Human.objects.create(age=18)
+        FieldHistory.objects.filter(object_id__in=[str(people[1].pk), str(people[3].pk)]).delete()
+        FieldHistory.objects.filter(field_name='age').delete()
+        existing = set(FieldHistory.objects.values_list('pk', flat=True))
+
+        stdout = six.StringIO()
+        call_command('createinitialfieldhistory', batch_size=2, stdout=stdout)
+
+        created = FieldHistory.objects.exclude(pk__in=existing)
+        self.assertEqual(sorted(created.values_list('field_name', 'serialized_data')),
+                         [('age', serializers.serialize('json', [Human.objects.get()], fields=['age'])),
+                          ('name', serializers.serialize('json', [people[1]], fields=['name'])),
+                          ('name', serializers.serialize('json', [people[3]], fields=['name']))])
+        self.assertEqual(FieldHistory.objects.count(), 9)
+        self.assertIn('tests.Person: created 2 FieldHistory object(s), up to pk {}'.format(people[4].pk),
+                      stdout.getvalue())
+
+    def test_createinitialfieldhistory_command_resumes_from_checkpoint(self):
+        people = [Person.objects.create(name='Person {}'.format(i)) for i in range(3)]
+        FieldHistory.objects.all().delete()
+        checkpoint = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.addCleanup(os.remove, checkpoint.name)
+        with checkpoint:
+            json.dump({'tests.Person': [{'lower': None, 'upper': None, 'last_pk': str(people[1].pk), 'done': False}]},
+                      checkpoint)
+
+        call_command('createinitialfieldhistory', checkpoint=checkpoint.name, stdout=six.StringIO())
+
+        self.assertEqual(list(FieldHistory.objects.values_list('object_id', flat=True)), [str(people[2].pk)])
+        with open(checkpoint.name) as f:
+            self.assertEqual([partition['done'] for partition in json.load(f)['tests.Person']], [True])
+
+        FieldHistory.objects.all().delete()
+        call_command('createinitialfieldhistory', checkpoint=checkpoint.name, stdout=six.StringIO())
+
+        self.assertEqual(FieldHistory.objects.count(), 0)
+
+    def test_createinitialfieldhistory_command_models(self):
+        Person.objects.create(name='Initial Name')
+        PizzaOrder.objects.create(status=PizzaOrder.STATUS_ORDERED)
+        FieldHistory.objects.all().delete()
+
+        call_command('createinitialfieldhistory', models=['tests.person'], stdout=six.StringIO())
+
+        self.assertEqual(list(FieldHistory.objects.values_list('field_name', flat=True)), ['name'])
+        with self.assertRaises(CommandError):
+            call_command('createinitialfieldhistory', models=['tests.Pet'], stdout=six.StringIO())
+
+    def test_createinitialfieldhistory_command_partitions(self):
+        people = [Person.objects.create(name='Person {}'.format(i)) for i in range(7)]
+
+        partitions = get_partitions(Person, 3)
+
+        pks = [str(person.pk) for person in people]
+        self.assertEqual(partitions, [(None, pks[1]), (pks[1], pks[3]), (pks[3], None)])
+        self.assertEqual(get_partitions(Person, 1), [(None, None)])
+        self.assertEqual(get_partitions(Pet, 3), [(None, None)])
+        FieldHistory.objects.all().delete()
+        tracker = Person.field_history
+        self.assertEqual([sum(batch[1] for batch in iter_initial_field_histories(Person, tracker, lower, upper))
+                          for lower, upper in partitions], [2, 2, 3])
+        self.assertEqual(FieldHistory.objects.count(), 7)
+
+    def test_createinitialfieldhistory_command_workers_need_shared_database(self):
+        with self.assertRaises(CommandError):
+            call_command('createinitialfieldhistory', workers=2, stdout=six.StringIO())
+
+    def test_convertfieldhistoryobjectids(self):
+        person = Person.objects.create(name='Initial Name')
+        invoice = Invoice.objects.create(status='DRAFT')
+
+        call_command('convertfieldhistoryobjectids', batch_size=1, stdout=six.StringIO())
+
+        # The object id is kept until typed object ids are used
+        history = person.get_name_history().get()
+        self.assertEqual((history.object_id, history.object_id_int), (str(person.pk), person.pk))
+        history = invoice.get_status_history().get()
+        self.assertEqual(history.object_id_uuid, invoice.pk)
+        self.assertIsNotNone(history.object_id)
+
+        with override_settings(**TYPED_OBJECT_ID_SETTINGS):
+            call_command('convertfieldhistoryobjectids', stdout=six.StringIO())
+
+            history = person.get_name_history().get()
+            self.assertEqual((history.object_id, history.object_id_int), (None, person.pk))
+            history = invoice.get_status_history().get()
+            self.assertEqual((history.object_id, history.object_id_uuid), (None, invoice.pk))
+
+    def test_convertfieldhistoryobjectids_leaves_invalid_object_ids(self):
+        person = Person.objects.create(name='Jon')
+        Person.objects.create(name='Liz')
+        Invoice.objects.create(status='DRAFT')
+        Invoice.objects.create(status='DRAFT')
+        FieldHistory.objects.filter(pk__in=[
+            Person.objects.get(name='Liz').get_name_history().get().pk,
+            FieldHistory.objects.filter(field_name='status').earliest().pk,
+        ]).update(object_id='not-an-id')
+
+        stderr = six.StringIO()
+        with override_settings(**TYPED_OBJECT_ID_SETTINGS):
+            call_command('convertfieldhistoryobjectids', stdout=six.StringIO(), stderr=stderr)
+
+            self.assertEqual(person.get_name_history().get().object_id_int, person.pk)
+
+        self.assertEqual(stderr.getvalue().count("invalid object id: 'not-an-id'"), 2)
+        self.assertEqual(list(FieldHistory.objects.filter(object_id='not-an-id').values_list(
+            'object_id_int', 'object_id_uuid')), [(None, None), (None, None)])
+        self.assertEqual(FieldHistory.objects.filter(field_name='status', object_id_uuid__isnull=False).count(), 1)
+
+    def test_convertfieldhistoryobjectids_skips_other_primary_key_types(self):
+        Person.objects.create(name='Initial Name')
+
+        call_command('convertfieldhistoryobjectids', model=['tests.Pet'], stdout=six.StringIO())
+
+        self.assertIsNone(FieldHistory.objects.get().object_id_int)
+
+    def test_convertfieldhistoryformat(self):
+        pet = Pet.objects.create(name='Garfield')
+        Owner.objects.create(name='Jon', pet=pet)
+        Human.objects.create(age=18, body_temp=Decimal('98.60'), birth_date=datetime.date(1991, 11, 6))
+        invoice = Invoice.objects.create(status='DRAFT')
+        values = list(FieldHistory.objects.order_by('pk').field_values('pk'))
+
+        with override_settings(**COMPACT_SETTINGS):
+            call_command('convertfieldhistoryformat', batch_size=2, stdout=six.StringIO(), stderr=six.StringIO())
+
+        self.assertFalse(FieldHistory.objects.exclude(serialized_data__startswith='=').exists())
+        self.assertEqual(list(FieldHistory.objects.order_by('pk').field_values('pk')), values)
+
+        call_command('convertfieldhistoryformat', stdout=six.StringIO(), stderr=six.StringIO())
+
+        self.assertFalse(FieldHistory.objects.filter(serialized_data__startswith='=').exists())
+        self.assertEqual(list(FieldHistory.objects.order_by('pk').field_values('pk')), values)
+        self.assertEqual(invoice.get_status_history().get().serialized_data,
+                         serializers.serialize('json', [invoice], fields=['status']))
+
+    def test_convertfieldhistoryformat_skips_removed_fields(self):
+        person = Person.objects.create(name='Jon')
+        FieldHistory.objects.update(field_name='removed')
+        Person.objects.create(name='Liz')
+
+        stdout = six.StringIO()
+        with override_settings(**COMPACT_SETTINGS):
+            call_command('convertfieldhistoryformat', batch_size=1, stdout=stdout, stderr=six.StringIO())
+
+        self.assertIn('Skipped 1 FieldHistory object(s)', stdout.getvalue())
+        self.assertTrue(FieldHistory.objects.get(object_id=person.pk).serialized_data.startswith('['))
+        self.assertEqual(FieldHistory.objects.filter(serialized_data__startswith='=').count(), 1)
+
     def test_renamefieldhistory(self):
         Person.objects.create(name='Initial Name')
 
@@ -344,6 +1622,23 @@ class ManagementCommandsTests(TestCase):
         self.assertEqual(FieldHistory.objects.filter(field_name='name').count(), 0)
         self.assertEqual(FieldHistory.objects.filter(field_name='name2').count(), 1)
 
+    def test_renamefieldhistory_in_batches(self):
+        for i in range(3):
+            Owner.objects.create(name='Owner {}'.format(i))
+            Person.objects.create(name='Person {}'.format(i))
+        Human.objects.create(age=18)
+
+        stdout = six.StringIO()
+        call_command('renamefieldhistory', model=['tests.Person', 'tests.Owner'], renames=[('name', 'pet'), ('pet', 'name')],
+                     batch_size=4, sleep=0.001, stdout=stdout)
+
+        # Renames are applied together, so they can swap field names
+        expected = [('human', 'age'), ('human', 'birth_date'), ('human', 'body_temp'), ('human', 'is_female')]
+        expected.extend([('owner', 'name')] * 3 + [('owner', 'pet')] * 3 + [('person', 'pet')] * 3)
+        self.assertEqual(sorted(FieldHistory.objects.values_list('content_type__model', 'field_name')), expected)
+        self.assertIn('Updated 9 of 9 FieldHistory object(s)', stdout.getvalue())
+        self.assertEqual(stdout.getvalue().count('Updated'), 3)
+
     def test_renamefieldhistory_model_arg_is_required(self):
         Person.objects.create(name='Initial Name')
 